@@ -0,0 +1,126 @@
+"""
+Compare the binary command encoding (widget.binary_commands) with JSON for
+the recorded command traces and for numeric update workloads.
+
+$ python benchmarks/binary_commands_benchmark.py
+
+For each workload this reports the message bytes, the kernel side encoding
+time (json.dumps or binary_commands.encode_commands) and, if node is
+available, the view side decoding time (JSON.parse or decode_binary_commands).
+"""
+
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from jp_proxy_widget import binary_commands
+
+TRACES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "command_traces.json")
+NODE_VIEW = os.path.join(ROOT, "tests", "node_view.js")
+MIN_SECONDS = 0.2
+
+def float_updates():
+    "Scatter plot coordinate updates: method calls with 1000 floats."
+    rng = random.Random(1)
+    return [[i, [["method", ["element"], "plot", ["list"] + [rng.random() * 1000 for j in range(1000)]]], 1]
+        for i in range(50)]
+
+def int_updates():
+    "Method calls with 1000 integers."
+    rng = random.Random(2)
+    return [[i, [["method", ["element"], "plot", ["list"] + [rng.randrange(-10 ** 9, 10 ** 9) for j in range(1000)]]], 1]
+        for i in range(50)]
+
+def workloads():
+    with open(TRACES) as f:
+        result = list(json.load(f).items())
+    result.append(("float_updates", float_updates()))
+    result.append(("int_updates", int_updates()))
+    return result
+
+def time_it(function, argument):
+    "Return the best seconds per call over at least MIN_SECONDS."
+    best = None
+    total = 0.0
+    while total < MIN_SECONDS:
+        start = time.perf_counter()
+        function(argument)
+        elapsed = time.perf_counter() - start
+        total += elapsed
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+NODE_SCRIPT = """
+var make_view = require(%(loader)s).make_view;
+var fs = require("fs");
+var view = make_view({});
+var texts = JSON.parse(fs.readFileSync(%(texts)s, "utf8"));
+var data = new Uint8Array(fs.readFileSync(%(binary)s));
+var buffers = [];
+var cursor = 0;
+%(sizes)s.forEach(function(size) {
+    buffers.push(data.subarray(cursor, cursor + size));
+    cursor += size;
+});
+function best(f) {
+    var result = Infinity;
+    var total = 0;
+    while (total < %(min_ms)s) {
+        var start = process.hrtime.bigint();
+        f();
+        var elapsed = Number(process.hrtime.bigint() - start) / 1e6;
+        total += elapsed;
+        result = Math.min(result, elapsed);
+    }
+    return result;
+}
+console.log(JSON.stringify([
+    best(function() { texts.forEach(function(text) { JSON.parse(text); }); }),
+    best(function() { buffers.forEach(function(buffer) { view.decode_binary_commands(buffer); }); }),
+]));
+"""
+
+def node_decode_ms(texts, encoded):
+    "Return [JSON.parse ms, decode_binary_commands ms] for all the messages, or None without node."
+    node = shutil.which("node")
+    if node is None:
+        return None
+    with tempfile.TemporaryDirectory() as directory:
+        texts_path = os.path.join(directory, "texts.json")
+        binary_path = os.path.join(directory, "binary")
+        with open(texts_path, "w") as f:
+            json.dump(texts, f)
+        with open(binary_path, "wb") as f:
+            f.write(b"".join(encoded))
+        script = NODE_SCRIPT % dict(loader=json.dumps(NODE_VIEW), texts=json.dumps(texts_path),
+            binary=json.dumps(binary_path), sizes=json.dumps([len(b) for b in encoded]),
+            min_ms=MIN_SECONDS * 1000)
+        return json.loads(subprocess.check_output([node, "-e", script]))
+
+def main():
+    print("%-14s %10s %10s %6s %10s %10s %10s %10s" % (
+        "workload", "json KB", "binary KB", "ratio", "dumps ms", "encode ms", "parse ms", "decode ms"))
+    for (name, payloads) in workloads():
+        texts = [json.dumps(p) for p in payloads]
+        encoded = [binary_commands.encode_commands(p) for p in payloads]
+        json_size = sum(len(t.encode("utf-8")) for t in texts)
+        binary_size = sum(len(b) for b in encoded)
+        dumps = time_it(lambda ps: [json.dumps(p) for p in ps], payloads)
+        encode = time_it(lambda ps: [binary_commands.encode_commands(p) for p in ps], payloads)
+        decoding = node_decode_ms(texts, encoded) or [float("nan"), float("nan")]
+        print("%-14s %10.1f %10.1f %6.2f %10.2f %10.2f %10.2f %10.2f" % (
+            name, json_size / 1000.0, binary_size / 1000.0, binary_size / float(json_size),
+            dumps * 1000, encode * 1000, decoding[0], decoding[1]))
+        sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Report throughput in MB/s for the jp_proxy_widget.hex_codec codecs.
+
+$ python benchmarks/codec_benchmark.py
+$ python benchmarks/codec_benchmark.py --max-size 10MB --legacy
+
+Sizes run from 1KB up to --max-size (500MB by default -- large sizes need
+several GB of memory).  With --legacy the former codecs based implementation
+and the former per-byte uploader decoding are measured too (per-byte decoding
+is limited to 1MB because it is very slow).
+"""
+
+import argparse
+import codecs
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from jp_proxy_widget import hex_codec
+
+SIZES = ["1KB", "10KB", "100KB", "1MB", "10MB", "100MB", "500MB"]
+UNITS = {"KB": 1000, "MB": 1000 ** 2, "GB": 1000 ** 3}
+STREAM_CHUNK = 1000000
+LEGACY_PER_BYTE_LIMIT = UNITS["MB"]
+
+def parse_size(size):
+    size = size.strip().upper()
+    for (unit, factor) in UNITS.items():
+        if size.endswith(unit):
+            return int(float(size[:-len(unit)]) * factor)
+    return int(size)
+
+def chunked(text, chunk_size=STREAM_CHUNK):
+    return [text[i: i + chunk_size] for i in range(0, len(text), chunk_size)]
+
+def stream_decode(decoder_class, text):
+    decoder = decoder_class()
+    return b"".join(decoder.iter_decode(chunked(text)))
+
+def legacy_bytearray_to_hex(binary):
+    return codecs.decode(codecs.encode(binary, "hex_codec"), "utf8")
+
+def legacy_hex_to_bytearray(hex):
+    return bytearray(codecs.decode(hex, "hex_codec"))
+
+def legacy_from_hex_iterator(hexcontent):
+    for i in range(0, len(hexcontent), 2):
+        yield bytes(((int(hexcontent[i: i+2], 16)),))
+
+def time_it(function, argument, min_time=0.2):
+    "Return the best seconds per call, repeating small calls until min_time has elapsed."
+    best = None
+    total = 0.0
+    count = 0
+    while total < min_time or count < 1:
+        start = time.perf_counter()
+        function(argument)
+        elapsed = time.perf_counter() - start
+        total += elapsed
+        count += 1
+        if best is None or elapsed < best:
+            best = elapsed
+        if elapsed > min_time:
+            break
+    return best
+
+def benchmarks(size, legacy):
+    "Return a list of (name, function, argument) for payloads of size bytes."
+    binary = os.urandom(size)
+    view = memoryview(binary)
+    hex_text = hex_codec.bytes_to_hex(binary)
+    base64_text = hex_codec.bytes_to_base64(binary)
+    result = [
+        ("hex encode (memoryview)", hex_codec.bytes_to_hex, view),
+        ("hex decode", hex_codec.hex_to_bytes, hex_text),
+        ("hex stream decode", lambda t: stream_decode(hex_codec.HexStreamDecoder, t), hex_text),
+        ("base64 encode (memoryview)", hex_codec.bytes_to_base64, view),
+        ("base64 decode", hex_codec.base64_to_bytes, base64_text),
+        ("base64 stream decode", lambda t: stream_decode(hex_codec.Base64StreamDecoder, t), base64_text),
+    ]
+    if legacy:
+        result.extend([
+            ("legacy hex encode", legacy_bytearray_to_hex, binary),
+            ("legacy hex decode", legacy_hex_to_bytearray, hex_text),
+        ])
+        if size <= LEGACY_PER_BYTE_LIMIT:
+            result.append(
+                ("legacy per-byte decode", lambda t: b"".join(legacy_from_hex_iterator(t)), hex_text))
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--max-size", default="500MB", help="largest payload size (default 500MB)")
+    parser.add_argument("--legacy", action="store_true", help="also measure the former implementations")
+    args = parser.parse_args()
+    max_size = parse_size(args.max_size)
+    print("%-28s %10s %12s" % ("codec", "size", "MB/s"))
+    for size_name in SIZES:
+        size = parse_size(size_name)
+        if size > max_size:
+            break
+        for (name, function, argument) in benchmarks(size, args.legacy):
+            seconds = time_it(function, argument)
+            rate = (size / UNITS["MB"]) / seconds if seconds > 0 else float("inf")
+            print("%-28s %10s %12.1f" % (name, size_name, rate))
+            sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
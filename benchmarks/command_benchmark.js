@@ -0,0 +1,117 @@
+// Replay recorded command traces through JSProxyView.execute_commands in node
+// and report top level commands per second for each implementation file.
+//
+// $ python benchmarks/record_command_traces.py     (to refresh command_traces.json)
+// $ node benchmarks/command_benchmark.js
+// $ git show <revision>:js/lib/proxy_implementation.js > /tmp/before.js
+// $ node benchmarks/command_benchmark.js /tmp/before.js js/lib/proxy_implementation.js
+//
+// The widget modules are replaced by minimal stand ins and the element is a
+// fake object whose methods are chainable no-ops, so the numbers measure the
+// command executor rather than the DOM.
+
+var fs = require("fs");
+var path = require("path");
+var Module = require("module");
+
+var ROOT = path.dirname(__dirname);
+var TRACES = path.join(__dirname, "command_traces.json");
+var MIN_SECONDS = 0.5;
+
+var stand_ins = {
+    "@jupyter-widgets/base": (function() {
+        var extend = function(properties) {
+            var constructor = function() {};
+            Object.assign(constructor.prototype, properties);
+            constructor.extend = extend;
+            return constructor;
+        };
+        var defaults = function() { return {}; };
+        return {
+            DOMWidgetModel: {extend: extend, prototype: {defaults: defaults}},
+            DOMWidgetView: {extend: extend},
+        };
+    })(),
+    "lodash": {extend: Object.assign},
+    "jquery": (function() {
+        var jquery = function() {};
+        jquery.isArray = Array.isArray;
+        return jquery;
+    })(),
+};
+
+var original_require = Module.prototype.require;
+Module.prototype.require = function(name) {
+    if (name in stand_ins) {
+        return stand_ins[name];
+    }
+    return original_require.apply(this, arguments);
+};
+
+global.window = global;
+
+function fake_element() {
+    // properties which were set read back, anything else is a chainable method.
+    var proxy = new Proxy({}, {
+        get: function(target, name) {
+            return (name in target) ? target[name] : chain;
+        },
+    });
+    var chain = function() { return proxy; };
+    return proxy;
+}
+
+function make_view(implementation) {
+    var JSProxyView = require(path.resolve(implementation)).JSProxyView;
+    var view = Object.create(JSProxyView.prototype);
+    var attributes = {};
+    view.model = {
+        get: function(name) { return attributes[name]; },
+        set: function(name, value) { attributes[name] = value; },
+    };
+    view.touch = function() {};
+    view.send_custom_message = function() {};
+    view.$$el = fake_element();
+    return view;
+}
+
+function run_trace(view, text) {
+    // Return [commands, seconds] for executing fresh copies of the trace
+    // (messages are parsed outside the timed loop, as they arrive parsed).
+    var commands = 0;
+    var seconds = 0;
+    while (seconds < MIN_SECONDS) {
+        var payloads = JSON.parse(text);
+        var start = process.hrtime.bigint();
+        for (var i=0; i<payloads.length; i++) {
+            view.execute_commands(payloads[i], []);
+            commands += payloads[i][1].length;
+        }
+        seconds += Number(process.hrtime.bigint() - start) / 1e9;
+    }
+    return [commands, seconds];
+}
+
+function main() {
+    var implementations = process.argv.slice(2);
+    if (!implementations.length) {
+        implementations = [path.join(ROOT, "js", "lib", "proxy_implementation.js")];
+    }
+    var traces = JSON.parse(fs.readFileSync(TRACES, "utf8"));
+    var names = Object.keys(traces);
+    var texts = {};
+    names.forEach(function(name) { texts[name] = JSON.stringify(traces[name]); });
+    console.log("trace          implementation                      commands/s");
+    names.forEach(function(name) {
+        implementations.forEach(function(implementation) {
+            var view = make_view(implementation);
+            run_trace(view, texts[name]);   // warm up
+            var measured = run_trace(view, texts[name]);
+            var rate = measured[0] / measured[1];
+            console.log(name.padEnd(14) + " " + path.basename(implementation).padEnd(35) + " " +
+                rate.toFixed(0).padStart(10));
+        });
+    });
+}
+
+main();
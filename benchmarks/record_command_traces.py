@@ -0,0 +1,70 @@
+"""
+Record command message payloads sent by jp_proxy_widget for typical usage
+patterns, for replay by command_benchmark.js.
+
+$ python benchmarks/record_command_traces.py
+
+writes benchmarks/command_traces.json mapping trace names to lists of
+[count, commands, level, ...] payloads as sent in "commands" messages.
+Binary values are sent as hexidecimal strings so the traces need no buffers.
+"""
+
+import json
+import os
+import sys
+from unittest.mock import MagicMock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from jp_proxy_widget import proxy_widget
+
+OUTPUT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "command_traces.json")
+
+def lazy_element(widget):
+    "Chained element calls through the lazy interface (fragile reference slots)."
+    for i in range(100):
+        widget.element.css("left", i).html("item %s" % i)
+
+def js_init(widget):
+    "Repeated js_init calls with structured arguments."
+    for i in range(50):
+        widget.js_init("element.data = [x, options];", x=i, options=dict(labels=["a", "b", "c"], scale=1.5))
+
+def wide_calls(widget):
+    "Method calls with many arguments and long numeric lists."
+    element = widget.get_element()
+    for i in range(25):
+        widget(element.update(*range(i, i + 100)))
+        widget(element.plot(list(range(i, i + 200)), dict(color="red", width=i)))
+
+def templates(widget):
+    "Command template calls with packed numeric parameters."
+    move = widget.template(lambda element, x, y: element.css("left", x).css("top", y))
+    for i in range(250):
+        move(i, 2 * i)
+
+TRACES = [lazy_element, js_init, wide_calls, templates]
+
+def record(scenario):
+    widget = proxy_widget.JSProxyWidget()
+    widget.binary_buffers = False
+    widget.rendered = True
+    widget.send = MagicMock()
+    scenario(widget)
+    widget.flush()
+    payloads = []
+    for call in widget.send.call_args_list:
+        message = call[0][0]
+        if message[proxy_widget.INDICATOR] == proxy_widget.COMMANDS:
+            payloads.append(message[proxy_widget.PAYLOAD])
+    return payloads
+
+def main():
+    traces = dict((scenario.__name__, record(scenario)) for scenario in TRACES)
+    with open(OUTPUT, "w") as f:
+        json.dump(traces, f)
+    for (name, payloads) in traces.items():
+        print("%-14s %6d batches %7d commands" % (name, len(payloads), sum(len(p[1]) for p in payloads)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+Compact binary encoding for command messages.
+
+When a widget sets binary_commands and the view accepts it at render time,
+the command payload [count, commands, level, ...] is sent as one binary
+message buffer instead of nested JSON lists.  Each value is a type tag byte
+followed by its content:
+
+    NULL, FALSE, TRUE                  no content
+    INT32                              4 byte little endian signed integer
+    FLOAT64                            8 byte little endian float (other numbers)
+    STRING                             uint32 byte length, UTF-8 bytes
+    LIST                               uint32 item count, items
+    DICT                               uint32 item count, (uint32 length, UTF-8 key, value) pairs
+    COMMAND                            uint8 opcode, uint32 argument count, arguments
+
+COMMAND encodes a list starting with a known indicator string, using the
+indicator's position in OPCODES.  The view decodes the buffer back into the
+same payload structure (decode_binary_commands in proxy_implementation.js).
+"""
+
+import struct
+
+# Value type tags.
+NULL = 0
+FALSE = 1
+TRUE = 2
+INT32 = 3
+FLOAT64 = 4
+STRING = 5
+LIST = 6
+DICT = 7
+COMMAND = 8
+
+# Command indicators by opcode.  Only append to this list: the view uses the same table.
+OPCODES = [
+    "element", "window", "method", "function", "get", "set", "id", "list", "dict",
+    "callback", "null", "bytes", "text", "ndarray", "ref", "load_css", "load_js",
+    "cached_function", "hole", "template_define", "template_call", "evaluate",
+    "evaluate_many", "result", "handle_set", "handle", "handle_retain", "handle_release",
+    "forget_callbacks",
+]
+
+OPCODE = dict((indicator, code) for (code, indicator) in enumerate(OPCODES))
+
+INT32_MIN = -(2 ** 31)
+INT32_MAX = 2 ** 31 - 1
+
+_int32 = struct.Struct("<Bi")
+_float64 = struct.Struct("<Bd")
+_sized = struct.Struct("<BI")
+_command = struct.Struct("<BBI")
+_length = struct.Struct("<I")
+
+def encode_commands(payload):
+    "Return a bytearray holding the binary encoding of a command payload."
+    output = bytearray()
+    _encode(payload, output)
+    return output
+
+def _encode(value, output):
+    ty = type(value)
+    if value is None:
+        output.append(NULL)
+    elif ty is bool:
+        output.append(TRUE if value else FALSE)
+    elif ty is int:
+        if INT32_MIN <= value <= INT32_MAX:
+            output += _int32.pack(INT32, value)
+        else:
+            output += _float64.pack(FLOAT64, value)
+    elif ty is float:
+        output += _float64.pack(FLOAT64, value)
+    elif ty is str:
+        encoded = value.encode("utf-8")
+        output += _sized.pack(STRING, len(encoded))
+        output += encoded
+    elif ty is list or ty is tuple:
+        code = OPCODE.get(value[0]) if value and type(value[0]) is str else None
+        if code is not None:
+            output += _command.pack(COMMAND, code, len(value) - 1)
+            items = value[1:]
+        else:
+            output += _sized.pack(LIST, len(value))
+            items = value
+        for item in items:
+            _encode(item, output)
+    elif ty is dict:
+        output += _sized.pack(DICT, len(value))
+        for (key, item) in value.items():
+            encoded = str(key).encode("utf-8")
+            output += _length.pack(len(encoded))
+            output += encoded
+            _encode(item, output)
+    elif isinstance(value, (bool, int, float, str)):
+        # subclasses such as enumerations encode like their base type.
+        for base in (bool, int, float, str):
+            if isinstance(value, base):
+                _encode(base(value), output)
+                break
+    else:
+        raise TypeError("cannot encode value as binary command data " + repr(ty))
+
+def decode_commands(data):
+    "Decode a binary command payload (the inverse of encode_commands, used for testing and debugging)."
+    (value, cursor) = _decode(memoryview(data), 0)
+    if cursor != len(data):
+        raise ValueError("extra data after binary command payload")
+    return value
+
+def _decode(data, cursor):
+    tag = data[cursor]
+    if tag == NULL:
+        return (None, cursor + 1)
+    if tag == FALSE:
+        return (False, cursor + 1)
+    if tag == TRUE:
+        return (True, cursor + 1)
+    if tag == INT32:
+        return (_int32.unpack_from(data, cursor)[1], cursor + _int32.size)
+    if tag == FLOAT64:
+        return (_float64.unpack_from(data, cursor)[1], cursor + _float64.size)
+    if tag == STRING:
+        length = _sized.unpack_from(data, cursor)[1]
+        start = cursor + _sized.size
+        return (str(data[start: start + length], "utf-8"), start + length)
+    if tag == LIST or tag == COMMAND:
+        if tag == LIST:
+            count = _sized.unpack_from(data, cursor)[1]
+            cursor += _sized.size
+            result = []
+        else:
+            (_, code, count) = _command.unpack_from(data, cursor)
+            cursor += _command.size
+            result = [OPCODES[code]]
+        for i in range(count):
+            (item, cursor) = _decode(data, cursor)
+            result.append(item)
+        return (result, cursor)
+    if tag == DICT:
+        count = _sized.unpack_from(data, cursor)[1]
+        cursor += _sized.size
+        result = {}
+        for i in range(count):
+            length = _length.unpack_from(data, cursor)[0]
+            start = cursor + _length.size
+            key = str(data[start: start + length], "utf-8")
+            (result[key], cursor) = _decode(data, start + length)
+        return (result, cursor)
+    raise ValueError("bad binary command tag %s at %s" % (tag, cursor))
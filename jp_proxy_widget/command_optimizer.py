@@ -0,0 +1,121 @@
+"""
+Peephole optimization for validated command batches.
+
+The lazy element interface saves intermediate values in slots of the widget
+element, like ["set", ["element"], "_FRAGILE_THIS", value], and many of these
+writes are overwritten before anything reads them.  optimize_commands scans a
+batch backwards tracking which element slots will be overwritten before they
+are read, and
+
+  - removes top level "set" commands on element slots which are dead (or replaces
+    them with ["null", value] if evaluating the value may have side effects),
+  - removes top level ["null", value] commands where the value is a pure read.
+
+All slots are assumed to be read after the batch.  Fragile slots are assumed to be
+read only by explicit "get" commands, template calls or calls to the methods in slot_readers.
+Other slots may be read by any call, so calls keep earlier writes to them alive.
+Getting a property may run a getter, so only reads of fragile slots of the element are pure.
+"""
+
+# Commands whose evaluation has no side effects if their parts have none.
+PURE_INDICATORS = frozenset(["element", "window", "list", "dict", "id", "callback",
+    "bytes", "text", "ndarray", "ref", "cached_function", "handle"])
+
+# Commands with untranslated data, which is not searched for reads.
+DATA_INDICATORS = frozenset(["id", "callback", "bytes", "text", "ndarray"])
+
+ELEMENT = ["element"]
+
+def optimize_commands(commands, fragile_slots=(), slot_readers=None):
+    """
+    Return (optimized_commands, changes) for a list of validated top level commands,
+    where changes is a list of (original_command, replacement_or_None) pairs.
+    slot_readers maps method names to the fragile slot the method reads.
+    """
+    slot_readers = slot_readers or {}
+    fragile_slots = frozenset(fragile_slots)
+    # names of element slots which are written later in the batch before any read.
+    killed = set()
+    optimized = []
+    changes = []
+    for command in reversed(commands):
+        replacement = command
+        if type(command) is list and command:
+            indicator = command[0]
+            if indicator == "set" and command[1] == ELEMENT and type(command[2]) is str:
+                name = command[2]
+                value = command[3]
+                if name in killed:
+                    # dead write: keep only the side effects of evaluating the value.
+                    replacement = None if is_pure(value, fragile_slots) else ["null", value]
+                else:
+                    killed.add(name)
+                note_reads(value, killed, fragile_slots, slot_readers)
+            elif indicator == "null" and is_pure(command[1], fragile_slots):
+                replacement = None
+            else:
+                note_reads(command, killed, fragile_slots, slot_readers)
+        else:
+            note_reads(command, killed, fragile_slots, slot_readers)
+        if replacement is not command:
+            changes.append((command, replacement))
+        if replacement is not None:
+            optimized.append(replacement)
+    if not changes:
+        return (commands, changes)
+    optimized.reverse()
+    changes.reverse()
+    return (optimized, changes)
+
+def is_pure(command, fragile_slots=()):
+    "Test whether evaluating a validated command can have no side effects."
+    if type(command) is not list:
+        return True
+    if not command:
+        return True
+    indicator = command[0]
+    if indicator == "get":
+        # fragile slots hold plain values saved by earlier commands.
+        return command[1] == ELEMENT and type(command[2]) is str and command[2] in fragile_slots
+    if indicator not in PURE_INDICATORS:
+        return False
+    if indicator in DATA_INDICATORS:
+        return True
+    for part in command[1:]:
+        if type(part) is dict:
+            if not all(is_pure(v, fragile_slots) for v in part.values()):
+                return False
+        elif not is_pure(part, fragile_slots):
+            return False
+    return True
+
+def note_reads(command, killed, fragile_slots, slot_readers):
+    "Remove the slots which evaluating command may read from the killed set."
+    if not killed or type(command) is not list or not command:
+        return
+    indicator = command[0]
+    if indicator in DATA_INDICATORS:
+        return
+    if indicator == "get":
+        name = command[2]
+        if type(name) is str:
+            # the target may be an alias of the element: match reads by name.
+            killed.discard(name)
+        else:
+            killed.clear()
+    elif indicator == "template_call":
+        # the template may read any slot of the element.
+        killed.clear()
+    elif indicator in ("method", "function") or indicator not in PURE_INDICATORS:
+        if indicator == "method" and command[2] in slot_readers:
+            killed.discard(slot_readers[command[2]])
+        # calls may read any non fragile property of the element.
+        for name in list(killed):
+            if name not in fragile_slots:
+                killed.discard(name)
+    for part in command[1:]:
+        if type(part) is dict:
+            for v in part.values():
+                note_reads(v, killed, fragile_slots, slot_readers)
+        else:
+            note_reads(part, killed, fragile_slots, slot_readers)
@@ -1,17 +1,89 @@
-
-"""
-Helpers for sending/receiving binary data as unicode
 """
+Helpers for sending/receiving binary data as unicode.
 
-import codecs
+Encoders accept any object supporting the buffer protocol (bytes, bytearray,
+memoryview, numpy arrays) and read it without copying.  The stream decoders
+decode text arriving in chunks of arbitrary length, such as uploaded files.
+"""
 
-CODEC = 'hex_codec'
+import binascii
 
 def hex_to_bytearray(hex):
     "decode a hex string to a binary bytearray."
-    binary = codecs.decode(hex, CODEC)
-    return bytearray(binary)
+    return bytearray(binascii.unhexlify(hex))
+
+def hex_to_bytes(hex):
+    "decode a hex string to bytes."
+    return binascii.unhexlify(hex)
 
 def bytearray_to_hex(binary):
-    hexbytes = codecs.encode(binary, CODEC)
-    return codecs.decode(hexbytes, "utf8")
+    "encode binary data as a hex string."
+    return binascii.hexlify(binary).decode("ascii")
+
+bytes_to_hex = bytearray_to_hex
+
+def base64_to_bytes(text):
+    "decode a base64 string to bytes."
+    return binascii.a2b_base64(text)
+
+def bytes_to_base64(binary):
+    "encode binary data as a base64 string (with no line breaks)."
+    return binascii.b2a_base64(binary, newline=False).decode("ascii")
+
+
+class StreamDecoder(object):
+    """
+    Decode text encoded in units of block_size characters which arrives in chunks
+    that need not be aligned to the units.
+    """
+
+    block_size = 1
+
+    def __init__(self):
+        self.pending = ""
+
+    def decode_block(self, text):
+        raise NotImplementedError("decode_block must be defined in subclass")
+
+    def decode(self, chunk):
+        "decode as much of the chunk (and any pending text from the last chunk) as possible."
+        text = self.pending + chunk if self.pending else chunk
+        split = len(text) - (len(text) % self.block_size)
+        self.pending = text[split:]
+        if split == len(text):
+            return self.decode_block(text)
+        return self.decode_block(text[:split])
+
+    def finish(self):
+        "check that no partial unit is pending at the end of the stream."
+        if self.pending:
+            pending = self.pending
+            self.pending = ""
+            raise ValueError("incomplete encoded data at end of stream: " + repr(pending))
+        return b""
+
+    def iter_decode(self, chunks):
+        "generate decoded bytes for each chunk in an iterable of encoded chunks."
+        for chunk in chunks:
+            decoded = self.decode(chunk)
+            if decoded:
+                yield decoded
+        self.finish()
+
+
+class HexStreamDecoder(StreamDecoder):
+    "Decode a hex string arriving in chunks."
+
+    block_size = 2
+
+    def decode_block(self, text):
+        return binascii.unhexlify(text)
+
+
+class Base64StreamDecoder(StreamDecoder):
+    "Decode a base64 string (with no line breaks) arriving in chunks."
+
+    block_size = 4
+
+    def decode_block(self, text):
+        return binascii.a2b_base64(text)
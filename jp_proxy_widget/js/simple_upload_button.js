@@ -48,19 +48,19 @@ more information on the error, such as "file too big."
             "continuation_style": false,   // default to 
         }, options);
         var result = $('<input type="file"/>');
-        var hex_byte = function (b) {
-            var result = b.toString(16);
-            if (result.length < 2) {
-                result = "0" + result
-            }
-            return result;
-        };
         var size_limit = settings.size_limit;
         var chunk_size = settings.chunk_size;
         var continuation_style = settings.continuation_style;
         var to_hex_string = function (buffer) {
+            // look up the two hex character codes for each byte and decode them all at once.
             var bytes = new Uint8Array(buffer);
-            return Array.from(bytes).map(hex_byte).join("");
+            var length = bytes.length;
+            var codes = new Uint16Array(length);
+            var table = $.fn.simple_upload_button.hex_codes;
+            for (var i=0; i<length; i++) {
+                codes[i] = table[bytes[i]];
+            }
+            return new TextDecoder("ascii").decode(codes);
         };
         if (settings.style) {
             result.css(settings.style);
@@ -127,6 +127,16 @@ more information on the error, such as "file too big."
         return result;
     };
 
+    // Table of the two (little endian) hex character codes for each byte value.
+    $.fn.simple_upload_button.hex_codes = (function() {
+        var digits = "0123456789abcdef";
+        var table = new Uint16Array(256);
+        for (var b=0; b<256; b++) {
+            table[b] = digits.charCodeAt(b >> 4) | (digits.charCodeAt(b & 15) << 8);
+        }
+        return table;
+    })();
+
     $.fn.simple_upload_button.example = function(element) {
         var output_area = $("<pre/>");
         element.append(output_area);
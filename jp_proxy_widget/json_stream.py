@@ -0,0 +1,79 @@
+"""
+Incremental JSON encoding and decoding for large segmented messages.
+
+iter_json generates the JSON text for a value in fragments while walking the
+value, so the complete JSON string is never held in memory.  iter_segments
+cuts a fragment stream into message segments of a fixed size.
+The text produced is identical to json.dumps(value).
+"""
+
+import json
+
+_encode_scalar = json.JSONEncoder().encode
+
+def iter_json(value, chunk_size=1000000):
+    """
+    Generate JSON text fragments for value.
+    Strings longer than chunk_size characters are encoded in pieces of chunk_size characters.
+    """
+    ty = type(value)
+    if ty is str:
+        if len(value) <= chunk_size:
+            yield _encode_scalar(value)
+        else:
+            yield '"'
+            for start in range(0, len(value), chunk_size):
+                # strip the quotes from each encoded piece.
+                yield _encode_scalar(value[start: start + chunk_size])[1:-1]
+            yield '"'
+    elif ty is list or ty is tuple:
+        if not value:
+            yield "[]"
+            return
+        separator = "["
+        for item in value:
+            yield separator
+            separator = ", "
+            for fragment in iter_json(item, chunk_size):
+                yield fragment
+        yield "]"
+    elif ty is dict:
+        if not value:
+            yield "{}"
+            return
+        separator = "{"
+        for (key, item) in value.items():
+            if type(key) is not str:
+                # match json.dumps conversion of non-string keys
+                key = _encode_scalar(key)
+            yield separator
+            separator = ", "
+            yield _encode_scalar(key)
+            yield ": "
+            for fragment in iter_json(item, chunk_size):
+                yield fragment
+        yield "}"
+    else:
+        yield _encode_scalar(value)
+
+def iter_segments(fragments, segment_size):
+    """
+    Regroup text fragments into segments of segment_size characters.
+    The last segment holds the remaining 1 to segment_size characters
+    (it is empty only if there is no text at all).
+    """
+    pending = []
+    pending_length = 0
+    for fragment in fragments:
+        pending.append(fragment)
+        pending_length += len(fragment)
+        if pending_length > segment_size:
+            text = "".join(pending)
+            cursor = 0
+            while len(text) - cursor > segment_size:
+                yield text[cursor: cursor + segment_size]
+                cursor += segment_size
+            tail = text[cursor:]
+            pending = [tail]
+            pending_length = len(tail)
+    yield "".join(pending)
@@ -93,6 +93,95 @@ JSON ENCODING: ["new", target, arg0, ... argn]
 JAVASCRIPT ACTION: thing = E(target); result = new E(arg0, ... argn)
 PASSED TO PYTHON: This should not be the end of the chain.
 
+WIDGET INTERFACE: (not exposed) bytes, bytearray or memoryview values.
+JSON ENCODING: ["bytes", hex_string] or ["bytes", buffer_index]
+JAVASCRIPT ACTION/RESULT: Uint8Array decoded from the hex string, or a
+   Uint8Array view (no copy) of the message buffer at buffer_index when
+   the widget uses binary_buffers transport.
+PASSED TO PYTHON: should never be returned.
+
+WIDGET INTERFACE: (not exposed) argument strings at least utf8_buffer_threshold long (not in templates).
+JSON ENCODING: ["text", buffer_index]
+JAVASCRIPT ACTION/RESULT: the UTF-8 decoded content of the message buffer at buffer_index.
+PASSED TO PYTHON: should never be returned.
+
+WIDGET INTERFACE: (not exposed) numpy.ndarray values.
+JSON ENCODING: ["ndarray", dtype_str, shape, ["bytes", ...]]
+JAVASCRIPT ACTION/RESULT: typed array (Float32Array, Int32Array, etcetera) matching
+   the little endian dtype_str, viewing the array bytes where possible.  The typed
+   array has additional dtype and shape properties.  64 bit integer arrays are sent as
+   Int32Array or Uint32Array if the values fit and Float64Array otherwise, unless they
+   are wrapped with bigint_array(array) to send BigInt64Array or BigUint64Array.
+PASSED TO PYTHON: should never be returned.
+
+WIDGET INTERFACE: widget.function(argument_names, body) (used by js_init)
+JSON ENCODING: ["cached_function", hash, argument_names_string, body] or ["cached_function", hash]
+JAVASCRIPT ACTION/RESULT: new Function(argument_names_string, E(body)) stored in a page level
+   registry under hash, or the function stored under hash.  The body is only sent if some
+   page displaying the widget has not acknowledged compiling it (see function_known).
+PASSED TO PYTHON: should never be returned.
+
+WIDGET INTERFACE: widget.template(builder) (holes are the builder arguments after element)
+JSON ENCODING: ["template_define", identifier, ["list", command, ...]] and ["hole", index] in the commands
+JAVASCRIPT ACTION/RESULT: store the commands as template identifier for the widget model, compiled
+   into a closure of the parameter vector by each view when first called.  Result is identifier.
+PASSED TO PYTHON: should never be returned.
+
+WIDGET INTERFACE: template(value0, value1, ...) or template.packed(array)
+JSON ENCODING: ["template_call", identifier, ["list", value0, ...]] or ["template_call", identifier, ndarray]
+JAVASCRIPT ACTION/RESULT: run the compiled template with params[i] as hole i.  Result is the list of
+   results of the template commands.
+PASSED TO PYTHON: list of values of the commands.
+
+WIDGET INTERFACE: await widget.evaluate_async(target)
+JSON ENCODING: ["evaluate", request_identifier, level, target]
+JAVASCRIPT ACTION/RESULT: evaluate E(target) and send an "evaluated" message
+   [request_identifier, ok, value] to the kernel at once (value is the error message if
+   the evaluation failed; the failure does not stop the batch).  Result is null.
+PASSED TO PYTHON: (the value is passed in the "evaluated" message)
+
+WIDGET INTERFACE: widget.evaluate_many({name: target, ...}) or widget.sync_values(target, [path, ...])
+JSON ENCODING: ["evaluate_many", request_identifier, level, ["dict", {name: target, ...}]]
+JAVASCRIPT ACTION/RESULT: evaluate each E(target) separately and send an "evaluated" message
+   [request_identifier, true, {name: [ok, value], ...}] to the kernel at once.  Result is null.
+PASSED TO PYTHON: (the values are passed in the "evaluated" message)
+
+WIDGET INTERFACE: widget.handle(target)
+JSON ENCODING: ["handle_set", handle, target]
+JAVASCRIPT ACTION/RESULT: store E(target) in the handle table of the widget model (shared by its views).
+   Result is E(target).
+PASSED TO PYTHON: (not sent: the method returns a JSHandle)
+
+WIDGET INTERFACE: a JSHandle used in a command
+JSON ENCODING: ["handle", handle]
+JAVASCRIPT ACTION/RESULT: the value stored in the handle table.
+PASSED TO PYTHON: json_safe(value)
+
+WIDGET INTERFACE: (not exposed) garbage collection of the last JSHandle for a handle
+JSON ENCODING: ["handle_release", handle, ...]
+JAVASCRIPT ACTION/RESULT: remove the handle table entries.  Result is null.
+   (The kernel counts the JSHandles for each handle; widget.handle(js_handle) adds one.)
+PASSED TO PYTHON: null
+
+WIDGET INTERFACE: (not exposed) sent with the next flush after callbacks are forgotten
+JSON ENCODING: ["forget_callbacks", identifier, ...]
+JAVASCRIPT ACTION/RESULT: drop the callbacks with the identifiers: calls to their
+   handlers do nothing.  Result is null.
+PASSED TO PYTHON: null
+
+WIDGET INTERFACE: widget.result(key, target, level)
+JSON ENCODING: ["result", key, level, target]
+JAVASCRIPT ACTION/RESULT: E(target), also sending a "result" message [batch_count, key, value]
+   to the kernel at once, which passes the value to the stream callback of the batch.
+PASSED TO PYTHON: (the value is passed in the "result" message)
+
+WIDGET INTERFACE: (not exposed) repeated subtrees and strings in a message when share_structure is set.
+JSON ENCODING: ["ref", table_index]
+JAVASCRIPT ACTION/RESULT: E(table[table_index]) where the table of shared values is sent
+   as the fourth element of the message payload [count, commands, level, table].
+   Table entries may refer to earlier entries.  The table is expanded once per message.
+PASSED TO PYTHON: should never be returned.
+
 WIDGET INTERFACE: <target>._null.
 JSON ENCODING: ["null", target]
 JAVASCRIPT ACTION: execute E(target) and discard the final value to prevent 
@@ -100,6 +189,40 @@ JAVASCRIPT ACTION: execute E(target) and discard the final value to prevent
    optimization to prevent unneeded communication.
 PASSED TO PYTHON: None
 
+If the widget sets binary_commands and the view accepts binary commands at render time
+the same command structures are sent in a compact binary encoding as the last message
+buffer of a "bin_commands" message (see the binary_commands module).  Segmented messages
+are always sent as JSON.
+
+If the view supports compression streams, message JSON at least compression_threshold
+characters long is sent deflate compressed as the last message buffer of a "compressed" message
+whose payload is the indicator for the decompressed payload.  Segmented command and callback
+payloads are compressed as a stream instead and the compressed bytes are segmented: each
+"cz_fragment" message (with payload stream, the callback stream tag or null) carries a buffer
+of compressed bytes and the final "compressed" message has the payload [indicator, stream].
+
+The view executes batches in the order they arrive, waiting for loads started by load_css
+and load_js before the rest of the batch and the batches after it.  With frame_budget_ms
+set, a long batch runs in slices of about that many milliseconds, one per animation frame.
+With defer_while_hidden, views out of sight queue batches instead (keeping only the last
+of consecutive commands setting the same element property, css, attr, etcetera) and run
+them when they are visible again (or when the queue exceeds max_deferred_commands).  Batches
+creating callbacks, replying to the kernel (sync_value) or using handles run at once, after
+the queue.
+The view acknowledges every batch when it completes with a "results" message [count, true]
+(or [count, false] if the batch failed).  Before that, each widget.result(key, command)
+in the batch sends a "result" message [count, key, value] as it is evaluated, for the
+stream_callback of the batch.  If flow_control_window is set the widget
+counts unacknowledged batches and holds back, merges or drops further batches while the
+window is full according to flow_control_policy (see backlog()).
+
+By default each step of a chain like widget.element.a.b(c) executes immediately, saving
+intermediate values in the _FRAGILE_THIS and _FRAGILE_JS_REFERENCE slots of the element.
+With expression_mode the chain builds an expression which is sent as one nested command
+["set", ["element"], "_FRAGILE_JS_REFERENCE", E(chain)] when it is used as a statement
+(when the next chain starts, commands are buffered or flushed, or the cell ends),
+or embedded in another command when it is used as an argument or for sync_value.
+
 """
 
 import ipywidgets as widgets
@@ -109,14 +232,26 @@ import IPython
 from IPython.display import display, HTML
 import traitlets
 import json
+import zlib
+import asyncio
+import weakref
+import itertools
+import heapq
+import sys
+import hashlib
+import inspect
 #import threading
 import types
 import traceback
 from . import js_context
+from . import json_stream
+from . import shared_commands
+from . import binary_commands
+from . import command_optimizer
 from .hex_codec import hex_to_bytearray, bytearray_to_hex
 from pprint import pprint
 import numpy as np
-from jupyter_ui_poll import run_ui_poll_loop
+from jupyter_ui_poll import run_ui_poll_loop, ui_events
 
 # In the IPython context get_ipython is a builtin.
 # get a reference to the IPython notebook object.
@@ -135,6 +270,17 @@ JSON_CB_FINAL = "jcb_final"
 COMMANDS = "commands"
 COMMANDS_FRAGMENT = "cm_fragment"
 COMMANDS_FINAL = "cm_final"
+BINARY_COMMANDS = "bin_commands"
+FUNCTION_MISS = "function_miss"
+FUNCTIONS_KNOWN = "functions_known"
+VIEW_RENDERED = "view_rendered"
+FUNCTION_BODIES = "function_bodies"
+EVALUATED = "evaluated"
+RESULT = "result"
+COMPRESSED = "compressed"
+COMPRESSED_FRAGMENT = "cz_fragment"
+# Unsegmented equivalents of final segment indicators, for sending segmented payloads compressed.
+UNSEGMENTED_INDICATORS = {COMMANDS_FINAL: COMMANDS, JSON_CB_FINAL: CALLBACK_RESULTS}
 LOAD_CSS = "load_css"
 LOAD_JS = "load_js"
 LOAD_INDICATORS = [LOAD_CSS, LOAD_JS]
@@ -147,9 +293,30 @@ FRAGILE_THIS = "_FRAGILE_THIS"
 
 SEND_FRAGILE_JS_REFERENCE = "_SEND_FRAGILE_JS_REFERENCE"
 
+FRAGILE_SLOTS = (FRAGILE_THIS, FRAGILE_JS_REFERENCE)
+
+# Callback lifetime: until the callback function is garbage collected.
+WEAK = "weak"
+
+# Hashes of functions compiled in each frontend page session (shared by all widgets in the kernel).
+KNOWN_FUNCTIONS = {}
+
+# Marker for binary values sent from javascript as message buffers: {BUFFER_REFERENCE: [index, dtype]}
+BUFFER_REFERENCE = "__jp_proxy_buffer__"
+
 # Message segmentation size default
 BIG_SEGMENT = 1000000
 
+# Flow control policies for batches sent while the window of unacknowledged batches is full.
+BLOCK = "block"
+COALESCE = "coalesce"
+DROP_OLDEST = "drop_oldest"
+FLOW_CONTROL_POLICIES = (BLOCK, COALESCE, DROP_OLDEST)
+
+# Held batches with these commands are merged into the next held batch instead of dropped,
+# so the handle table of the view agrees with the JSHandles.
+KEPT_ON_DROP = ("handle_set", "handle_release")
+
 class SyncTimeOutError(RuntimeError):
     "The sync operation between the kernel and Javascript timed out."
 
@@ -185,15 +352,99 @@ class JSProxyWidget(widgets.DOMWidget):
     # Set to automatically flush messages to javascript side without buffering after render.
     auto_flush = True
 
+    # If set with auto_flush, hold buffered commands for this many milliseconds (using the
+    # kernel asyncio event loop) and send them as one batch, or sooner if the buffered commands
+    # reach coalesce_flush_commands commands or coalesce_flush_bytes approximate bytes.
+    coalesce_flush_ms = None
+    coalesce_flush_commands = 1000
+    coalesce_flush_bytes = 1000000
+
+    # If set, chains like widget.element.a.b(c).d build an expression which is sent as one
+    # nested command when it is used as a statement, argument or sync_value, instead of
+    # executing each step through the fragile reference slots.
+    expression_mode = False
+
+    # If set, remove dead writes to element slots and useless "null" commands before sending
+    # batches (see the command_optimizer module).  This assumes the _FRAGILE_* slots of the
+    # element are only read by the commands the widget generates, not by javascript of your own.
+    optimize_commands = False
+
+    # Send js_init and function bodies once per browser page, then refer to the compiled function by hash.
+    function_cache = True
+
+    # If positive, the view runs long command batches in slices of about this many milliseconds,
+    # continuing in animation frames so the page stays responsive (0 runs batches to completion).
+    frame_budget_ms = traitlets.Integer(0, sync=True)
+
+    # If set, views which are scrolled out of sight queue (and compact) commands and postpone
+    # element.pausable_timeout and element.when_visible callbacks until they are visible again.
+    defer_while_hidden = traitlets.Bool(False, sync=True)
+
+    # Hidden views run their queue of deferred commands anyway if it grows beyond this length.
+    max_deferred_commands = traitlets.Integer(10000, sync=True)
+
+    # Visibility of each view by view identifier, reported by views with defer_while_hidden.
+    visibility = traitlets.Dict({}, sync=True)
+
+    # Send binary values as raw message buffers rather than hexidecimal strings.
+    binary_buffers = traitlets.Bool(True, sync=True)
+
+    # If set, send strings at least this long in command arguments as UTF-8 message buffers.
+    utf8_buffer_threshold = None
+
+    # Request compact binary command messages.  They are smaller and faster than JSON only for
+    # batches dominated by floating point numbers (see benchmarks/binary_commands_benchmark.py).
+    binary_commands = traitlets.Bool(False, sync=True)
+
+    # Set by the view at render time if it accepts binary command messages.
+    binary_commands_accepted = traitlets.Bool(False, sync=True)
+
+    # Deflate compress message JSON at least this long (0 disables compression).
+    compression_threshold = traitlets.Integer(100000, sync=True)
+
+    # Set by the view at render time if it supports compression streams.
+    compression_accepted = traitlets.Bool(False, sync=True)
+
+    # Send repeated subtrees and strings in a message once, referring to them by ["ref", index].
+    share_structure = True
+
+    # Flow control: maximum number of sent batches not yet acknowledged by the view (None disables).
+    flow_control_window = None
+
+    # Flow control: maximum approximate bytes of unacknowledged batches (None for no limit).
+    flow_control_bytes = None
+
+    # What to do with batches sent while the window is full:
+    #   "block": wait for acknowledgements before sending (batches sent by message handlers
+    #       while waiting are held and sent in order after the waiting batch, without waiting),
+    #   "coalesce": hold batches merged into one batch until the window opens,
+    #   "drop_oldest": hold at most flow_control_held batches, dropping the oldest
+    #       (their results callbacks get False, as for a failed batch).
+    flow_control_policy = COALESCE
+    flow_control_held = 1
+
+    # Seconds to wait for the window to open under the "block" policy before raising TimeoutError.
+    flow_control_timeout = 60
+
     def __init__(self, *pargs, **kwargs):
         super(JSProxyWidget, self).__init__(*pargs, **kwargs)
         # top level access for element operations
         self.element = ElementWrapper(self)
         self.counter = 0
+        # stream callbacks for the "result" commands of unacknowledged batches by batch count.
         self.count_to_results_callback = {}
         self.default_event_callback = None
+        # callback registry: the identifier_to_callback setter builds the reverse index
+        # {callback_key(key): set(identifiers)} and the index keys by identifier for forget_callback.
         self.identifier_to_callback = {}
         self.callable_cache = {}
+        # callable_cache keys by identifier, (deadline, identifier) heap of expiring callbacks,
+        # active callback scopes, forgotten identifiers not yet sent to the view.
+        self._callable_keys = {}
+        self._callback_expiry = []
+        self._callback_scopes = []
+        self._forgotten_callbacks = []
+        self._forgotten_count = 0
         #self.callback_to_identifier = {}
         #self.on_trait_change(self.handle_callback_results, "callback_results")
         #self.on_trait_change(self.handle_results, "results")
@@ -201,7 +452,36 @@ class JSProxyWidget(widgets.DOMWidget):
         self.on_trait_change(self.handle_error_msg, "error_msg")
         ##pr "registered on_msg(handle_custom_message)"
         self.on_msg(self.handle_custom_message_wrapper)
+        # JSON fragments of segmented callback messages in progress by stream (view, identifier, counter)
+        self._json_streams = {}
+        # decompressors for compressed segmented messages in progress by JSON stream tag
+        self._compressed_streams = {}
         self.buffered_commands = []
+        # coalescing flush state: timer handle, approximate bytes of buffered commands.
+        self._flush_handle = None
+        self._buffered_bytes = 0
+        # expression mode: the last lazy expression built, not yet sent or used in another expression.
+        self._pending_expression = None
+        # statistics for optimize_commands
+        self.optimizer_stats = dict(batches=0, commands_removed=0, bytes_removed=0)
+        # flow control state: approximate bytes by unacknowledged batch count, held batches.
+        self._in_flight = {}
+        self._held_batches = []
+        self._dropped_batches = 0
+        # set while the "block" policy processes messages waiting for the window to open.
+        self._flow_control_waiting = False
+        # identifier for the next command template.
+        self._template_count = 0
+        # browser page sessions displaying the widget and cached function [argnames, body] by hash.
+        self._frontend_sessions = set()
+        self._function_bodies = {}
+        # reply functions for evaluation requests by request identifier.
+        self._evaluations = {}
+        self._evaluation_count = 0
+        # handle table: identifier for the next handle, JSHandle counts, released handles not yet sent.
+        self._handle_count = 0
+        self._handle_references = {}
+        self._released_handles = []
         #self.commands_awaiting_render = []
         self.last_commands_sent = []
         self.last_callback_results = None
@@ -222,9 +502,11 @@ class JSProxyWidget(widgets.DOMWidget):
 
             // The following is used for sending synchronous values.
             element._SEND_FRAGILE_JS_REFERENCE = function(ms_delay) {
-                // xxxxx add a delay to allow the Python side to be ready for the response (???)
-                ms_delay = ms_delay || 100;
                 var ref = element._FRAGILE_JS_REFERENCE;
+                if (!ms_delay) {
+                    // reply at once (the kernel is polling for the reply).
+                    return RECEIVE_FRAGILE_REFERENCE(ref);
+                }
                 var delayed = function () {
                     RECEIVE_FRAGILE_REFERENCE(ref);
                 };
@@ -354,7 +636,7 @@ class JSProxyWidget(widgets.DOMWidget):
             self.error_msg = repr(e)
             raise
 
-    def send_custom_message(self, indicator, payload):
+    def send_custom_message(self, indicator, payload, buffers=None):
         package = { 
             INDICATOR: indicator,
             PAYLOAD: payload,
@@ -363,12 +645,53 @@ class JSProxyWidget(widgets.DOMWidget):
         if self.verbose:
             print("sending")
             pprint(package)
+            if buffers:
+                print("with buffer sizes", [len(b) for b in buffers])
         #debug_check_commands(package)
-        self.send(package)
+        if self.compression_enabled() and size_at_least(payload, self.compression_threshold):
+            text = json.dumps(payload)
+            if len(text) >= self.compression_threshold:
+                return self.send_compressed_message(indicator, zlib.compress(text.encode("utf-8")), buffers)
+        self.send(package, buffers)
+
+    def compression_enabled(self):
+        return self.compression_accepted and self.compression_threshold > 0
+
+    def send_compressed_message(self, indicator, compressed, buffers=None):
+        """
+        Send a message with the deflate compressed payload JSON as the last message buffer.
+        The view decompresses the payload and handles it as a message with the indicator.
+        """
+        package = {
+            INDICATOR: COMPRESSED,
+            PAYLOAD: indicator,
+        }
+        self.send(package, (buffers or []) + [compressed])
+
+    def send_compressed_segments(self, indicator, fragments, segmented, buffers=None):
+        """
+        Compress the JSON fragments as a stream, sending the compressed bytes in "cz_fragment"
+        messages of segmented bytes and the rest in a final "compressed" message.
+        """
+        compressor = zlib.compressobj()
+        pending = bytearray()
+        for fragment in fragments:
+            pending += compressor.compress(fragment.encode("utf-8"))
+            while len(pending) > segmented:
+                self.send({INDICATOR: COMPRESSED_FRAGMENT, PAYLOAD: None}, [bytes(pending[:segmented])])
+                del pending[:segmented]
+        pending += compressor.flush()
+        while len(pending) > segmented:
+            self.send({INDICATOR: COMPRESSED_FRAGMENT, PAYLOAD: None}, [bytes(pending[:segmented])])
+            del pending[:segmented]
+        package = {
+            INDICATOR: COMPRESSED,
+            PAYLOAD: [indicator, None],
+        }
+        self.send(package, (buffers or []) + [bytes(pending)])
 
     # slot for last message data debugging
     _last_message_data = None
-    _json_accumulator = []
     _last_custom_message_error = None
     _last_accumulated_json = None
     
@@ -407,6 +730,26 @@ class JSProxyWidget(widgets.DOMWidget):
             self._last_message_data = data
             indicator = data[INDICATOR]
             payload = data[PAYLOAD]
+            buffers = etcetera[0] if etcetera else None
+            if indicator == COMPRESSED_FRAGMENT:
+                # compressed bytes of a segmented message: decompress them as they arrive.
+                self.compressed_stream(payload).append(buffers[0])
+                return
+            if indicator == COMPRESSED:
+                # the JSON payload for the indicator is deflate compressed in the last buffer.
+                if type(payload) is list:
+                    # ... following the cz_fragment messages for the stream.
+                    [payload, stream] = payload
+                    decompressed = self.compressed_stream(stream)
+                    del self._compressed_streams[json.dumps(stream)]
+                    decompressed.append(buffers[-1])
+                    text = decompressed.text()
+                else:
+                    text = zlib.decompress(buffers[-1]).decode("utf-8")
+                data = {INDICATOR: payload, PAYLOAD: json.loads(text)}
+                return self.handle_custom_message(widget, data, list(buffers[:-1]))
+            if buffers and indicator in (RESULTS, CALLBACK_RESULTS, EVALUATED, RESULT):
+                payload = decode_buffers(payload, buffers)
             if indicator == RESULTS:
                 self.results = payload
                 self.status = "Got results."
@@ -415,17 +758,47 @@ class JSProxyWidget(widgets.DOMWidget):
                 self.status = "got callback results"
                 self.last_callback_results = payload
                 self.handle_callback_results(payload)
+            elif indicator == EVALUATED:
+                self.status = "got evaluation"
+                self.handle_evaluation(payload)
+            elif indicator == RESULT:
+                self.status = "got command result"
+                self.handle_result(payload)
+            elif indicator == VIEW_RENDERED:
+                # a view displays the widget in the page session: partial segmented
+                # messages from the view before it rendered again will never be completed.
+                [session, view] = payload
+                self._frontend_sessions.add(session)
+                self.drop_view_streams(view)
+            elif indicator == FUNCTIONS_KNOWN:
+                # a page displaying the widget has compiled the functions (or has just rendered).
+                [session, hashes] = payload
+                self._frontend_sessions.add(session)
+                KNOWN_FUNCTIONS.setdefault(session, set()).update(hashes)
+            elif indicator == FUNCTION_MISS:
+                # the page does not have the compiled functions: send the bodies so the
+                # waiting batch can run, and send them with later commands until acknowledged.
+                [session, hashes] = payload
+                self._frontend_sessions.add(session)
+                KNOWN_FUNCTIONS.setdefault(session, set()).difference_update(hashes)
+                bodies = self._function_bodies
+                self.send_custom_message(FUNCTION_BODIES,
+                    [[h, bodies[h][0], self.validate_command(bodies[h][1], top=False)] for h in hashes if h in bodies])
+                self.status = "compiled function cache miss " + repr(hashes)
             elif indicator == JSON_CB_FRAGMENT:
                 self.status = "got callback fragment"
-                self._json_accumulator.append(payload)
+                (stream, fragment) = self.segment_stream(payload)
+                self._json_streams.setdefault(stream, []).append(fragment)
             elif indicator == JSON_CB_FINAL:
                 self.status = "got callback final"
-                acc = self._json_accumulator
-                self._json_accumulator = []
-                acc.append(payload)
-                self._last_accumulated_json = acc
-                accumulated_json_str = u"".join(acc)
-                accumulated_json_ob = json.loads(accumulated_json_str)
+                (stream, fragment) = self.segment_stream(payload)
+                fragments = self._json_streams.pop(stream, [])
+                fragments.append(fragment)
+                self.drop_stale_streams(stream)
+                accumulated_json_ob = json.loads("".join(fragments))
+                if buffers:
+                    accumulated_json_ob = decode_buffers(accumulated_json_ob, buffers)
+                self._last_accumulated_json = accumulated_json_ob
                 self.handle_callback_results(accumulated_json_ob)
             else:
                 self.status = "Unknown indicator from custom message " + repr(indicator)
@@ -436,6 +809,49 @@ class JSProxyWidget(widgets.DOMWidget):
             self.error_msg = repr(e)
             raise
 
+    def compressed_stream(self, stream):
+        "Return the DecompressedStream for a compressed segmented message stream tag."
+        key = json.dumps(stream)
+        result = self._compressed_streams.get(key)
+        if result is None:
+            result = self._compressed_streams[key] = DecompressedStream()
+        return result
+
+    def drop_stale_streams(self, stream):
+        """
+        Forget partial segmented messages of the callback of a completed stream from earlier
+        invocations: the view sends the segments of each message in order, so they are abandoned.
+        """
+        if stream is None:
+            return
+        (view, identifier, counter) = stream
+        streams = self._json_streams
+        for key in [key for key in streams if key is not None and key[:2] == (view, identifier) and key[2] < counter]:
+            del streams[key]
+
+    def drop_view_streams(self, view):
+        "Forget partial segmented callback messages from a view (which has rendered again)."
+        streams = self._json_streams
+        for key in [key for key in streams if key is not None and key[0] == view]:
+            del streams[key]
+        compressed = self._compressed_streams
+        for key in list(compressed):
+            stream = json.loads(key)
+            if type(stream) is list and len(stream) == 3 and stream[0] == view:
+                del compressed[key]
+
+    def segment_stream(self, payload):
+        """
+        Return (stream, fragment) for a segmented callback message payload.
+        Segments are tagged [view, callback_identifier, invocation_counter, fragment] so that
+        several segmented callback messages, from several views, may be reassembled concurrently.
+        """
+        if type(payload) is list:
+            [view, identifier, counter, fragment] = payload
+            return ((view, identifier, counter), fragment)
+        # untagged segment
+        return (None, payload)
+
     def unique_id(self, prefix="jupyter_proxy_widget_id_"):
         IDENTITY_COUNTER[0] += 1
         return prefix + str(IDENTITY_COUNTER[0])
@@ -450,29 +866,133 @@ class JSProxyWidget(widgets.DOMWidget):
         return command
 
     def buffer_commands(self, commands):
+        pending = self._pending_expression
+        if pending is not None:
+            if expression_uses(commands, pending):
+                # the pending expression is sent as part of the commands.
+                self._pending_expression = None
+            else:
+                self.commit_expression()
+        transaction = CallbackTransaction.widgets
+        if transaction is not None and self.auto_flush:
+            # a Python callback is running: send the commands when the callback returns.
+            transaction.setdefault(id(self), self)
+            self.buffered_commands.extend(commands)
+            return commands
+        if self.auto_flush and self.coalesce_flush_ms is not None:
+            self.coalesce_commands(commands)
+            return commands
         self.buffered_commands.extend(commands)
         if self.auto_flush:
             self.flush()
         return commands
 
-    def seg_flush(self, results_callback=None, level=1, segmented=BIG_SEGMENT):
+    def coalesce_commands(self, commands):
+        "Buffer commands and schedule a flush after coalesce_flush_ms, or flush now if the buffer is full."
+        validated = self.validate_commands(list(map(quoteIfNeeded, commands)))
+        # (wrapped so flush does not quote the list format commands as literals.)
+        self.buffered_commands.extend(ValidatedCommand(c) for c in validated)
+        if self.coalesce_flush_bytes is not None:
+            self._buffered_bytes += sum(approximate_size(c) for c in validated)
+            if self._buffered_bytes >= self.coalesce_flush_bytes:
+                return self.flush()
+        if len(self.buffered_commands) >= self.coalesce_flush_commands:
+            return self.flush()
+        if self._flush_handle is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                # no kernel event loop to drive the timer (for example in a script).
+                return self.flush()
+            self._flush_handle = loop.call_later(self.coalesce_flush_ms / 1000.0, self.coalesced_flush)
+
+    def expression_created(self, expression, parts):
+        """
+        Expression mode: record a new lazy expression built from parts (target and arguments).
+        The pending expression is committed as a statement unless the new expression uses it.
+        """
+        pending = self._pending_expression
+        if pending is not None and not expression_uses(parts, pending):
+            self.commit_expression()
+        self._pending_expression = expression
+        PENDING_EXPRESSION_WIDGETS.add(self)
+        register_post_run_cell()
+        transaction = CallbackTransaction.widgets
+        if transaction is not None and self.auto_flush:
+            transaction.setdefault(id(self), self)
+
+    def commit_expression(self):
+        """
+        Expression mode: send the pending expression as a statement.
+        Its value is saved in the fragile reference slot so later uses need not evaluate it again.
+        Expressions which only get properties of the element have no effect and are dropped.
+        """
+        commands = self.expression_statements()
+        if commands:
+            self.buffer_commands(commands)
+
+    def expression_statements(self):
+        "Expression mode: remove the pending expression and return the commands to send for it."
+        expression = self._pending_expression
+        if expression is None:
+            return []
+        self._pending_expression = None
+        if expression._pure():
+            return []
+        # convert now: references to the previously committed value are only valid at this point.
+        command = self.validate_command(SetMaker(self.get_element(), FRAGILE_JS_REFERENCE, expression))
+        self.last_fragile_reference = expression
+        return [ValidatedCommand(command)]
+
+    def coalesced_flush(self):
+        "Timer callback for coalesce_commands."
+        self._flush_handle = None
+        self.flush()
+
+    def cancel_coalesced_flush(self):
+        handle = self._flush_handle
+        if handle is not None:
+            self._flush_handle = None
+            handle.cancel()
+        self._buffered_bytes = 0
+
+    def seg_flush(self, results_callback=None, level=1, segmented=BIG_SEGMENT, stream_callback=None):
         "flush a potentially large command sequence, segmented."
-        return self.flush(results_callback, level, segmented)
+        return self.flush(results_callback, level, segmented, stream_callback)
 
     error_on_flush = False  # Primarily for debugging
 
-    def flush(self, results_callback=None, level=1, segmented=None):
-        "send the buffered commands and clear the buffer. Convenience."
+    def flush(self, results_callback=None, level=1, segmented=None, stream_callback=None):
+        """
+        send the buffered commands and clear the buffer. Convenience.
+        stream_callback(key, value) receives the values of widget.result(key, command) commands
+        in the batch as the view produces them.
+        """
         if not self.rendered:
             #("XXXX not flushing before render", len(self.buffered_commands))
             self.status = "deferring flush until render"
             return None
         if self.error_on_flush:
             raise ValueError("flush is disabled")
-        commands = self.buffered_commands
+        self.cancel_coalesced_flush()
+        # the pending expression goes in this batch (committing it would flush separately).
+        commands = self.buffered_commands + self.expression_statements()
         self.buffered_commands = []
+        released = self._released_handles
+        if released:
+            # after the other commands, which may use the handles.
+            self._released_handles = []
+            commands.append(RequestMaker("handle_release", *released))
+        forgotten = self._forgotten_callbacks
+        if forgotten:
+            self._forgotten_callbacks = []
+            commands.append(RequestMaker("forget_callbacks", *forgotten))
+        if not commands and results_callback is None and stream_callback is None:
+            # nothing to send and nobody waiting for the acknowledgement.
+            return None
         #("XXXXX now flushing", len(commands))
-        result = self.send_commands(commands, results_callback, level, segmented=segmented)
+        result = self.send_commands(commands, results_callback, level, segmented=segmented,
+            stream_callback=stream_callback)
         self._send_counter += 1
         return result
 
@@ -490,6 +1010,36 @@ class JSProxyWidget(widgets.DOMWidget):
         # return the reference by name
         return getattr(self.element, name)
 
+    def handle(self, command):
+        """
+        Store the value of the command in the handle table of the view and return a JSHandle
+        proxy for it.  Using the handle in later commands reads the stored value
+        instead of evaluating the command again.  When the JSHandle is garbage collected
+        the view is told to release the value with the next flush.
+        Handles for the same value share a table entry, released when the last is collected.
+        """
+        if isinstance(command, JSHandle) and command.for_widget is self:
+            identifier = command.identifier
+        else:
+            identifier = self._handle_count
+            self._handle_count = identifier + 1
+            if isinstance(command, LazyCommandSuperClass):
+                command = command.reference()
+            self.buffer_command(RequestMaker("handle_set", identifier, self.wrap_callables(command)))
+        references = self._handle_references
+        references[identifier] = references.get(identifier, 0) + 1
+        return JSHandle(self, identifier)
+
+    def release_handle(self, identifier):
+        "Release a handle table entry with the next flush when its last JSHandle is collected."
+        references = self._handle_references
+        count = references.get(identifier, 0) - 1
+        if count > 0:
+            references[identifier] = count
+        else:
+            references.pop(identifier, None)
+            self._released_handles.append(identifier)
+
     _jqueryUI_checked = False
 
     def check_jquery(self, onsuccess=None, force=False,
@@ -650,9 +1200,21 @@ class JSProxyWidget(widgets.DOMWidget):
         return self.save_new(name, klass, list(arguments) + [body])
 
     def function(self, arguments, body):
+        if self.function_cache:
+            return FunctionMaker(self, arguments, body)
         klass = self.window().Function
         return self.get_element().New(klass, list(arguments) + [body])
 
+    def function_known(self, digest):
+        "Test whether every frontend page displaying the widget has acknowledged compiling the function hash."
+        sessions = self._frontend_sessions
+        if not sessions or not self.rendered:
+            return False
+        for session in sessions:
+            if digest not in KNOWN_FUNCTIONS.get(session, ()):
+                return False
+        return True
+
     handle_results_exception = None
 
     def handle_results(self, new):
@@ -660,17 +1222,42 @@ class JSProxyWidget(widgets.DOMWidget):
         if self.verbose:
             print ("got results", new)
         [identifier, json_value] = new
+        # the batch is complete: no more results will be streamed for it.
+        self.count_to_results_callback.pop(identifier, None)
         i2c = self.identifier_to_callback
         results_callback = i2c.get(identifier)
-        if results_callback is not None:
-            del i2c[identifier]
-            try:
-                results_callback(json_value)
-            except Exception as e:
-                #pr ("handle results exception " + repr(e))
-                self.handle_results_exception = e
-                self.error_msg = "Handle results: " + repr(e)
-                raise
+        try:
+            if results_callback is not None:
+                del i2c[identifier]
+                try:
+                    results_callback(json_value)
+                except Exception as e:
+                    #pr ("handle results exception " + repr(e))
+                    self.handle_results_exception = e
+                    self.error_msg = "Handle results: " + repr(e)
+                    raise
+        finally:
+            if self.flow_control_window is not None:
+                self.acknowledge(identifier)
+
+    def handle_result(self, payload):
+        "Pass the [count, key, value] value of a result command to the stream callback of batch count."
+        [count, key, value] = payload
+        stream_callback = self.count_to_results_callback.get(count)
+        if stream_callback is not None:
+            stream_callback(key, value)
+
+    def result(self, key, command, level=1):
+        """
+        Return a command which evaluates to the value of command and also sends the value,
+        converted to the given depth level, to the stream callback of the batch as
+            stream_callback(key, value)
+        for example
+            widget(widget.result("width", widget.element.width()))
+            widget.flush(stream_callback=lambda key, value: print(key, value))
+        Other commands in the batch send nothing.
+        """
+        return RequestMaker("result", key, level, command)
 
     handle_callback_results_exception = None
     last_callback_results = None
@@ -683,34 +1270,37 @@ class JSProxyWidget(widgets.DOMWidget):
         if self.verbose:
             print ("got callback results", new)
         [identifier, json_value, arguments, counter] = new
+        if self._callback_expiry:
+            self.expire_callbacks()
         i2c = self.identifier_to_callback
         results_callback = i2c.get(identifier)
         self.status = "call back to " + repr(results_callback)
         if results_callback is not None:
             try:
-                results_callback(json_value, arguments)
+                with CallbackTransaction():
+                    results_callback(json_value, arguments)
             except Exception as e:
                 #pr ("handle results callback exception " +repr(e))
                 self.handle_callback_results_exception = e
                 self.error_msg = "Handle callback results: " + repr(e)
                 raise
 
-    def send_command(self, command, results_callback=None, level=1):
+    def send_command(self, command, results_callback=None, level=1, stream_callback=None):
         "Send a single command to the JS View."
-        return self.send_commands([command], results_callback, level)
+        return self.send_commands([command], results_callback, level, stream_callback=stream_callback)
 
-    def send_commands(self, commands_iter, results_callback=None, level=1, segmented=None, check=False):
+    def send_commands(self, commands_iter, results_callback=None, level=1, segmented=None, check=False,
+            stream_callback=None):
         """Send several commands fo the JS View.
         If segmented is a positive integer then the commands payload will be pre-encoded
-        as a json string and sent in segments of that length
+        as a json string and sent in segments of that length.
+        stream_callback(key, value) receives the values of result commands (see result).
         """
         count = self.counter
         self.counter = count + 1
         commands_iter = list(commands_iter)
         qcommands = list(map(quoteIfNeeded, commands_iter))
         commands = self.validate_commands(qcommands)
-        if check:
-            debug_check_commands(commands)
         if self.rendered:
             # also send buffered commands
             #if self.commands_awaiting_render:
@@ -719,17 +1309,17 @@ class JSProxyWidget(widgets.DOMWidget):
             if self.buffered_commands:
                 commands = self.buffered_commands + commands
                 self.buffered_commands = []
-            payload = [count, commands, level]
-            if results_callback is not None:
-                self.identifier_to_callback[count] = results_callback
-            # send the command using the commands traitlet which is mirrored to javascript.
-            #self.commands = payload
-            if segmented and segmented > 0:
-                self.send_segmented_message(COMMANDS_FRAGMENT, COMMANDS_FINAL, payload, segmented)
-            else:
-                self.send_custom_message(COMMANDS, payload)
-            self.last_commands_sent = payload
-            return payload
+            if self.flow_control_window is not None:
+                if self.flow_control_policy == BLOCK:
+                    if self._held_batches or self.flow_control_full():
+                        result = self.hold_commands(commands, results_callback, level, segmented, stream_callback)
+                        if not self._flow_control_waiting:
+                            self.wait_for_flow_control(self._held_batches[-1])
+                        return result
+                elif self._held_batches or self.flow_control_full():
+                    return self.hold_commands(commands, results_callback, level, segmented, stream_callback)
+            return self.transmit_commands(count, commands, results_callback, level, segmented, check,
+                stream_callback)
         else:
             # wait for render event before sending commands.
             ##pr "waiting for render!", commands
@@ -737,27 +1327,219 @@ class JSProxyWidget(widgets.DOMWidget):
             self.buffered_commands.extend(commands)
             return ("awaiting render", commands)
 
-    def send_segmented_message(self, frag_ind, final_ind, payload, segmented):
-        "Send a message in fragments."
-        json_str = json.dumps(payload)
-        len_json = len(json_str)
-        cursor = 0
-        # don't reallocate large string tails...
-        while len_json - cursor > segmented:
-            next_cursor = cursor + segmented
-            json_fragment = json_str[cursor: next_cursor]
-            # send the fragment
+    def transmit_commands(self, count, commands, results_callback=None, level=1, segmented=None, check=False,
+            stream_callback=None):
+        "Send validated commands to the view as batch number count."
+        if self.optimize_commands:
+            commands = self.optimize_batch(commands)
+        (encoded, buffers) = self.encode_binary(commands)
+        if check:
+            debug_check_commands(encoded)
+        payload = [count, encoded, level]
+        if self.share_structure:
+            (shared, table) = shared_commands.share_commands(encoded)
+            if table:
+                payload = [count, shared, level, table]
+        if results_callback is not None:
+            self.identifier_to_callback[count] = results_callback
+        if stream_callback is not None:
+            self.count_to_results_callback[count] = stream_callback
+        # send the command using the commands traitlet which is mirrored to javascript.
+        #self.commands = payload
+        if segmented and segmented > 0:
+            self.send_segmented_message(COMMANDS_FRAGMENT, COMMANDS_FINAL, payload, segmented, buffers)
+        elif self.binary_commands and self.binary_commands_accepted:
+            # the encoded payload is sent as the last message buffer.
+            encoded_payload = binary_commands.encode_commands(payload)
+            self.send_custom_message(BINARY_COMMANDS, count, (buffers or []) + [encoded_payload])
+        else:
+            self.send_custom_message(COMMANDS, payload, buffers)
+        self.last_commands_sent = payload
+        if self.flow_control_window is not None:
+            size = 0
+            if self.flow_control_bytes is not None:
+                size = len(json.dumps(payload)) + sum(memoryview(b).nbytes for b in (buffers or []))
+            self._in_flight[count] = size
+        return payload
+
+    def optimize_batch(self, commands):
+        "Apply the peephole optimizer to validated commands, updating optimizer_stats."
+        (optimized, changes) = command_optimizer.optimize_commands(
+            commands, FRAGILE_SLOTS, {SEND_FRAGILE_JS_REFERENCE: FRAGILE_JS_REFERENCE})
+        if changes:
+            stats = self.optimizer_stats
+            stats["batches"] += 1
+            stats["commands_removed"] += len(commands) - len(optimized)
+            for (original, replacement) in changes:
+                stats["bytes_removed"] += approximate_size(original) - (approximate_size(replacement) if replacement else 0)
+        return optimized
+
+    def flow_control_full(self):
+        "Test whether the flow control window of unacknowledged batches is full."
+        in_flight = self._in_flight
+        if len(in_flight) >= self.flow_control_window:
+            return True
+        limit = self.flow_control_bytes
+        return in_flight and limit is not None and sum(in_flight.values()) >= limit
+
+    def hold_commands(self, commands, results_callback, level, segmented, stream_callback=None):
+        "Hold validated commands until the flow control window opens, according to the policy."
+        callbacks = [results_callback] if results_callback is not None else []
+        # stream callbacks with the keys of the result commands they receive.
+        stream_callbacks = [(result_keys(commands), stream_callback)] if stream_callback is not None else []
+        held = self._held_batches
+        policy = self.flow_control_policy
+        if policy == COALESCE and held:
+            [held_commands, held_callbacks, held_level, held_segmented, held_streams] = held[-1]
+            held_commands.extend(commands)
+            held_callbacks.extend(callbacks)
+            held_streams.extend(stream_callbacks)
+            held[-1] = [held_commands, held_callbacks, max(level, held_level), held_segmented or segmented,
+                held_streams]
+        else:
+            assert policy in FLOW_CONTROL_POLICIES, "bad flow control policy " + repr(policy)
+            held.append([list(commands), callbacks, level, segmented, stream_callbacks])
+            if policy == DROP_OLDEST:
+                dropped_callbacks = []
+                while len(held) > max(1, self.flow_control_held):
+                    [old_commands, old_callbacks, old_level, old_segmented, old_streams] = held.pop(0)
+                    if any(type(c) is list and c and c[0] in KEPT_ON_DROP for c in old_commands):
+                        [next_commands, next_callbacks, next_level, next_segmented, next_streams] = held[0]
+                        held[0] = [old_commands + next_commands, old_callbacks + next_callbacks,
+                            max(old_level, next_level), old_segmented or next_segmented, old_streams + next_streams]
+                    else:
+                        self._dropped_batches += 1
+                        dropped_callbacks.extend(old_callbacks)
+                # the dropped batches will never be acknowledged: report them as failed.
+                for callback in dropped_callbacks:
+                    callback(False)
+        return ("held", commands)
+
+    def release_held(self):
+        "Send held batches while the flow control window is open."
+        held = self._held_batches
+        while held and not self.flow_control_full():
+            [commands, callbacks, level, segmented, stream_callbacks] = held.pop(0)
+            count = self.counter
+            self.counter = count + 1
+            results_callback = None
+            if len(callbacks) == 1:
+                results_callback = callbacks[0]
+            elif callbacks:
+                def results_callback(json_value, callbacks=callbacks):
+                    for callback in callbacks:
+                        callback(json_value)
+            stream_callback = None
+            if len(stream_callbacks) == 1:
+                stream_callback = stream_callbacks[0][1]
+            elif stream_callbacks:
+                # route each result of the merged batch to the callbacks of the batches with its key.
+                routes = {}
+                for (keys, callback) in stream_callbacks:
+                    for key in keys:
+                        routes.setdefault(key, []).append(callback)
+                def stream_callback(key, value, routes=routes):
+                    for callback in routes.get(key, ()):
+                        callback(key, value)
+            self.transmit_commands(count, commands, results_callback, level, segmented,
+                stream_callback=stream_callback)
+
+    def acknowledge(self, identifier):
+        "The view has finished executing batch number identifier: open the flow control window."
+        if self._in_flight.pop(identifier, None) is not None or self._held_batches:
+            self.release_held()
+
+    def wait_for_flow_control(self, batch):
+        """
+        Process UI events until the held batch is sent, for the block policy.
+        Message handlers run while waiting: batches they send are held, not waited for (no nested polling).
+        """
+        held = self._held_batches
+        deadline = time.time() + self.flow_control_timeout
+        def sent():
+            if not any(b is batch for b in held) or time.time() > deadline:
+                return True
+            return None  # only None continues polling.
+        self._flow_control_waiting = True
+        try:
+            run_ui_poll_loop(sent)
+        finally:
+            self._flow_control_waiting = False
+        if any(b is batch for b in held):
+            # give up on the batch.
+            held[:] = [b for b in held if b is not batch]
+            raise TimeoutError("flow control window still full after %s seconds" % self.flow_control_timeout)
+
+    def visible(self):
+        "Test whether any view of the widget is on screen (True if the views do not report visibility)."
+        visibility = self.visibility
+        if not visibility:
+            return True
+        return any(visibility.values())
+
+    def backlog(self):
+        "Return a summary of batches not yet acknowledged or held back by flow control."
+        held = self._held_batches
+        return dict(
+            in_flight=len(self._in_flight),
+            in_flight_bytes=sum(self._in_flight.values()),
+            held=len(held),
+            held_commands=sum(len(batch[0]) for batch in held),
+            dropped=self._dropped_batches,
+        )
+
+    def reset_flow_control(self):
+        "Forget unacknowledged batches (for example if the view was closed) and send held batches."
+        self._in_flight.clear()
+        self.release_held()
+
+    def encode_binary(self, commands):
+        """
+        Prepare binary values in validated commands for transmission.
+        Return (encoded_commands, buffers) where buffers is the list of message buffers
+        referenced by the encoded commands (empty if binary_buffers is disabled).
+        """
+        if self.binary_buffers:
+            buffers = []
+            encoded = [encode_binary(c, buffers, self.utf8_buffer_threshold) for c in commands]
+        else:
+            buffers = None
+            encoded = [encode_binary(c, None) for c in commands]
+        return (encoded, buffers)
+
+    def send_segmented_message(self, frag_ind, final_ind, payload, segmented, buffers=None):
+        """
+        Send a message in fragments.  Message buffers, if any, are sent with the final fragment.
+        The JSON encoding of the payload is generated incrementally and is never held in memory all at once.
+        """
+        fragments = json_stream.iter_json(payload, segmented)
+        indicator = UNSEGMENTED_INDICATORS.get(final_ind)
+        if indicator is not None and self.compression_enabled():
+            # Compress the payload instead of sending JSON segments if it is large enough.
+            # Uncompressed fragments are kept only until the size reaches the threshold.
+            held = []
+            length = 0
+            for fragment in fragments:
+                held.append(fragment)
+                length += len(fragment)
+                if length >= self.compression_threshold:
+                    return self.send_compressed_segments(
+                        indicator, itertools.chain(held, fragments), segmented, buffers)
+            fragments = held
+        segments = json_stream.iter_segments(fragments, segmented)
+        # look ahead one segment to identify the final segment.
+        json_fragment = next(segments)
+        for next_fragment in segments:
             self.send_custom_message(frag_ind, json_fragment)
-            cursor = next_cursor
-        json_tail = json_str[cursor:]
-        self.send_custom_message(final_ind, json_tail)
+            json_fragment = next_fragment
+        self.send_custom_message(final_ind, json_fragment, buffers)
 
     _synced_command_result = None
     _synced_command_evaluated = False
     _synced_command_timed_out = False
     _synced_command_timeout_time = None
 
-    def evaluate(self, command, level=3, timeout=3000, ms_delay=100):
+    def evaluate(self, command, level=3, timeout=3000, ms_delay=0):
         "Evaluate the command and return the converted javascript value."
         # temporarily disable error prints
         print_on_error = self.print_on_error
@@ -792,7 +1574,93 @@ class JSProxyWidget(widgets.DOMWidget):
             self.error_msg = old_err
             self.print_on_error = print_on_error
 
-    def _send_synced_command(self, command, level, ms_delay=100):
+    async def evaluate_async(self, command, level=3, timeout=None):
+        """
+        Evaluate the command in the view and return the converted javascript value.
+        Each evaluation is a separate request, so many may be in flight at once, for example
+            (w, h) = await asyncio.gather(widget.evaluate_async(e.width()), widget.evaluate_async(e.height()))
+        Raise JavascriptException if the evaluation fails or asyncio.TimeoutError after timeout seconds.
+        """
+        return await self.request_async("evaluate", command, level, timeout)
+
+    async def evaluate_many_async(self, expressions, level=3, timeout=None):
+        "Awaitable version of evaluate_many."
+        replies = await self.request_async("evaluate_many", LiteralMaker(dict(expressions)), level, timeout)
+        return evaluated_values(replies)
+
+    def evaluate_many(self, expressions, level=3, timeout=60):
+        """
+        Evaluate a dictionary of commands {name: command} in one round trip and return
+        {name: value}.  If evaluating a command fails its value is a JavascriptException
+        and the other commands are not affected.  Raise TimeoutError after timeout seconds.
+        """
+        replies = []
+        def reply(ok, value):
+            replies.append(value)
+        identifier = self.request_evaluation("evaluate_many", LiteralMaker(dict(expressions)), level, reply)
+        deadline = time.time() + timeout
+        def replied():
+            if replies or time.time() > deadline:
+                return True
+            return None  # only None continues polling.
+        try:
+            run_ui_poll_loop(replied)
+        finally:
+            self._evaluations.pop(identifier, None)
+        if not replies:
+            raise TimeoutError("no reply after %s seconds" % timeout)
+        return evaluated_values(replies[0])
+
+    def sync_values(self, target, paths, level=3, timeout=60):
+        """
+        Return {path: value} for property paths of the target like "scrollTop" or "style.width"
+        in one round trip (see evaluate_many).  The target is evaluated once for each path.
+        """
+        expressions = {}
+        for path in paths:
+            command = target
+            for name in path.split("."):
+                command = MethodMaker(command, name)
+            expressions[path] = command
+        return self.evaluate_many(expressions, level=level, timeout=timeout)
+
+    def request_evaluation(self, indicator, command, level, reply):
+        """
+        Send a request [indicator, identifier, level, command] and return the identifier.
+        The view's reply calls reply(ok, value).
+        """
+        identifier = self._evaluation_count
+        self._evaluation_count = identifier + 1
+        self._evaluations[identifier] = reply
+        self.buffer_command(RequestMaker(indicator, identifier, level, command))
+        self.flush()
+        return identifier
+
+    async def request_async(self, indicator, command, level, timeout):
+        "Send a request and await the value of the reply."
+        future = asyncio.get_running_loop().create_future()
+        def reply(ok, value):
+            if future.done():
+                # the request timed out or was cancelled.
+                return
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(JavascriptException("evaluation error: " + repr(value)))
+        identifier = self.request_evaluation(indicator, command, level, reply)
+        try:
+            return await wait_for_future(future, timeout)
+        finally:
+            self._evaluations.pop(identifier, None)
+
+    def handle_evaluation(self, payload):
+        "Pass an [identifier, ok, value] reply to the request waiting for it."
+        [identifier, ok, value] = payload
+        reply = self._evaluations.pop(identifier, None)
+        if reply is not None:
+            reply(ok, value)
+
+    def _send_synced_command(self, command, level, ms_delay=0):
         if self.last_fragile_reference is not command:
             set_ref = SetMaker(self.get_element(), FRAGILE_JS_REFERENCE, command)
             self.buffer_command(set_ref)
@@ -847,23 +1715,26 @@ class JSProxyWidget(widgets.DOMWidget):
         """
         return self.callback(callback_function, data, level, delay, segmented)
 
-    def callable(self, function_or_method, level=1, delay=False, segmented=None):
+    def callable(self, function_or_method, level=1, delay=False, segmented=None, lifetime=None):
         """
         Simplified callback protocol.
         Map function_or_method to a javascript function js_function
         Calls to js_function(x, y, z)
         will trigger calls to function_or_method(x, y, z)
         where x, y, z are json compatible values.
+        See callback for the lifetime.
         """
         # do not double wrap CallMakers
         if isinstance(function_or_method, CallMaker):
             return function_or_method
         # get existing wrapper value from cache, if available
         cache = self.callable_cache
-        result = cache.get(function_or_method)
-        if result is not None:
-            return result
+        if lifetime is None:
+            result = cache.get(function_or_method)
+            if result is not None:
+                return result
         data = repr(function_or_method)
+        call = weak_function(function_or_method) if lifetime == WEAK else function_or_method
         def callback_function(_data, arguments):
             count = 0
             # construct the Python argument list from argument mapping
@@ -876,13 +1747,22 @@ class JSProxyWidget(widgets.DOMWidget):
                     count += 1
                 else:
                     break
-            function_or_method(*py_arguments)
-        result = self.callback(callback_function, data, level, delay, segmented)
-        cache[function_or_method] = result
+            with CallbackTransaction():
+                call(*py_arguments)
+        result = self.callback(callback_function, data, level, delay, segmented, lifetime, key=function_or_method)
+        if lifetime is None:
+            # the cache entry is removed if the callback is forgotten (for example by a scope).
+            cache[function_or_method] = result
+            self._callable_keys[result.args[0]] = function_or_method
         return result
 
-    def callback(self, callback_function, data, level=1, delay=False, segmented=None):
-        "Create a 'proxy callback' to receive events detected by the JS View."
+    def callback(self, callback_function, data, level=1, delay=False, segmented=None, lifetime=None, key=None):
+        """
+        Create a 'proxy callback' to receive events detected by the JS View.
+        The callback is registered until forgotten (see forget_callback and callback_scope)
+        or, if lifetime is "weak", until the key (default callback_function) is garbage collected,
+        or, if lifetime is a number, for that many seconds.
+        """
         assert level > 0, "level must be positive " + repr(level)
         assert level <= 5, "level cannot exceed 5 " + repr(level)
         assert segmented is None or (type(segmented) is int and segmented > 0), "bad segment " + repr(segmented)
@@ -893,15 +1773,112 @@ class JSProxyWidget(widgets.DOMWidget):
         command = CallMaker("callback", count, data, level, segmented)
         #if delay:
         #    callback_function = delay_in_thread(callback_function)
-        self.identifier_to_callback[count] = callback_function
+        if key is None:
+            key = callback_function
+            if lifetime == WEAK:
+                callback_function = weak_function(callback_function)
+        self.register_callback(count, callback_function, key, lifetime)
         return command
 
+    def register_callback(self, identifier, callback_function, key, lifetime=None):
+        "Add a callback to the registry, indexed by key for forget_callback."
+        if self._callback_expiry:
+            self.expire_callbacks()
+        self._identifier_to_callback[identifier] = callback_function
+        index_key = callback_key(key, weak=(lifetime == WEAK))
+        self._callback_identifiers.setdefault(index_key, set()).add(identifier)
+        self._callback_keys[identifier] = index_key
+        if lifetime == WEAK:
+            # bound methods are created for each use: follow the lifetime of their object.
+            referent = key.__self__ if inspect.ismethod(key) else key
+            weakref.finalize(referent, forget_weak_callback, weakref.ref(self), identifier)
+        elif lifetime is not None:
+            heapq.heappush(self._callback_expiry, (time.time() + lifetime, identifier))
+        if self._callback_scopes:
+            self._callback_scopes[-1].identifiers.append(identifier)
+
+    @property
+    def identifier_to_callback(self):
+        "Registered callbacks by identifier."
+        return self._identifier_to_callback
+
+    @identifier_to_callback.setter
+    def identifier_to_callback(self, mapping):
+        self._identifier_to_callback = mapping
+        index = self._callback_identifiers = {}
+        keys = self._callback_keys = {}
+        for (identifier, callback_function) in mapping.items():
+            index_key = callback_key(callback_function)
+            index.setdefault(index_key, set()).add(identifier)
+            keys[identifier] = index_key
+
     def forget_callback(self, callback_function):
-        "Remove all uses of callback_function in proxy callbacks (Python side only)."
-        i2c = self.identifier_to_callback
-        deletes = [i for i in i2c if i2c[i] == callback_function]
-        for i in deletes:
-            del i2c[i]
+        "Remove all uses of callback_function (or a function wrapped by callable) in proxy callbacks."
+        index = self._callback_identifiers
+        identifiers = set(index.get(callback_key(callback_function), ()))
+        if not inspect.ismethod(callback_function):
+            # weak callbacks are indexed by id while the function is alive.
+            identifiers.update(index.get(callback_key(callback_function, weak=True), ()))
+        if identifiers:
+            self.forget_callback_identifiers(list(identifiers))
+
+    def forget_callback_identifiers(self, identifiers):
+        "Remove callbacks by identifier.  The view is told to drop them with the next flush."
+        i2c = self._identifier_to_callback
+        index = self._callback_identifiers
+        for identifier in identifiers:
+            if i2c.pop(identifier, None) is None:
+                continue
+            index_key = self._callback_keys.pop(identifier, None)
+            indexed = index.get(index_key)
+            if indexed is not None:
+                indexed.discard(identifier)
+                if not indexed:
+                    del index[index_key]
+            cached = self._callable_keys.pop(identifier, None)
+            if cached is not None:
+                self.callable_cache.pop(cached, None)
+            self._forgotten_callbacks.append(identifier)
+            self._forgotten_count += 1
+
+    def expire_callbacks(self):
+        "Forget callbacks whose lifetime has passed."
+        expiry = self._callback_expiry
+        now = time.time()
+        expired = []
+        while expiry and expiry[0][0] <= now:
+            expired.append(heapq.heappop(expiry)[1])
+        self.forget_callback_identifiers(expired)
+
+    def callback_scope(self):
+        """
+        Return a context manager which forgets the callbacks created inside it when it exits:
+            with widget.callback_scope():
+                widget.element.on("click", handle_click)
+        """
+        return CallbackScope(self)
+
+    def callback_stats(self):
+        """
+        Return callback registry counts and the approximate size in bytes of the registry
+        (the containers and registered functions, not the values the functions refer to).
+        """
+        i2c = self._identifier_to_callback
+        index = self._callback_identifiers
+        containers = [i2c, index, self._callback_keys, self.callable_cache, self._callable_keys,
+            self._callback_expiry, self._forgotten_callbacks]
+        size = sum(sys.getsizeof(c) for c in containers)
+        size += sum(sys.getsizeof(identifiers) for identifiers in index.values())
+        size += sum(sys.getsizeof(f) for f in i2c.values())
+        return dict(
+            callbacks=len(i2c),
+            callables=len(self.callable_cache),
+            expiring=len(self._callback_expiry),
+            scopes=len(self._callback_scopes),
+            forgotten=self._forgotten_count,
+            unsent_forgotten=len(self._forgotten_callbacks),
+            registry_bytes=size,
+        )
 
     def js_debug(self, *arguments):
         """
@@ -914,7 +1891,7 @@ class JSProxyWidget(widgets.DOMWidget):
     def print_status(self):
         status_slots = """
             results
-            auto_flush _last_message_data _json_accumulator _last_custom_message_error
+            auto_flush _last_message_data _json_streams _last_custom_message_error _in_flight
             _last_accumulated_json _jqueryUI_checked _require_checked
             handle_results_exception last_callback_results
             """
@@ -931,6 +1908,28 @@ class JSProxyWidget(widgets.DOMWidget):
         "Return a proxy reference to the browser window top level name space."
         return CommandMaker("window")
 
+    def template(self, builder, holes=None):
+        """
+        Register a command batch with numbered holes in the view and return a CommandTemplate.
+        builder(element, hole0, hole1, ...) is called with proxies for the element and the holes
+        and returns a command or a list of commands, for example
+
+            move = widget.template(lambda element, x, y: element.attr("x", x).attr("y", y))
+            move(10, 20)
+
+        Calling the template sends only its identifier and the parameter values.
+        """
+        if holes is None:
+            holes = len(inspect.signature(builder).parameters) - 1
+        parameters = [HoleMaker(i) for i in range(holes)]
+        commands = builder(self.get_element(), *parameters)
+        if not isinstance(commands, (list, tuple)) or (commands and type(commands[0]) is str):
+            commands = [commands]
+        identifier = self._template_count
+        self._template_count = identifier + 1
+        self(RequestMaker("template_define", identifier, LiteralMaker(list(commands))))
+        return CommandTemplate(self, identifier, holes)
+
     def load_js_files(self, filenames, force=True, local=True):
         for filepath in filenames:
             def load_the_file(filepath=filepath):
@@ -988,8 +1987,40 @@ class JSProxyWidget(widgets.DOMWidget):
                 target = self.validate_command(target, top=True)
                 args = self.validate_commands(args, top=False)
                 remainder = [target] + args
-            elif indicator == "id" or indicator == "bytes":
-                assert len(remainder) == 1, "id or bytes takes one argument only " + repr(remainder)
+            elif indicator == "ndarray":
+                [dtype, shape, data] = remainder
+                assert type(dtype) is str, "dtype must be a string " + repr(dtype)
+                remainder = [dtype, shape, self.validate_command(data, top=False)]
+            elif indicator == "cached_function":
+                assert len(remainder) in (1, 3), "cached_function takes 1 or 3 arguments " + repr(len(remainder))
+                if len(remainder) == 3:
+                    [digest, argnames, body] = remainder
+                    remainder = [digest, argnames, self.validate_command(body, top=False)]
+            elif indicator == "hole":
+                [index] = remainder
+                assert type(index) is int and index >= 0, "hole index must be a non-negative integer " + repr(index)
+            elif indicator == "evaluate" or indicator == "evaluate_many":
+                [identifier, level, target] = remainder
+                assert type(identifier) is int, "request identifier must be an integer " + repr(identifier)
+                assert type(level) is int, "must be integer " + repr(level)
+                remainder = [identifier, level, self.validate_command(target, top=False)]
+            elif indicator in ("handle", "handle_release", "forget_callbacks"):
+                assert remainder and all(type(x) is int for x in remainder), "handles must be integers " + repr(remainder)
+            elif indicator == "handle_set":
+                [identifier, target] = remainder
+                assert type(identifier) is int, "handle must be an integer " + repr(identifier)
+                remainder = [identifier, self.validate_command(target, top=False)]
+            elif indicator == "result":
+                [key, level, target] = remainder
+                assert type(key) in (str, int), "result key must be a string or integer " + repr(key)
+                assert type(level) is int, "must be integer " + repr(level)
+                remainder = [key, level, self.validate_command(target, top=False)]
+            elif indicator == "template_define" or indicator == "template_call":
+                [identifier, data] = remainder
+                assert type(identifier) is int, "template identifier must be an integer " + repr(identifier)
+                remainder = [identifier, self.validate_command(data, top=False)]
+            elif indicator == "id" or indicator == "bytes" or indicator == "text":
+                assert len(remainder) == 1, "id, bytes or text takes one argument only " + repr(remainder)
             elif indicator in LOAD_INDICATORS:
                 assert len(remainder) == 2, "loaders take exactly 2 arguments" + repr(len(remainder))
             elif indicator == "list":
@@ -1040,6 +2071,78 @@ class JSProxyWidget(widgets.DOMWidget):
         """
         return DisableFlushContextManager(self)
 
+def size_at_least(value, size):
+    """
+    Test whether the JSON encoding of value is at least about size characters long,
+    without encoding it (the walk stops when the size is reached).
+    """
+    stack = [value]
+    total = 0
+    while stack:
+        item = stack.pop()
+        ty = type(item)
+        if ty is str:
+            total += len(item) + 2
+        elif ty is list or ty is tuple:
+            total += len(item) + 1
+            stack.extend(item)
+        elif ty is dict:
+            for (key, member) in item.items():
+                total += len(str(key)) + 4
+                stack.append(member)
+        else:
+            total += 4
+        if total >= size:
+            return True
+    return False
+
+class DecompressedStream(object):
+    "Decompress the deflate compressed segments of a message as they arrive."
+
+    def __init__(self):
+        self.decompressor = zlib.decompressobj()
+        self.parts = []
+
+    def append(self, compressed):
+        self.parts.append(self.decompressor.decompress(compressed))
+
+    def text(self):
+        self.parts.append(self.decompressor.flush())
+        return b"".join(self.parts).decode("utf-8")
+
+def result_keys(commands):
+    "Return the set of keys of the result commands in validated commands."
+    keys = set()
+    stack = list(commands)
+    while stack:
+        command = stack.pop()
+        if type(command) is not list or not command:
+            continue
+        indicator = command[0]
+        if indicator == "result":
+            keys.add(command[1])
+            stack.append(command[3])
+        elif indicator == "dict":
+            stack.extend(command[1].values())
+        elif indicator not in ("id", "callback", "bytes", "text", "ndarray"):
+            stack.extend(command[1:])
+    return keys
+
+def approximate_size(command):
+    "Approximate size in bytes of a validated command when sent (for flush budgets)."
+    ty = type(command)
+    if ty is list:
+        return sum(approximate_size(c) for c in command) + 2
+    if ty is str:
+        return len(command) + 2
+    if ty is dict:
+        return sum(len(str(k)) + approximate_size(v) + 4 for (k, v) in command.items())
+    if isinstance(command, np.ndarray):
+        return command.nbytes
+    if isinstance(command, (bytes, bytearray, memoryview)):
+        return memoryview(command).nbytes
+    return 8
+
 def indent_string(s, level, indent="    "):
     lindent = indent * level
     return s.replace("\n", "\n" + lindent)
@@ -1061,6 +2164,14 @@ def to_javascript(thing, level=0, indent=None, comma=","):
             inner = list(map(int, thing))
             # Note: no line breaks for binary data.
             json_value = "Uint8Array(%s)" % inner
+        elif ty is np.ndarray and thing.dtype.str[1:] in TYPED_ARRAY_NAMES:
+            thing = narrow_int64(thing)
+            array_name = TYPED_ARRAY_NAMES[thing.dtype.str[1:]]
+            # Note: no line breaks for binary data.
+            json_value = "%s.from(%s)" % (array_name, thing.ravel().tolist())
+        elif ty is BigIntArray:
+            array_name = BIGINT_ARRAY_NAMES[thing.array.dtype.str[1:]]
+            json_value = "%s.from(%s, BigInt)" % (array_name, thing.array.ravel().tolist())
         elif json_value is None:
             json_value = json.dumps(thing, indent=indent)
         result = indent_string(json_value, level)
@@ -1092,6 +2203,90 @@ class DisableFlushContextManager(object):
             canvas.flush()
 
 
+class CallbackTransaction(object):
+    """
+    Collect the commands buffered on any widget while a Python callback runs and send
+    them as one batch per widget when the outermost transaction ends.
+    Widgets with auto_flush disabled are not affected.
+    """
+
+    # Widgets with commands buffered in the active transaction by id (in order), or None.
+    widgets = None
+
+    def __enter__(self):
+        self.outermost = CallbackTransaction.widgets is None
+        if self.outermost:
+            CallbackTransaction.widgets = {}
+
+    def __exit__(self, type, value, traceback):
+        if self.outermost:
+            widgets = CallbackTransaction.widgets
+            CallbackTransaction.widgets = None
+            # flush every widget even if one fails, then report the first failure.
+            error = None
+            for widget in widgets.values():
+                try:
+                    if widget.auto_flush:
+                        widget.flush()
+                except Exception as e:
+                    if error is None:
+                        error = e
+            if error is not None:
+                raise error
+
+
+class CallbackScope(object):
+    "Forget the callbacks a widget creates inside the scope when it exits (see JSProxyWidget.callback_scope)."
+
+    def __init__(self, widget):
+        self.widget = widget
+        self.identifiers = []
+
+    def __enter__(self):
+        self.widget._callback_scopes.append(self)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.widget._callback_scopes.remove(self)
+        identifiers = self.identifiers
+        self.identifiers = []
+        self.widget.forget_callback_identifiers(identifiers)
+
+
+def forget_weak_callback(widget_reference, identifier):
+    "Finalizer for weak callbacks: forget the callback if the widget still exists."
+    widget = widget_reference()
+    if widget is not None:
+        widget.forget_callback_identifiers([identifier])
+
+def callback_key(function, weak=False):
+    """
+    Key for finding callbacks registered for function in the callback index.
+    Bound methods are created for each use: equal methods of the same object share a key
+    (the object is alive while the registry holds the method, or until a weak callback is forgotten).
+    Other functions are their own key if hashable, so equal functions share the key, except for
+    weak callbacks, which must not be held by the index: those use the id while the function is alive.
+    """
+    if inspect.ismethod(function):
+        return ("method", id(function.__self__), function.__func__)
+    if not weak:
+        try:
+            hash(function)
+            return function
+        except TypeError:
+            pass
+    return ("id", id(function))
+
+def weak_function(function):
+    "Return a function calling function through a weak reference, doing nothing after it is collected."
+    reference = weakref.WeakMethod(function) if inspect.ismethod(function) else weakref.ref(function)
+    def call(*arguments):
+        target = reference()
+        if target is not None:
+            return target(*arguments)
+    return call
+
+
 class ElementWrapper(object):
 
     """
@@ -1145,6 +2340,10 @@ class LazyCommandSuperClass(CommandMakerSuperClass):
 
     fragile_reference = "invalid"
 
+    def _pure(self):
+        "Test whether evaluating the expression has no side effects (expression mode)."
+        return False
+
     def __repr__(self):
         return repr(self._cmd())
 
@@ -1183,7 +2382,7 @@ class LazyCommandSuperClass(CommandMakerSuperClass):
             return f(*args)
         return result
 
-    def sync_value(self, timeout=3000, level=3, ms_delay=100):
+    def sync_value(self, timeout=3000, level=3, ms_delay=0):
         """
         Return the converted javascript-side value for this command.
         """
@@ -1192,12 +2391,85 @@ class LazyCommandSuperClass(CommandMakerSuperClass):
         return for_widget._synced_command_result
 
 
+def evaluated_values(replies):
+    "Convert the {name: [ok, value]} reply to an evaluate_many request to {name: value}."
+    result = {}
+    for (name, (ok, value)) in replies.items():
+        result[name] = value if ok else JavascriptException("evaluation error: " + repr(value))
+    return result
+
+# Futures awaited by wait_for_future which are processing kernel messages.
+POLLING_FUTURES = []
+
+async def wait_for_future(future, timeout=None, sleep=0.005):
+    """
+    Await future (with an optional timeout in seconds).  In a kernel, widget messages are
+    not handled while a cell runs, so process them while waiting (one waiter processes
+    messages for all waiters).
+    """
+    shell = IPython.get_ipython()
+    if getattr(shell, "kernel", None) is None:
+        return await asyncio.wait_for(future, timeout)
+    deadline = None if timeout is None else time.time() + timeout
+    while not future.done():
+        if deadline is not None and time.time() > deadline:
+            future.cancel()
+            raise asyncio.TimeoutError("no reply after %s seconds" % timeout)
+        if POLLING_FUTURES:
+            await asyncio.wait([future], timeout=sleep)
+            continue
+        POLLING_FUTURES.append(future)
+        try:
+            async with ui_events() as poll:
+                while not future.done() and (deadline is None or time.time() <= deadline):
+                    await poll(10)
+                    await asyncio.sleep(sleep)
+        finally:
+            POLLING_FUTURES.remove(future)
+    return future.result()
+
+
+def expression_uses(value, expression):
+    "Test whether a command structure refers to the lazy expression (expression mode)."
+    if value is expression:
+        return True
+    ty = type(value)
+    if ty is list or ty is tuple:
+        return any(expression_uses(x, expression) for x in value)
+    if ty is dict:
+        return any(expression_uses(x, expression) for x in value.values())
+    if isinstance(value, CommandMakerSuperClass):
+        return any(expression_uses(x, expression) for (k, x) in vars(value).items() if k != "for_widget")
+    return False
+
+# Widgets which may have a pending expression to commit after an IPython cell executes.
+PENDING_EXPRESSION_WIDGETS = weakref.WeakSet()
+_POST_RUN_CELL_REGISTERED = []
+
+def commit_pending_expressions(*ignored):
+    "Commit pending lazy expressions (expression mode) at the end of a cell."
+    widgets = list(PENDING_EXPRESSION_WIDGETS)
+    PENDING_EXPRESSION_WIDGETS.clear()
+    for widget in widgets:
+        widget.commit_expression()
+
+def register_post_run_cell():
+    if not _POST_RUN_CELL_REGISTERED:
+        ip = IPython.get_ipython()
+        if ip is not None:
+            ip.events.register("post_run_cell", commit_pending_expressions)
+            _POST_RUN_CELL_REGISTERED.append(ip)
+
+
 class LazyGet(LazyCommandSuperClass):
 
     def __init__(self, for_widget, for_target, attribute):
         self.for_target = for_target
         self.for_widget = for_widget
         self.attribute = attribute
+        if for_widget.expression_mode:
+            for_widget.expression_created(self, (for_target, attribute))
+            return
         # when executing immediately put target ref in fragile_this and attr value in fragile_ref
         set_this = SetMaker(for_widget.get_element(), FRAGILE_THIS, for_target.reference())
         # get attr value as element.fragile_this.attr
@@ -1209,9 +2481,17 @@ class LazyGet(LazyCommandSuperClass):
         for_widget.last_fragile_reference = self
 
     def _cmd(self):
-        m = MethodMaker(self.for_target, self.attribute)
+        # a committed target is read from the fragile reference slot, not evaluated again.
+        m = MethodMaker(self.for_target.reference(), self.attribute)
         return m._cmd()
 
+    def _pure(self):
+        target = self.for_target
+        if isinstance(target, LazyCommandSuperClass):
+            return target._pure()
+        # properties of the element or window
+        return type(target) is CommandMaker
+
     def __call__(self, *args):
         if type(self.attribute) is str:
             return LazyMethodCall(self.for_widget, self, *args)
@@ -1234,6 +2514,9 @@ class LazyCall(LazyCommandSuperClass):
         self.for_widget = for_widget
         args = for_widget.wrap_callables(args)
         self.args = args
+        if for_widget.expression_mode:
+            for_widget.expression_created(self, (for_target, args))
+            return
         # when executing immediately save result of call in fragile_ref
         set_ref = SetMaker(
             for_widget.get_element(),
@@ -1244,8 +2527,8 @@ class LazyCall(LazyCommandSuperClass):
         for_widget.last_fragile_reference = self
 
     def _cmd(self):
-        c = CallMaker("function", self.for_target, *self.args)
-        return c.cmd()
+        c = CallMaker("function", self.for_target.reference(), *self.args)
+        return c._cmd()
         
 class LazyMethodCall(LazyCommandSuperClass):
 
@@ -1254,6 +2537,9 @@ class LazyMethodCall(LazyCommandSuperClass):
         self.for_widget = for_widget
         args = for_widget.wrap_callables(args)
         self.args = args
+        if for_widget.expression_mode:
+            for_widget.expression_created(self, (for_method, args))
+            return
         # when executing immediately save result of call in fragile_ref
         set_ref = SetMaker(
             for_widget.get_element(),
@@ -1265,9 +2551,34 @@ class LazyMethodCall(LazyCommandSuperClass):
 
     def _cmd(self):
         for_method = self.for_method
-        m = CallMaker("method", for_method.for_target, for_method.attribute, *self.args)
+        m = CallMaker("method", for_method.for_target.reference(), for_method.attribute, *self.args)
         return m._cmd()
 
+def release_handle(widget_reference, identifier):
+    "Finalizer for JSHandles: release the handle if the widget still exists."
+    widget = widget_reference()
+    if widget is not None:
+        widget.release_handle(identifier)
+
+class JSHandle(LazyCommandSuperClass):
+
+    """
+    Proxy for a value in the handle table of the view (see JSProxyWidget.handle).
+    Attributes and calls chain like other lazy commands, starting from the stored value.
+    """
+
+    def __init__(self, for_widget, identifier):
+        self.for_widget = for_widget
+        self.identifier = identifier
+        # the finalizer must not keep the widget alive.
+        weakref.finalize(self, release_handle, weakref.ref(for_widget), identifier)
+
+    def _cmd(self):
+        return ["handle", self.identifier]
+
+    def _pure(self):
+        return True
+
 class CommandMaker(CommandMakerSuperClass):
 
     """
@@ -1454,6 +2765,128 @@ class CallMaker(CommandMaker):
         return [self.kind] + self.args #+ validate_commands(self.args, False)
 
 
+class FunctionMaker(CommandMaker):
+    """
+    Proxy reference to new Function(arg0, ..., argn, body) compiled in the browser page.
+    The page keeps compiled functions by hash of the argument names and body, so
+    the body is sent only until the pages displaying the widget acknowledge compiling it.
+    """
+
+    def __init__(self, for_widget, arguments, body):
+        self.for_widget = for_widget
+        self.argnames = ",".join(arguments)
+        self.body = body
+        text = json.dumps([self.argnames, body])
+        self.hash = hashlib.sha256(text.encode("utf-8")).hexdigest()[:32]
+
+    def javascript(self, level=0):
+        args = [to_javascript(a) for a in self.argnames.split(",")] + [to_javascript(self.body)]
+        return indent_string("new Function(%s)" % ", ".join(args), level)
+
+    def __call__(self, *args):
+        return CallMaker("function", self, *args)
+
+    def _cmd(self):
+        widget = self.for_widget
+        # kept to resend if a page reports a miss.
+        widget._function_bodies[self.hash] = [self.argnames, self.body]
+        if widget.function_known(self.hash):
+            return ["cached_function", self.hash]
+        return ["cached_function", self.hash, self.argnames, self.body]
+
+
+class HoleMaker(CommandMaker):
+    """
+    Proxy reference to parameter number index of a command template.
+    """
+
+    def __init__(self, index):
+        self.index = index
+
+    def javascript(self, level=0):
+        return indent_string("params[%s]" % self.index, level)
+
+    def _cmd(self):
+        return ["hole", self.index]
+
+
+class RequestMaker(CommandMaker):
+    """
+    Proxy container for commands [indicator, identifier, ...data] which refer to
+    a template or request by identifier.
+    """
+
+    def __init__(self, indicator, identifier, *data):
+        self.indicator = indicator
+        self.identifier = identifier
+        self.data = data
+
+    def javascript(self, level=0):
+        return indent_string("%s(%s, %s)" % (self.indicator, self.identifier, format_args(self.data)), level)
+
+    def _cmd(self):
+        return [self.indicator, self.identifier] + list(self.data)
+
+
+class ValidatedCommand(CommandMaker):
+    """
+    Proxy container for a command already converted to list format by validate_command.
+    """
+
+    def __init__(self, command):
+        self.command = command
+
+    def javascript(self, level=0):
+        raise NotImplementedError("validated commands are not converted to javascript.")
+
+    def _cmd(self):
+        return self.command
+
+
+class CommandTemplate(object):
+    """
+    A command batch registered in the view by widget.template.
+    Call the template with values for its holes to run the batch.  If all the values
+    are numbers they are sent packed in one Float64Array.
+    """
+
+    def __init__(self, for_widget, identifier, holes):
+        self.for_widget = for_widget
+        self.identifier = identifier
+        self.holes = holes
+
+    def __call__(self, *values):
+        assert len(values) == self.holes, "template expects %s values, got %s" % (self.holes, len(values))
+        if values and all(isinstance(v, NUMBER_TYPES) and not isinstance(v, (bool, np.bool_)) for v in values):
+            return self.packed(values)
+        return self.for_widget(RequestMaker("template_call", self.identifier, LiteralMaker(list(values))))
+
+    def packed(self, array):
+        "Run the template with the numbers in array sent as one typed array of the array dtype."
+        array = np.asarray(array)
+        if array.dtype.kind != "f":
+            # holes hold Javascript numbers, as for JSON values.
+            array = array.astype(np.float64)
+        assert array.shape == (self.holes,), "template expects %s values, got shape %s" % (self.holes, array.shape)
+        return self.for_widget(RequestMaker("template_call", self.identifier, LiteralMaker(array)))
+
+
+class BigIntArray(object):
+    "A 64 bit integer array to send as a BigInt64Array or BigUint64Array (see bigint_array)."
+
+    def __init__(self, array):
+        assert array.dtype.kind in "iu" and array.dtype.itemsize == 8, "not a 64 bit integer array " + repr(array.dtype)
+        self.array = array
+
+def bigint_array(array):
+    """
+    Wrap a 64 bit integer array to send it to javascript as a BigInt64Array or BigUint64Array
+    rather than an Int32Array, Uint32Array or Float64Array.  Elements of BigInt arrays are
+    BigInt values which do not mix with numbers in javascript arithmetic.
+    """
+    return BigIntArray(np.asarray(array))
+
+
 class LiteralMaker(CommandMaker):
     """
     Proxy to make a literal dictionary or list which may contain other
@@ -1462,7 +2895,9 @@ class LiteralMaker(CommandMaker):
 
     indicators = {
         # things we can translate
-        dict: "dict", list: "list", bytearray: "bytes",
+        dict: "dict", list: "list", bytearray: "bytes", bytes: "bytes", memoryview: "bytes",
+        np.ndarray: "ndarray",
+        BigIntArray: "ndarray",
         # we can't translate non-specific types, modules, etc.
         type: "don't translate non-specific types, like classes",
         type(json): "don't translate modules",
@@ -1487,8 +2922,13 @@ class LiteralMaker(CommandMaker):
                 return [indicator] + quoteLists(thing)
             elif ty is dict:
                 return [indicator, dict((k, quoteIfNeeded(thing[k])) for k in thing)]
-            elif ty is bytearray:
-                return [indicator, bytearray_to_hex(thing)]
+            elif indicator == "bytes":
+                # binary values are encoded for transport when the commands are sent.
+                return [indicator, thing]
+            elif ty is BigIntArray:
+                return ndarray_command(thing.array, bigint=True)
+            elif indicator == "ndarray":
+                return ndarray_command(thing)
             else:
                 raise ValueError("can't translate " + repr(ty))
         return thing
@@ -1497,13 +2937,156 @@ class LiteralMaker(CommandMaker):
 def quoteIfNeeded(arg):
     if type(arg) in LiteralMaker.indicators:
         return LiteralMaker(arg)
+    if isinstance(arg, np.ndarray):
+        # ndarray subclasses
+        return LiteralMaker(np.asarray(arg))
+    if isinstance(arg, np.generic):
+        # numpy scalars are sent as the equivalent Python value
+        return arg.item()
     return arg
 
+# Typed array names for little endian numpy dtype strings (without the byte order character).
+TYPED_ARRAY_NAMES = {
+    "b1": "Uint8Array",
+    "i1": "Int8Array",
+    "u1": "Uint8Array",
+    "i2": "Int16Array",
+    "u2": "Uint16Array",
+    "i4": "Int32Array",
+    "u4": "Uint32Array",
+    "i8": "Float64Array",
+    "u8": "Float64Array",
+    "f4": "Float32Array",
+    "f8": "Float64Array",
+}
+
+# Typed array names for 64 bit integer arrays wrapped by bigint_array.
+BIGINT_ARRAY_NAMES = {
+    "i8": "BigInt64Array",
+    "u8": "BigUint64Array",
+}
+
+def narrow_int64(array):
+    """
+    Convert a 64 bit integer array to 32 bits if the values fit, or to float64 otherwise,
+    since javascript numbers are doubles.  Other arrays are returned unchanged.
+    """
+    dtype = array.dtype
+    if dtype.kind not in "iu" or dtype.itemsize != 8:
+        return array
+    narrow = np.dtype(np.int32 if dtype.kind == "i" else np.uint32)
+    info = np.iinfo(narrow)
+    if array.size == 0 or (array.min() >= info.min and array.max() <= info.max):
+        return array.astype(narrow)
+    return array.astype(np.float64)
+
+def ndarray_command(array, bigint=False):
+    """
+    Encode a numpy array as ["ndarray", dtype_str, shape, ["bytes", data]].
+    Arrays with no typed array equivalent are converted to float64 if numeric
+    or sent as (nested) lists otherwise.  64 bit integer arrays are narrowed
+    (see narrow_int64) unless bigint is set.
+    """
+    if not bigint:
+        array = narrow_int64(array)
+    dtype = array.dtype
+    if dtype.kind in "biuf":
+        if dtype.str[1:] not in TYPED_ARRAY_NAMES:
+            # float16 and extended precision floats
+            dtype = np.dtype(np.float64)
+        # typed arrays are little endian.
+        dtype = dtype.newbyteorder("<")
+        array = np.asarray(array, dtype=dtype, order="C")
+        data = memoryview(array.reshape(-1)).cast("B")
+        return ["ndarray", array.dtype.str, list(array.shape), ["bytes", data]]
+    # otherwise fall back to JSON lists
+    return LiteralMaker(array.tolist())._cmd()
+
 def quoteLists(args):
     "Wrap lists or dictionaries in the args in LiteralMakers"
     return [quoteIfNeeded(x) for x in args]
 
 
+BINARY_TYPES = (bytes, bytearray, memoryview)
+
+NUMBER_TYPES = (int, float, np.integer, np.floating)
+
+# Commands whose parts are all evaluated as arguments.
+ARGUMENT_INDICATORS = frozenset(["list", "function", "null"])
+
+def encode_binary(command, buffers, text_threshold=None):
+    """
+    Encode binary values in a validated command for transport.
+    If buffers is a list then binary values are appended to buffers and replaced by their
+    buffer index, and strings at least text_threshold long in argument positions are replaced
+    by ["text", buffer_index] references to their UTF-8 encoding.
+    If buffers is None binary values are replaced by hexidecimal strings.
+    """
+    ty = type(command)
+    if ty is str:
+        if buffers is not None and text_threshold is not None and len(command) >= text_threshold:
+            buffers.append(command.encode("utf8"))
+            return ["text", len(buffers) - 1]
+        return command
+    if ty is not list or not command:
+        return command
+    indicator = command[0]
+    def encode(c):
+        return encode_binary(c, buffers, text_threshold)
+    if indicator == "bytes":
+        value = command[1]
+        if not isinstance(value, BINARY_TYPES):
+            # already encoded
+            return command
+        if buffers is None:
+            return [indicator, bytearray_to_hex(value)]
+        buffers.append(value)
+        return [indicator, len(buffers) - 1]
+    elif indicator == "id" or indicator == "callback" or indicator == "text":
+        # untranslated data
+        return command
+    elif indicator in LOAD_INDICATORS:
+        [name, text_content] = command[1:]
+        return [indicator, name, encode(text_content)]
+    elif indicator == "method":
+        return [indicator, encode(command[1]), command[2]] + [encode(x) for x in command[3:]]
+    elif indicator == "ndarray":
+        return command[:3] + [encode(command[3])]
+    elif indicator == "cached_function":
+        return command[:3] + [encode(x) for x in command[3:]]
+    elif indicator == "get":
+        return [indicator, encode(command[1]), command[2]]
+    elif indicator == "set":
+        return [indicator, encode(command[1]), command[2], encode(command[3])]
+    elif indicator == "dict":
+        d = command[1]
+        return [indicator, dict((k, encode(d[k])) for k in d)]
+    elif indicator == "template_define":
+        # the template runs in later batches, which have other message buffers.
+        return command[:2] + [encode_binary(command[2], None)]
+    elif indicator in ARGUMENT_INDICATORS:
+        return [indicator] + [encode(x) for x in command[1:]]
+    else:
+        # strings in requests are keys or names, not arguments.
+        return [indicator] + [x if type(x) is str else encode(x) for x in command[1:]]
+
+
+def decode_buffers(value, buffers):
+    """
+    Replace binary value references in a JSON value sent from javascript with
+    numpy arrays viewing the message buffers (no copy).
+    """
+    ty = type(value)
+    if ty is dict:
+        if len(value) == 1 and BUFFER_REFERENCE in value:
+            [index, dtype] = value[BUFFER_REFERENCE]
+            return np.frombuffer(buffers[index], dtype=dtype)
+        return dict((k, decode_buffers(v, buffers)) for (k, v) in value.items())
+    if ty is list:
+        return [decode_buffers(x, buffers) for x in value]
+    return value
+
+
 class InvalidCommand(Exception):
     "Invalid command"
 
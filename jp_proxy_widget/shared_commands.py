@@ -0,0 +1,155 @@
+"""
+Structural sharing for command batches.
+
+Batches built by the lazy element interface repeat the same subtrees, like
+["element"], ["get", ["element"], "_FRAGILE_THIS"] and method name strings, many
+times.  share_commands replaces repeated subtrees and strings with
+
+    ["ref", index]
+
+references into a per message table of shared values.  Table entries may
+themselves refer to earlier table entries, so the batch is sent as a DAG.
+The view expands the table once per batch before executing the commands.
+"""
+
+import json
+
+REF = "ref"
+
+# Approximate JSON size of a reference like ["ref", 12], used to decide if sharing is worthwhile.
+REF_SIZE = 12
+
+# Command data which is not translated and must not be rewritten.
+UNTRANSLATED = ("id", "callback")
+
+def share_commands(commands, ref_size=REF_SIZE):
+    """
+    Return (shared_commands, table) for a list of validated and encoded commands.
+    The table is empty if no sharing is worthwhile, and then shared_commands is commands.
+    """
+    counter = _SubtreeCounter()
+    for command in commands:
+        counter.count(command)
+    shared = counter.shared_keys(ref_size)
+    if not shared:
+        return (commands, [])
+    encoder = _SharingEncoder(counter, shared)
+    return ([encoder.encode(command) for command in commands], encoder.table)
+
+
+class _SubtreeCounter(object):
+    """
+    Count occurrences of subtrees and strings by structural key, recording the approximate
+    JSON size of each.  Subtrees of a repeated occurrence are not counted again because
+    they will be sent once as part of the shared occurrence.
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self.sizes = {}
+        # (key, size) for each list visited, by id (the commands are alive throughout).
+        self.keys = {}
+
+    def count(self, value):
+        (key, size) = self.key(value)
+        if key is None:
+            return
+        counts = self.counts
+        previous = counts.get(key, 0)
+        counts[key] = previous + 1
+        if previous or type(value) is not list or (value and value[0] in UNTRANSLATED):
+            return
+        # the indicator is never shared: the view dispatches on it before expanding references.
+        for item in value[1:]:
+            if type(item) is dict:
+                for v in item.values():
+                    self.count(v)
+            else:
+                self.count(item)
+
+    def key(self, value):
+        "Return (structural_key, approximate_size) for value, computing keys for subtrees once."
+        ty = type(value)
+        if ty is str:
+            key = ("s", value)
+            size = len(value) + 2
+            self.sizes[key] = size
+            return (key, size)
+        if ty is not list:
+            # numbers, booleans and None are not shared.
+            return (None, len(repr(value)))
+        known = self.keys.get(id(value))
+        if known is not None:
+            return known
+        if value and value[0] in UNTRANSLATED:
+            text = json.dumps(value)
+            result = (("j", text), len(text))
+        else:
+            child_keys = []
+            size = 1
+            for item in value:
+                if type(item) is dict:
+                    # ["dict", {key: command}]
+                    pairs = []
+                    for k in sorted(item):
+                        (item_key, item_size) = self.key(item[k])
+                        pairs.append((k, item_key if item_key is not None else ("v", repr(item[k]))))
+                        size += len(k) + item_size + 4
+                    child_keys.append(("d", tuple(pairs)))
+                else:
+                    (item_key, item_size) = self.key(item)
+                    child_keys.append(item_key if item_key is not None else ("v", repr(item)))
+                    size += item_size + 1
+            result = (("l",) + tuple(child_keys), size)
+        self.keys[id(value)] = result
+        self.sizes[result[0]] = result[1]
+        return result
+
+    def shared_keys(self, ref_size):
+        "Keys of values worth sharing: sending the value once plus references is smaller."
+        sizes = self.sizes
+        result = set()
+        for (key, count) in self.counts.items():
+            if count > 1:
+                size = sizes[key]
+                if (count - 1) * size > (count + 1) * ref_size:
+                    result.add(key)
+        return result
+
+
+class _SharingEncoder(object):
+    "Replace shared values with references, building the table of shared values."
+
+    def __init__(self, counter, shared):
+        self.counter = counter
+        self.shared = shared
+        self.table = []
+        self.index = {}
+
+    def encode(self, value):
+        ty = type(value)
+        if ty is not str and ty is not list:
+            return value
+        (key, size) = self.counter.key(value)
+        if key in self.shared:
+            index = self.index.get(key)
+            if index is None:
+                # encode the value first so its entry can refer to earlier entries.
+                entry = self.encode_parts(value)
+                index = self.index[key] = len(self.table)
+                self.table.append(entry)
+            return [REF, index]
+        return self.encode_parts(value)
+
+    def encode_parts(self, value):
+        if type(value) is str or (value and value[0] in UNTRANSLATED):
+            return value
+        encode = self.encode
+        result = value[:1]
+        for item in value[1:]:
+            if type(item) is dict:
+                item = dict((k, encode(v)) for (k, v) in item.items())
+            else:
+                item = encode(item)
+            result.append(item)
+        return result
@@ -12,12 +12,11 @@ js_files = ["js/simple_upload_button.js"]
 def _load_required_js(widget):
     widget.load_js_files(filenames=js_files)
 
-def from_hex_iterator(hexcontent):
-    # xxxx try to optimize...
-    for i in range(0, len(hexcontent), 2):
-        hexcode = hexcontent[i: i+2]
-        char = bytes(((int(hexcode, 16)),))
-        yield char
+def from_hex_iterator(hexcontent, chunk_size=1000000):
+    "Generate decoded bytes for hexcontent, chunk_size hex characters at a time."
+    decoder = hex_codec.HexStreamDecoder()
+    chunks = (hexcontent[i: i+chunk_size] for i in range(0, len(hexcontent), chunk_size))
+    return decoder.iter_decode(chunks)
 
 class JavaScriptError(Exception):
     "Exception sent from javascript."
@@ -121,14 +120,16 @@ class UnicodeUploader(HasTraits):
             exc.file_info = file_info
             self.status = "Javascript sent exception " + msg
             self.chunk_collector = []
+            self.reset_decoder()
             raise exc
         if status == "more":
-            self.chunk_collector.append(content)
+            self.chunk_collector.append(self.decode_chunk(content))
             self.progress_callback(self.chunk_collector, file_info)
         else:
             assert status == "done", "Unknown status " + repr(status)
             self.save_chunks = self.chunk_collector
-            self.chunk_collector.append(content)
+            self.chunk_collector.append(self.decode_chunk(content))
+            self.finish_decoding()
             all_content = self.combine_chunks(self.chunk_collector)
             self.chunk_collector = []
             content_callback = self.content_callback
@@ -154,6 +155,18 @@ class UnicodeUploader(HasTraits):
     def combine_chunks(self, chunk_list):
         return u"".join(chunk_list)
 
+    def decode_chunk(self, content):
+        "decode one chunk of content as it arrives -- unicode content is not transformed."
+        return content
+
+    def finish_decoding(self):
+        "check the decoding is complete after the last chunk."
+        pass
+
+    def reset_decoder(self):
+        "discard any partially decoded content."
+        pass
+
     def upload_options(self):
         "options for jquery upload plugin -- unicode, not hex"
         return {"hexidecimal": False}
@@ -169,7 +182,9 @@ class UnicodeUploader(HasTraits):
 
 class BinaryUploader(UnicodeUploader):
 
-    encoding_factor = 2
+    # chunks are decoded as they arrive.
+    encoding_factor = 1
+    decoder = None
 
     def upload_options(self):
         return {"hexidecimal": True}
@@ -181,8 +196,19 @@ class BinaryUploader(UnicodeUploader):
         return file_info.get("hexcontent")
 
     def combine_chunks(self, chunk_list):
-        all_hex_content = "".join(chunk_list)
-        #return b"".join(from_hex_iterator(all_hex_content))
-        ba = hex_codec.hex_to_bytearray(all_hex_content)
-        return bytes(ba)
+        return b"".join(chunk_list)
+
+    def decode_chunk(self, content):
+        if self.decoder is None:
+            self.decoder = hex_codec.HexStreamDecoder()
+        return self.decoder.decode(content)
+
+    def finish_decoding(self):
+        decoder = self.decoder
+        self.decoder = None
+        if decoder is not None:
+            decoder.finish()
+
+    def reset_decoder(self):
+        self.decoder = None
 
@@ -8,6 +8,7 @@ import os
 import jp_proxy_widget
 import time
 import sys
+import traitlets
 from IPython.display import display
 
 class FileWatcherWidget(jp_proxy_widget.JSProxyWidget):
@@ -18,6 +19,9 @@ class FileWatcherWidget(jp_proxy_widget.JSProxyWidget):
     verbose = False
     check_python_modules = False
     check_javascript = False
+
+    # don't check files for watchers scrolled out of sight.
+    defer_while_hidden = traitlets.Bool(True, sync=True)
     
     def __init__(self, *pargs, **kwargs):
         super(FileWatcherWidget, self).__init__(*pargs, **kwargs)
@@ -75,7 +79,7 @@ class FileWatcherWidget(jp_proxy_widget.JSProxyWidget):
             }
         };
         element.check_after_timeout = function () {
-            setTimeout(check_files, delay * 1000);
+            element.pausable_timeout(check_files, delay * 1000);
         }
         """, check_files=self.check_files, delay=self.delay)
         # start the checking
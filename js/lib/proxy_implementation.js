@@ -34,6 +34,40 @@ var JSProxyModel = widgets.DOMWidgetModel.extend({
 //var loader_defined = false;
 var JSProxyLoad = "JSProxyLoad";
 
+// Lookup tables for hexidecimal conversion.
+// HEX_CODES[b] holds the two hex character codes for byte b (first character in the low byte).
+// HEX_VALUES[c] is the value of the hex digit with character code c, or 255 if c is not a hex digit.
+var HEX_CODES = new Uint16Array(256);
+var HEX_VALUES = new Uint8Array(128).fill(255);
+(function() {
+    var digits = "0123456789abcdef";
+    for (var b=0; b<256; b++) {
+        HEX_CODES[b] = digits.charCodeAt(b >> 4) | (digits.charCodeAt(b & 15) << 8);
+    }
+    for (var d=0; d<16; d++) {
+        HEX_VALUES[digits.charCodeAt(d)] = d;
+        HEX_VALUES["0123456789ABCDEF".charCodeAt(d)] = d;
+    }
+})();
+
+// Command indicators by opcode for binary command messages (must match jp_proxy_widget/binary_commands.py).
+var BINARY_OPCODES = [
+    "element", "window", "method", "function", "get", "set", "id", "list", "dict",
+    "callback", "null", "bytes", "text", "ndarray", "ref", "load_css", "load_js",
+    "cached_function", "hole", "template_define", "template_call", "evaluate",
+    "evaluate_many", "result", "handle_set", "handle", "handle_retain", "handle_release",
+    "forget_callbacks",
+];
+
+// Functions compiled for cached_function commands, by content hash (shared by all views in the page).
+var FUNCTION_CACHE = {};
+
+// Identifier for this page session, so the kernel knows which functions are compiled here.
+var PAGE_SESSION = Date.now().toString(36) + "-" + Math.random().toString(36).slice(2);
+
+// Views created in the page session, for view identifiers.
+var VIEW_COUNT = 0;
+
 // Custom View. Renders the widget model.
 var JSProxyView = widgets.DOMWidgetView.extend({
 
@@ -237,10 +271,246 @@ var JSProxyView = widgets.DOMWidgetView.extend({
         // Just do it -- we never want scrollbars on widgets.
         that.$$el.no_overflow();
 
+        // Like setTimeout, but while a deferring view is hidden the callback waits until it is visible.
+        that.$$el.pausable_timeout = function(callback, milliseconds) {
+            return setTimeout(that.when_visible(callback), milliseconds);
+        };
+        // Wrap a function so calls while a deferring view is hidden are postponed (only the last call runs).
+        that.$$el.when_visible = function(callback) {
+            return that.when_visible(callback);
+        };
+        that.observe_visibility();
+
+        if (that.model.get("binary_commands") && (typeof TextDecoder != "undefined")) {
+            // accept binary command messages (set together with rendered).
+            that.model.set("binary_commands_accepted", true);
+        }
+        if ((typeof CompressionStream != "undefined") && (typeof DecompressionStream != "undefined")) {
+            that.model.set("compression_accepted", true);
+        }
+        // tell the kernel this page displays the widget.
+        that.send_custom_message(that.VIEW_RENDERED, [PAGE_SESSION, that.view_identifier()]);
         that.model.set("rendered", true);
         that.touch();
     },
 
+    remove: function() {
+        var that = this;
+        if (that._visibility_observer) {
+            that._visibility_observer.disconnect();
+            that._visibility_observer = null;
+            that.report_visibility(null);
+        }
+        return widgets.DOMWidgetView.prototype.remove.apply(that, arguments);
+    },
+
+    observe_visibility: function() {
+        // If the model sets defer_while_hidden, track whether the view is on screen.
+        var that = this;
+        that._hidden = false;
+        that._deferred = [];
+        that._paused_calls = [];
+        if (!that.model.get("defer_while_hidden") || (typeof IntersectionObserver == "undefined")) {
+            return;
+        }
+        that._visibility_observer = new IntersectionObserver(function(entries) {
+            var entry = entries[entries.length - 1];
+            that.set_hidden(!entry.isIntersecting);
+        });
+        that._visibility_observer.observe(that.el);
+    },
+
+    set_hidden: function(hidden) {
+        var that = this;
+        if (hidden == that._hidden) {
+            return;
+        }
+        that._hidden = hidden;
+        that.report_visibility(!hidden);
+        if (!hidden) {
+            that.catch_up();
+        }
+    },
+
+    report_visibility: function(visible) {
+        // Set this view's entry in the visibility model dictionary (remove it if visible is null).
+        var that = this;
+        var visibility = Object.assign({}, that.model.get("visibility"));
+        if (visible === null) {
+            delete visibility[that.cid];
+        } else {
+            visibility[that.cid] = visible;
+        }
+        that.model.set("visibility", visibility);
+        that.touch();
+    },
+
+    defer_commands: function(command_list, buffers) {
+        // Queue commands received while hidden.  A command which sets a value on the element
+        // replaces an earlier queued command setting the same value if only such commands
+        // are queued between them.
+        var that = this;
+        var deferred = that._deferred;
+        for (var i=0; i<command_list.length; i++) {
+            var command = command_list[i];
+            var key = that.compaction_key(command);
+            if (key) {
+                for (var j=deferred.length - 1; j>=0 && deferred[j].key; j--) {
+                    if (deferred[j].key == key) {
+                        deferred.splice(j, 1);
+                        break;
+                    }
+                }
+            }
+            deferred.push({command: command, buffers: buffers, key: key});
+        }
+    },
+
+    // jQuery methods (with their number of key arguments) whose last call on a target wins.
+    SETTER_METHODS: {css: 1, attr: 1, prop: 1, data: 1, html: 0, text: 0, val: 0},
+
+    compaction_key: function(command) {
+        // Return a key for commands setting a value on the element with pure arguments, or null.
+        var that = this;
+        if (!jquery_.isArray(command) || !that.is_element(command[1])) {
+            return null;
+        }
+        var indicator = command[0];
+        if (indicator == "set" && (typeof command[2]) == "string") {
+            var value = command[3];
+            if (that.is_pure(value)) {
+                return "set " + command[2];
+            }
+            if (command[2].startsWith("_FRAGILE_") && jquery_.isArray(value) && that.is_element(value[1])) {
+                // a statement like element.css("left", x) in expression mode.
+                return that.compaction_key(value);
+            }
+        } else if (indicator == "method" && that.SETTER_METHODS.hasOwnProperty(command[2])) {
+            var keys = that.SETTER_METHODS[command[2]];
+            var args = command.slice(3);
+            if (args.length == keys + 1 && args.every(that.is_pure, that) &&
+                    args.slice(0, keys).every(function(a) { return (typeof a) == "string"; })) {
+                return "method " + command[2] + " " + JSON.stringify(args.slice(0, keys));
+            }
+        }
+        return null;
+    },
+
+    is_element: function(command) {
+        return jquery_.isArray(command) && command.length == 1 && command[0] == "element";
+    },
+
+    is_pure: function(command) {
+        // Test whether evaluating the command can have no side effects.
+        var that = this;
+        if (!jquery_.isArray(command)) {
+            return true;
+        }
+        var indicator = command[0];
+        if (indicator == "id" || indicator == "bytes" || indicator == "text") {
+            return true;
+        } else if (indicator == "list") {
+            return command.slice(1).every(that.is_pure, that);
+        } else if (indicator == "dict") {
+            var desc = command[1];
+            for (var key in desc) {
+                if (!that.is_pure(desc[key])) {
+                    return false;
+                }
+            }
+            return true;
+        } else if (indicator == "ndarray") {
+            return that.is_pure(command[3]);
+        }
+        return false;
+    },
+
+    // Indicators of commands which must run at once even when the view is hidden.
+    MUST_RUN_INDICATORS: {
+        // callbacks and replies to the kernel (which may be waiting for them)
+        "callback": true, "evaluate": true, "evaluate_many": true, "result": true,
+        // the handle table, which the kernel expects to change in order with its handles
+        "handle_set": true, "handle": true, "handle_release": true,
+    },
+
+    must_run: function(command) {
+        // Test whether a command must run at once even when the view is hidden.
+        var that = this;
+        if (!jquery_.isArray(command)) {
+            return false;
+        }
+        var indicator = command[0];
+        if (that.MUST_RUN_INDICATORS[indicator]) {
+            return true;
+        } else if (indicator == "id" || indicator == "bytes" || indicator == "text") {
+            return false;
+        } else if (indicator == "method" && command[2] == "_SEND_FRAGILE_JS_REFERENCE") {
+            // sync_value: the kernel is polling for the reply.
+            return true;
+        } else if (indicator == "dict") {
+            var desc = command[1];
+            for (var key in desc) {
+                if (that.must_run(desc[key])) {
+                    return true;
+                }
+            }
+            return false;
+        }
+        for (var i=1; i<command.length; i++) {
+            if (that.must_run(command[i])) {
+                return true;
+            }
+        }
+        return false;
+    },
+
+    catch_up: function() {
+        // Run the commands and calls deferred while hidden, in order, after any running batches.
+        var that = this;
+        var deferred = that._deferred;
+        var paused = that._paused_calls;
+        that._deferred = [];
+        that._paused_calls = [];
+        var start = 0;
+        for (var i=1; i<=deferred.length; i++) {
+            if (i == deferred.length || deferred[i].buffers !== deferred[start].buffers) {
+                var commands = deferred.slice(start, i).map(function(entry) { return entry.command; });
+                var buffers = deferred[start].buffers;
+                // (already acknowledged when deferred)
+                that.enqueue_batch(that.run_batch.bind(that, commands, null, null, buffers));
+                start = i;
+            }
+        }
+        if (paused.length) {
+            that.enqueue_batch(function() {
+                paused.forEach(function(call) { call(); });
+                return true;
+            });
+        }
+    },
+
+    when_visible: function(callback) {
+        // Return a function calling callback now, or when the view is visible again if it is
+        // hidden (repeated calls while hidden are replaced by the last one).
+        var that = this;
+        var pending = null;
+        return function() {
+            var self = this;
+            var args = arguments;
+            if (!that._hidden) {
+                return callback.apply(self, args);
+            }
+            if (!pending) {
+                that._paused_calls.push(function() {
+                    var call = pending;
+                    pending = null;
+                    call();
+                });
+            }
+            pending = function() { callback.apply(self, args); };
+        };
+    },
+
     set_error_msg: function(message) {
         var that = this;
         that.error_msg = message;
@@ -253,12 +523,23 @@ var JSProxyView = widgets.DOMWidgetView.extend({
     INDICATOR: "indicator",
     PAYLOAD: "payload",
     RESULTS: "results",
+    FUNCTION_MISS: "function_miss",
+    FUNCTIONS_KNOWN: "functions_known",
+    FUNCTION_BODIES: "function_bodies",
+    VIEW_RENDERED: "view_rendered",
+    EVALUATED: "evaluated",
+    RESULT: "result",
     CALLBACK_RESULTS: "callback_results",
     JSON_CB_FRAGMENT: "jcb_results",
     JSON_CB_FINAL: "jcb_final",
     COMMANDS: "commands",
     COMMANDS_FRAGMENT: "cm_fragment",
     COMMANDS_FINAL: "cm_final",
+    BINARY_COMMANDS: "bin_commands",
+    COMPRESSED: "compressed",
+    COMPRESSED_FRAGMENT: "cz_fragment",
+    // unsegmented equivalents of final segment indicators, for sending segmented payloads compressed.
+    UNSEGMENTED_INDICATORS: {"jcb_final": "callback_results", "cm_final": "commands"},
 
     update: function(options) {
         // do nothing.
@@ -267,104 +548,449 @@ var JSProxyView = widgets.DOMWidgetView.extend({
         //return that.execute_commands(commands);
     },
 
-    execute_commands: function(commands) {
+    execute_commands: function(commands, buffers) {
+        // Queue a command batch for execution after earlier batches.
+        // Returns a Promise resolving to true when the batch completes or false if it fails.
         // cl("execute_commands " + commands.length);
         var that = this;
-        var results = [];
         if (commands && commands.length >= 2) {
             var command_counter = commands[0];
             // cl("command_counter=" + command_counter)
             var command_list = commands[1];
             var level = commands[2];
             level = that.check_level(level);
-            // resume command execution at the beginning...
-            return that.resume_execute_commands(results, command_list, command_counter, level, 0);
-            /*
-            try {
-                _.each(command_list, function(command,i) {
-                    var result = that.execute_command(command);
-                    results[i] = that.json_safe(result, level);
-                });
-            } catch (err) {
-                var msg = "" + err;
-                results.push(msg);
-                that.set_error_msg(msg);
+            if (commands.length > 3 && commands[3]) {
+                // expand ["ref", index] references to the table of shared values.
+                command_list = that.expand_shared(command_list, commands[3]);
+            }
+            if (that._hidden) {
+                if (!command_list.some(that.must_run, that)) {
+                    that.defer_commands(command_list, buffers);
+                    // acknowledge now: the kernel should not wait for the view to be visible.
+                    that.send_custom_message(that.RESULTS, [command_counter, true]);
+                    var limit = that.model.get("max_deferred_commands");
+                    if (limit && that._deferred.length > limit) {
+                        // too much to keep: run the queue while hidden.
+                        that.catch_up();
+                    }
+                    return Promise.resolve(true);
+                }
+                // the kernel may be waiting: run everything now.
+                that.catch_up();
+            }
+            return that.enqueue_batch(function() {
+                return that.run_batch(command_list, command_counter, level, buffers);
+            });
+        }
+        that.send_custom_message(that.RESULTS, [command_counter, true]);
+        return Promise.resolve(true);
+    },
+
+    enqueue_batch: function(run) {
+        // Run batches in arrival order.  A batch runs immediately unless an earlier
+        // batch is still waiting for an async step, and then it runs after that batch.
+        // run() returns the batch outcome or a Promise for it.
+        var that = this;
+        var queue = that._batch_queue;
+        if (!queue) {
+            var outcome = run();
+            if (!(outcome instanceof Promise)) {
+                return Promise.resolve(outcome);
             }
-            */
+            queue = outcome;
         } else {
-            results.push("no commands sent?");
+            queue = queue.then(run, run);
         }
-        //that.send_custom_message(that.RESULTS, [command_counter, results])
-        // disable sending results for now (not used)
-        that.send_custom_message(that.RESULTS, [command_counter, true])
-        return results;
+        that._batch_queue = queue;
+        var done = function() {
+            if (that._batch_queue === queue) {
+                // no batches are waiting.
+                that._batch_queue = null;
+            }
+        };
+        queue.then(done, done);
+        return queue;
     },
 
-    resume_execute_commands: function(results, command_list, command_counter, level, index) {
-        // resume command execution starting at index
+    run_batch: function(command_list, command_counter, level, buffers) {
+        // Execute the commands in order, waiting for async evaluators (loaders).
+        // Consecutive load_css commands load concurrently.  The RESULTS acknowledgement
+        // reports the completion (or failure) of the batch.
+        // If the frame_budget_ms model value is positive, a batch running longer than the
+        // budget yields to the event loop and continues in the next animation frame.
+        // Returns true or false if the batch completes synchronously, or a Promise.
         var that = this;
-        var evaluator = null;
-        var evaluation_index = index;
-        var command = null;
-        try {
-            for (var i=index; i<command_list.length; i++) {
-                evaluation_index = i;
-                command = command_list[i];
-                var evaluation = that.execute_command(command);
-                evaluator = evaluation.evaluator;
-                var result = evaluation.result;
-                if (evaluator) {
-                    // must evaluate result async and resume later
-                    break;
-                } else {
-                    // store result now and proceed
-                    //results[i] = that.json_safe(result, level);
-                    // disable return results for now.
-                    results[i] = true;
+        var index = 0;
+        var budget = that.model.get("frame_budget_ms") || 0;
+        // hashes of functions compiled from bodies sent with the batch, acknowledged when it completes.
+        var compiled = [];
+        var fail = function(err) {
+            var msg = "" + err;
+            that._batch_functions = null;
+            that.set_error_msg(msg);
+            if (command_counter !== null) {
+                // acknowledge the failed batch too (the kernel uses acknowledgements for flow control).
+                that.send_custom_message(that.RESULTS, [command_counter, false]);
+            }
+            return false;
+        };
+        var step = function() {
+            // run commands until one must be waited for.
+            // message buffers referenced by ["bytes", index] and ["text", index] commands in this batch.
+            that._batch_buffers = buffers || [];
+            // batch number for "result" messages.
+            that._batch_counter = command_counter;
+            that._batch_functions = compiled;
+            var slice_start = (budget > 0) ? that.now() : 0;
+            try {
+                while (index < command_list.length) {
+                    if ((budget > 0) && (that.now() - slice_start >= budget)) {
+                        // let the browser paint and handle events, then continue.
+                        return that.next_frame().then(step, fail);
+                    }
+                    var command = command_list[index];
+                    index++;
+                    var evaluator = that.execute_command(command).evaluator;
+                    if (evaluator) {
+                        var waits = [that.evaluator_promise(evaluator)];
+                        if (command[0] == "load_css") {
+                            while (index < command_list.length && jquery_.isArray(command_list[index]) &&
+                                    command_list[index][0] == "load_css") {
+                                waits.push(that.evaluator_promise(that.execute_command(command_list[index]).evaluator));
+                                index++;
+                            }
+                        }
+                        return Promise.all(waits).then(step, fail);
+                    }
                 }
+            } catch (err) {
+                return fail(err);
             }
-            if (evaluator) {
-                // The evaluation loop has been stopped by an async operation.
-                // evaluate at evaluation_index async and resume later
-                var resolver = function(value_for_command) {
-                    // store the calculated result
-                    results[evaluation_index] = value_for_command;
-                    // continue evaluating any remaining commands, starting at the next command
-                    return that.resume_execute_commands(results, command_list, command_counter, level,
-                        evaluation_index+1)
-                };
-                // call the async evaluator
-                evaluator(resolver);
+            // evaluation complete: acknowledge the batch (deferred commands have no counter).
+            that._batch_functions = null;
+            if (compiled.length > 0) {
+                that.send_custom_message(that.FUNCTIONS_KNOWN, [PAGE_SESSION, compiled]);
+            }
+            if (command_counter !== null) {
+                that.send_custom_message(that.RESULTS, [command_counter, true]);
+            }
+            return true;
+        };
+        var missing = that.missing_functions(command_list);
+        if (missing.length > 0) {
+            // the kernel thinks functions are compiled here: wait for their bodies before running anything.
+            that.send_custom_message(that.FUNCTION_MISS, [PAGE_SESSION, missing]);
+            return new Promise(function(resolve) {
+                that.function_waiters().push(resolve);
+            }).then(step, fail);
+        }
+        return step();
+    },
+
+    missing_functions: function(command_list) {
+        // Hashes of ["cached_function", hash] commands in the batch with no compiled function in the page.
+        var missing = [];
+        var data_indicators = {"id": true, "callback": true, "bytes": true, "text": true, "ndarray": true};
+        var scan = function(command) {
+            if (!jquery_.isArray(command) || command.length == 0) {
+                return;
+            }
+            var indicator = command[0];
+            if (indicator == "cached_function") {
+                var hash = command[1];
+                if ((command.length < 4) && !FUNCTION_CACHE[hash] && (missing.indexOf(hash) < 0)) {
+                    missing.push(hash);
+                }
+            } else if (indicator == "dict") {
+                var desc = command[1];
+                for (var key in desc) {
+                    scan(desc[key]);
+                }
+            } else if (!data_indicators[indicator]) {
+                for (var i=1; i<command.length; i++) {
+                    scan(command[i]);
+                }
+            }
+        };
+        command_list.forEach(scan);
+        return missing;
+    },
+
+    function_waiters: function() {
+        // Resume functions for batches waiting for function bodies.
+        var waiters = this._function_waiters;
+        if (!waiters) {
+            waiters = this._function_waiters = [];
+        }
+        return waiters;
+    },
+
+    define_functions: function(bodies) {
+        // Compile the [hash, argnames, body] functions sent after a miss and resume the waiting batches.
+        var that = this;
+        var hashes = [];
+        bodies.forEach(function(item) {
+            var hash = item[0];
+            if (!FUNCTION_CACHE[hash]) {
+                FUNCTION_CACHE[hash] = new Function(item[1], that.evaluate(item[2], []));
+            }
+            hashes.push(hash);
+        });
+        that.send_custom_message(that.FUNCTIONS_KNOWN, [PAGE_SESSION, hashes]);
+        var waiters = that.function_waiters().splice(0);
+        waiters.forEach(function(resume) {
+            resume();
+        });
+    },
+
+    now: function() {
+        return (typeof performance != "undefined") ? performance.now() : Date.now();
+    },
+
+    next_frame: function() {
+        // Promise resolved in the next animation frame, so DOM changes made by the
+        // following commands are grouped into that frame.  Hidden pages get no
+        // animation frames: use a timeout instead.
+        return new Promise(function(resolve) {
+            if ((typeof requestAnimationFrame != "undefined") &&
+                    !((typeof document != "undefined") && document.hidden)) {
+                requestAnimationFrame(function() { resolve(); });
             } else {
-                // evaluation complete: send results
-                // cl(command_counter + " execute commands done " + results.length);
-                //that.send_custom_message(that.RESULTS, [command_counter, results])
-                // disable sending results for now (not used)
-                that.send_custom_message(that.RESULTS, [command_counter, true]) 
-                return results
+                setTimeout(resolve, 0);
             }
-        } catch (err) {
-            var msg = "" + err;
-            results.push(msg);
-            that.set_error_msg(msg);
+        });
+    },
+
+    evaluator_promise: function(evaluator) {
+        // Promise for the value an evaluator(resolver) passes to its resolver.
+        return new Promise(function(resolve) {
+            evaluator(resolve);
+        });
+    },
+
+    expand_shared: function(command_list, table) {
+        // Replace ["ref", index] references with the shared values in table.
+        // Each table entry is expanded once and may refer to earlier entries.
+        var expanded = [];
+        var expand = function(command) {
+            if (!jquery_.isArray(command) || command.length == 0) {
+                return command;
+            }
+            var indicator = command[0];
+            if (indicator == "ref") {
+                return expanded[command[1]];
+            }
+            if (indicator == "id" || indicator == "callback") {
+                // untranslated data is never shared.
+                return command;
+            }
+            var result = [indicator];
+            for (var i=1; i<command.length; i++) {
+                var item = command[i];
+                if (indicator == "dict" && i == 1) {
+                    var mapping = {};
+                    for (var key in item) {
+                        mapping[key] = expand(item[key]);
+                    }
+                    item = mapping;
+                } else {
+                    item = expand(item);
+                }
+                result.push(item);
+            }
+            return result;
+        };
+        for (var j=0; j<table.length; j++) {
+            expanded.push(expand(table[j]));
         }
+        var result = [];
+        for (var k=0; k<command_list.length; k++) {
+            result.push(expand(command_list[k]));
+        }
+        return result;
     },
 
-    send_custom_message: function(indicator, payload) {
+    send_custom_message: function(indicator, payload, buffers) {
         var that = this;
-        message = {};
+        var message = {};
         message[that.INDICATOR] = indicator;
         message[that.PAYLOAD] = payload;
-        that.model.send(message)
+        var send = function() {
+            if ((buffers) && (buffers.length > 0)) {
+                that.model.send(message, null, buffers);
+            } else {
+                that.model.send(message);
+            }
+        };
+        if (that._outgoing) {
+            // wait for compressed messages sent earlier.
+            that.queue_outgoing(send);
+        } else {
+            send();
+        }
+    },
+
+    compression_enabled: function() {
+        var model = this.model;
+        return model.get("compression_accepted") && (model.get("compression_threshold") > 0);
+    },
+
+    send_compressed_segments: function(indicator, fragments, segmented, buffers, stream) {
+        // Deflate the JSON fragments as a stream and send the compressed bytes in cz_fragment
+        // messages of segmented bytes, with the rest in a final compressed message.
+        var that = this;
+        stream = stream || null;
+        var send = function(indicator, payload, buffers) {
+            var message = {};
+            message[that.INDICATOR] = indicator;
+            message[that.PAYLOAD] = payload;
+            that.model.send(message, null, buffers);
+        };
+        that.queue_outgoing(function() {
+            var compressor = new CompressionStream("deflate");
+            var writer = compressor.writable.getWriter();
+            var reader = compressor.readable.getReader();
+            var encoder = new TextEncoder();
+            var feed = function() {
+                // write about segmented characters at a time while the compressor keeps up.
+                return writer.ready.then(function() {
+                    var chunk = [];
+                    var length = 0;
+                    while (length < segmented) {
+                        var next = fragments.next();
+                        if (next.done) {
+                            writer.write(encoder.encode(chunk.join("")));
+                            return writer.close();
+                        }
+                        chunk.push(next.value);
+                        length += next.value.length;
+                    }
+                    writer.write(encoder.encode(chunk.join("")));
+                    return feed();
+                });
+            };
+            var pending = new Uint8Array(0);
+            var drain = function() {
+                return reader.read().then(function(result) {
+                    if (result.done) {
+                        send(that.COMPRESSED, [indicator, stream], (buffers || []).concat([pending]));
+                        return;
+                    }
+                    var joined = new Uint8Array(pending.length + result.value.length);
+                    joined.set(pending);
+                    joined.set(result.value, pending.length);
+                    var cursor = 0;
+                    while (joined.length - cursor > segmented) {
+                        send(that.COMPRESSED_FRAGMENT, stream, [joined.slice(cursor, cursor + segmented)]);
+                        cursor += segmented;
+                    }
+                    pending = joined.slice(cursor);
+                    return drain();
+                });
+            };
+            return Promise.all([feed(), drain()]);
+        });
+    },
+
+    queue_outgoing: function(task) {
+        // Send messages in order while compression is in progress.
+        var that = this;
+        var chain = (that._outgoing || Promise.resolve()).then(task).catch(function(err) {
+            that.set_error_msg("" + err);
+        });
+        that._outgoing = chain;
+        chain.then(function() {
+            if (that._outgoing === chain) {
+                that._outgoing = null;
+            }
+        });
+    },
+
+    message_bytes: function(buffer) {
+        // The bytes of a message buffer as a Uint8Array.
+        return (buffer instanceof ArrayBuffer) ?
+            new Uint8Array(buffer) : new Uint8Array(buffer.buffer, buffer.byteOffset, buffer.byteLength);
+    },
+
+    inflate: function(buffer) {
+        // Promise of the string decompressed from a deflate compressed UTF-8 message buffer.
+        var stream = new Blob([this.message_bytes(buffer)]).stream().pipeThrough(new DecompressionStream("deflate"));
+        return new Response(stream).text();
+    },
+
+    inflater: function(stream) {
+        // The decompressor for the cz_fragment messages of a stream tag: {writer, text}
+        // where text is a promise of the decompressed string after the writer is closed.
+        var inflaters = this._inflaters;
+        if (!inflaters) {
+            inflaters = this._inflaters = {};
+        }
+        var key = JSON.stringify(stream);
+        var result = inflaters[key];
+        if (!result) {
+            var decompressor = new DecompressionStream("deflate");
+            result = inflaters[key] = {
+                writer: decompressor.writable.getWriter(),
+                text: new Response(decompressor.readable).text(),
+            };
+        }
+        return result;
     },
 
     handle_custom_message: function(content, buffers, widget) {
+        var that = this;
+        var indicator = content[that.INDICATOR];
+        var compressed = (indicator == that.COMPRESSED) || (indicator == that.COMPRESSED_FRAGMENT);
+        if (!compressed && !that._incoming) {
+            return that.dispatch_custom_message(content, buffers, widget);
+        }
+        // handle messages in order while compressed messages are decompressed.
+        var chain = (that._incoming || Promise.resolve()).then(function() {
+            var payload = content[that.PAYLOAD];
+            if (!compressed) {
+                return that.dispatch_custom_message(content, buffers, widget);
+            }
+            if (indicator == that.COMPRESSED_FRAGMENT) {
+                that.inflater(payload).writer.write(that.message_bytes(buffers[0]));
+                return;
+            }
+            var last = buffers.length - 1;
+            var text;
+            if (Array.isArray(payload)) {
+                // the last compressed bytes of a segmented stream.
+                var inflater = that.inflater(payload[1]);
+                delete that._inflaters[JSON.stringify(payload[1])];
+                inflater.writer.write(that.message_bytes(buffers[last]));
+                inflater.writer.close();
+                text = inflater.text;
+                payload = payload[0];
+            } else {
+                text = that.inflate(buffers[last]);
+            }
+            return text.then(function(text) {
+                var message = {};
+                message[that.INDICATOR] = payload;
+                message[that.PAYLOAD] = JSON.parse(text);
+                return that.dispatch_custom_message(message, buffers.slice(0, last), widget);
+            });
+        }).catch(function(err) {
+            that.set_error_msg("" + err);
+        });
+        that._incoming = chain;
+        chain.then(function() {
+            if (that._incoming === chain) {
+                that._incoming = null;
+            }
+        });
+    },
+
+    dispatch_custom_message: function(content, buffers, widget) {
         var that = this;
         var indicator = content[that.INDICATOR];
         var payload = content[that.PAYLOAD];
         if (indicator == that.COMMANDS) {
             that._json_accumulator = [];
-            that.execute_commands(payload);
+            that.execute_commands(payload, buffers);
         } else if (indicator == that.COMMANDS_FRAGMENT) {
             that._json_accumulator.push(payload);
         } else if (indicator == that.COMMANDS_FINAL) {
@@ -373,121 +999,377 @@ var JSProxyView = widgets.DOMWidgetView.extend({
             acc.push(payload);
             var json_str = acc.join("");
             var commands = JSON.parse(json_str);
-            that.execute_commands(commands);
+            that.execute_commands(commands, buffers);
+        } else if (indicator == that.FUNCTION_BODIES) {
+            that.define_functions(payload);
+        } else if (indicator == that.BINARY_COMMANDS) {
+            // the binary encoded payload follows the message buffers referenced by the commands.
+            var last = buffers.length - 1;
+            var decoded = that.decode_binary_commands(buffers[last]);
+            that.execute_commands(decoded, buffers.slice(0, last));
         } else {
             var msg = "invalid custom message indicator " + indicator;
             that.set_error_msg(msg);
         }
     },
 
-    execute_command_result: function(command) {
+    get_template: function(identifier) {
+        // Return the compiled closure for a command template, compiling it on first use.
+        var that = this;
+        var templates = that.model.command_templates || {};
+        var template = templates[identifier];
+        if (!template) {
+            throw new Error("Unknown command template " + identifier);
+        }
+        var compiled = that.compiled_templates = that.compiled_templates || {};
+        var entry = compiled[identifier];
+        if (!entry || entry.template !== template) {
+            entry = compiled[identifier] = {template: template, run: that.compile_command(template)};
+        }
+        return entry.run;
+    },
+
+    execute_command_result: function(command, params) {
         // execute the command and ignore the evaluator if provided
-        return this.execute_command(command).result;
+        return this.evaluate(command, params);
     },
 
     execute_command: function(command) {
-        var that = this;
-        var result = command;
         // evaluator, if set is a function evaluator(resolver)
         //   which promises to eventually call resolver(value_for_command)
         //   perhaps after a few event loop iterations...
         // evaluator is ignored except at the top level evaluation loop
         //   where it takes precedence over the result.
-        var evaluator = null;
+        var that = this;
         if (jquery_.isArray(command)) {
             var indicator = command[0];
-            var remainder = command.slice();
-            remainder.shift();
-            if (indicator == "element") {
-                // Make sure the element is wrapped as a proper JQuery(UI) object
-                //if (!that.$$el) {
-                //    that.$$el = $(that.$el);
-                //}
-                result = that.$$el;
-            } else if (indicator == "window") {
-                result = window;
-            } else if (indicator == "method") {
-                var target_desc = remainder.shift();
-                var target = that.execute_command_result(target_desc);
-                var name = remainder.shift();
-                // cl("method call " + target + "." + name);
-                var method = target[name];
-                if (method) {
-                    var args = remainder.map(that.execute_command_result, that);
-                    result = method.apply(target, args);
-                } else {
-                    result = "In " + target + " no such method " + name;
-                    that.set_error_msg(result);
+            if (indicator == "load_css") {
+                var css_text = that.evaluate(command[2]);
+                return {result: "load_css_async", evaluator: that.load_css_async(command[1], css_text)};
+            } else if (indicator == "load_js") {
+                var js_text = that.evaluate(command[2]);
+                return {result: "load_javascript_async", evaluator: that.load_js_async(command[1], js_text)};
+            }
+        }
+        return {result: that.evaluate(command), evaluator: null};
+    },
+
+    evaluate_from: function(command, start, params) {
+        // Evaluate command[start:] into a new array.
+        var n = command.length - start;
+        var values = new Array(n > 0 ? n : 0);
+        for (var i=0; i<n; i++) {
+            values[i] = this.evaluate(command[start + i], params);
+        }
+        return values;
+    },
+
+    evaluate: function(command, params) {
+        // Evaluate a command tree in place (without copying argument arrays).
+        // params holds the values for ["hole", index] in templates.
+        var that = this;
+        if (!jquery_.isArray(command)) {
+            // untranslated values evaluate to themselves.
+            return command;
+        }
+        var indicator = command[0];
+        switch (indicator) {
+        case "element":
+            return that.$$el;
+        case "window":
+            return window;
+        case "method":
+            var target = that.evaluate(command[1], params);
+            var name = command[2];
+            var method = target[name];
+            if (method) {
+                return method.apply(target, that.evaluate_from(command, 3, params));
+            }
+            var msg = "In " + target + " no such method " + name;
+            that.set_error_msg(msg);
+            return msg;
+        case "function":
+            var function_value = that.evaluate(command[1], params);
+            // Use "that" as the "this" value for function values.
+            return function_value.apply(that, that.evaluate_from(command, 2, params));
+        case "get":
+            var target = that.evaluate(command[1], params);
+            var name = that.evaluate(command[2], params);
+            try {
+                return target[name];
+            } catch(err) {
+                var msg = "failed to get " + name + " from " + target + " :: " + err;
+                that.set_error_msg(msg);
+                return msg;
+            }
+        case "set":
+            var target = that.evaluate(command[1], params);
+            target[that.evaluate(command[2], params)] = that.evaluate(command[3], params);
+            return target;
+        case "null":
+            that.evaluate(command[1], params);
+            return null;
+        case "id":
+            return command[1];
+        case "list":
+            return that.evaluate_from(command, 1, params);
+        case "dict":
+            var result = {};
+            var desc = command[1];
+            for (var key in desc) {
+                result[key] = that.evaluate(desc[key], params);
+            }
+            return result;
+        case "callback":
+            // sanity check the level
+            return that.callback_factory(command[1], command[2], that.check_level(command[3]), command[4]);
+        case "hole":
+            return params[command[1]];
+        case "cached_function":
+            var hash = that.evaluate(command[1], params);
+            var result = FUNCTION_CACHE[hash];
+            if (!result) {
+                if (command.length < 4) {
+                    // the kernel thinks the function is compiled here: make it send the body next time.
+                    that.send_custom_message(that.FUNCTION_MISS, [PAGE_SESSION, [hash]]);
+                    throw new Error("no compiled function for hash " + hash);
                 }
-            } else if (indicator == "function") {
-                var function_desc = remainder.shift();
-                var function_value = that.execute_command_result(function_desc);
-                var args = remainder.map(that.execute_command_result, that);
-                // Use "that" as the "this" value for function values?
-                result = function_value.apply(that, args);
-            } else if (indicator == "id") {
-                result = remainder[0];
-            } else if (indicator == "list") {
-                result = remainder.map(that.execute_command_result, that);
-            } else if (indicator == "dict") {
-                result = {}
-                var desc = remainder[0];
-                for (var key in desc) {
-                    var key_desc = desc[key];
-                    var val = that.execute_command_result(key_desc);
-                    result[key] = val;
+                var argnames = that.evaluate(command[2], params);
+                result = FUNCTION_CACHE[hash] = new Function(argnames, that.evaluate(command[3], params));
+            }
+            if ((command.length >= 4) && that._batch_functions) {
+                that._batch_functions.push(hash);
+            }
+            return result;
+        case "evaluate":
+            that.send_evaluation(command[1], command[2], command[3], params);
+            return null;
+        case "evaluate_many":
+            that.send_evaluations(command[1], command[2], command[3][1], params);
+            return null;
+        case "handle_set":
+            var stored = that.evaluate(command[2], params);
+            that.handle_table()[command[1]] = stored;
+            return stored;
+        case "handle":
+            var table = that.handle_table();
+            if (!(command[1] in table)) {
+                throw new Error("no value for handle " + command[1]);
+            }
+            return table[command[1]];
+        case "handle_release":
+            that.release_handles(command);
+            return null;
+        case "forget_callbacks":
+            that.forget_callbacks(command);
+            return null;
+        case "result":
+            var value = that.evaluate(command[3], params);
+            that.send_result(command[1], command[2], value);
+            return value;
+        case "template_define":
+            // definitions are kept on the model so views rendered later can compile them.
+            var templates = that.model.command_templates = that.model.command_templates || {};
+            templates[command[1]] = command[2];
+            return command[1];
+        case "template_call":
+            return that.get_template(command[1])(that.evaluate(command[2], params));
+        case "bytes":
+            var data = command[1];
+            if ((typeof data) == "number") {
+                return that.buffer_bytes(data);
+            }
+            return that.from_hex(data);
+        case "text":
+            return that.buffer_text(command[1]);
+        case "ndarray":
+            return that.typed_array(that.evaluate(command[3], params), command[1], command[2]);
+        case "load_css":
+        case "load_js":
+            // nested loaders are not waited for.
+            return that.execute_command(command).result;
+        }
+        var msg = "Unknown command indicator " + indicator;
+        that.set_error_msg(msg);
+        return msg;
+    },
+
+    send_evaluation: function(identifier, level, command, params) {
+        // Evaluate the command and send [identifier, ok, value] to the kernel at once.
+        // Failures are reported in the reply and do not stop the batch.
+        var that = this;
+        var buffers = that.result_buffers();
+        var reply = that.evaluate_captured(command, level, params, buffers);
+        that.send_custom_message(that.EVALUATED, [identifier, reply[0], reply[1]], buffers);
+    },
+
+    send_evaluations: function(identifier, level, commands, params) {
+        // Evaluate each command of {name: command} separately and send
+        // [identifier, true, {name: [ok, value]}] to the kernel in one message.
+        var that = this;
+        var buffers = that.result_buffers();
+        var replies = {};
+        for (var name in commands) {
+            replies[name] = that.evaluate_captured(commands[name], level, params, buffers);
+        }
+        that.send_custom_message(that.EVALUATED, [identifier, true, replies], buffers);
+    },
+
+    handle_table: function() {
+        // Values stored for JSHandles in the kernel: {handle: value}.
+        // The table is kept on the model so views rendered later can use the handles.
+        var model = this.model;
+        var table = model.handle_table;
+        if (!table) {
+            table = model.handle_table = {};
+        }
+        return table;
+    },
+
+    release_handles: function(command) {
+        // ["handle_release", handle, ...]: the kernel has no more JSHandles for the handles.
+        var table = this.handle_table();
+        for (var i=1; i<command.length; i++) {
+            delete table[command[i]];
+        }
+    },
+
+    send_result: function(key, level, value) {
+        // Send [batch_counter, key, value] to the stream callback of the running batch.
+        var that = this;
+        var counter = that._batch_counter;
+        if (counter === null || counter === undefined) {
+            // deferred batches are acknowledged already.
+            return;
+        }
+        var buffers = that.result_buffers();
+        var payload = [counter, key, that.json_safe(value, level, buffers)];
+        that.send_custom_message(that.RESULT, payload, buffers);
+    },
+
+    evaluate_captured: function(command, level, params, buffers) {
+        // Evaluate the command and return [true, json_safe_value] or [false, error_message].
+        var that = this;
+        var saved_error = that.error_msg;
+        that.error_msg = null;
+        var ok = true;
+        var value;
+        try {
+            value = that.evaluate(command, params);
+            // commands report some failures as error messages instead of exceptions.
+            ok = (that.error_msg === null) || (that.error_msg !== value);
+        } catch (err) {
+            ok = false;
+            value = "" + err;
+        }
+        if (that.error_msg === null) {
+            that.error_msg = saved_error;
+        }
+        return [ok, ok ? that.json_safe(value, level, buffers) : value];
+    },
+
+    compile_command: function(command) {
+        // Compile a command tree which is run repeatedly (a template) into a closure run(params).
+        // Subtrees without holes are compiled too: the closures do not dispatch on
+        // indicators or allocate argument arrays beyond those passed to calls.
+        var that = this;
+        if (!jquery_.isArray(command)) {
+            // untranslated values evaluate to themselves.
+            return function() { return command; };
+        }
+        var compile = function(c) { return that.compile_command(c); };
+        var run_all = function(closures, params) {
+            var n = closures.length;
+            var values = new Array(n);
+            for (var i=0; i<n; i++) {
+                values[i] = closures[i](params);
+            }
+            return values;
+        };
+        var compile_rest = function(start) {
+            var closures = [];
+            for (var i=start; i<command.length; i++) {
+                closures.push(compile(command[i]));
+            }
+            return closures;
+        };
+        var indicator = command[0];
+        if (indicator == "element") {
+            return function() { return that.$$el; };
+        } else if (indicator == "window") {
+            return function() { return window; };
+        } else if (indicator == "method") {
+            var target = compile(command[1]);
+            var name = command[2];
+            var args = compile_rest(3);
+            return function(params) {
+                var target_value = target(params);
+                var method = target_value[name];
+                if (method) {
+                    return method.apply(target_value, run_all(args, params));
                 }
-            } else if (indicator == "callback") {
-                var identifier = remainder.shift();
-                var data = remainder.shift();
-                var level = remainder.shift();
-                var segmented = remainder.shift();
-                // sanity check
-                level = that.check_level(level);
-                result = that.callback_factory(identifier, data, level, segmented);
-            } else if (indicator == "get") {
-                var target_desc = remainder.shift();
-                var target = that.execute_command_result(target_desc);
-                var name = remainder.shift();
+                var msg = "In " + target_value + " no such method " + name;
+                that.set_error_msg(msg);
+                return msg;
+            };
+        } else if (indicator == "function") {
+            var func = compile(command[1]);
+            var args = compile_rest(2);
+            return function(params) {
+                return func(params).apply(that, run_all(args, params));
+            };
+        } else if (indicator == "get") {
+            var target = compile(command[1]);
+            var name = compile(command[2]);
+            return function(params) {
+                var target_value = target(params);
+                var name_value = name(params);
                 try {
-                    result = target[name];
+                    return target_value[name_value];
                 } catch(err) {
-                    result = "failed to get "+name+" from "+target+" :: "+err;
-                    that.set_error_msg(result);
+                    var msg = "failed to get " + name_value + " from " + target_value + " :: " + err;
+                    that.set_error_msg(msg);
+                    return msg;
                 }
-            } else if (indicator == "set") {
-                var target_desc = remainder.shift();
-                var target = that.execute_command_result(target_desc);
-                var name = remainder.shift();
-                var value_desc = remainder.shift()
-                var value = that.execute_command_result(value_desc);
-                target[name] = value;
-                result = target;
-            } else if (indicator == "null") {
-                target_desc = remainder.shift();
-                that.execute_command_result(target_desc);
-                result = null;
-            } else if (indicator == "load_css") {
-                result = "load_css_async";
-                css_name = remainder.shift();
-                css_text = remainder.shift();
-                evaluator = that.load_css_async(css_name, css_text);
-            } else if (indicator == "load_js") {
-                result = "load_javascript_async";
-                js_name = remainder.shift();
-                js_text = remainder.shift();
-                evaluator = that.load_js_async(js_name, js_text);
-            } else if (indicator == "bytes") {
-                var hexstr = remainder[0];
-                result = that.from_hex(hexstr);
-            } else {
-                var msg = "Unknown command indicator " + indicator;
-                result = msg;
-                that.set_error_msg(msg);
-            }
+            };
+        } else if (indicator == "set") {
+            var target = compile(command[1]);
+            var name = compile(command[2]);
+            var value = compile(command[3]);
+            return function(params) {
+                var target_value = target(params);
+                target_value[name(params)] = value(params);
+                return target_value;
+            };
+        } else if (indicator == "null") {
+            var target = compile(command[1]);
+            return function(params) {
+                target(params);
+                return null;
+            };
+        } else if (indicator == "id") {
+            var data = command[1];
+            return function() { return data; };
+        } else if (indicator == "list") {
+            var items = compile_rest(1);
+            return function(params) { return run_all(items, params); };
+        } else if (indicator == "dict") {
+            var desc = command[1];
+            var keys = Object.keys(desc);
+            var values = keys.map(function(key) { return compile(desc[key]); });
+            return function(params) {
+                var result = {};
+                for (var i=0; i<keys.length; i++) {
+                    result[keys[i]] = values[i](params);
+                }
+                return result;
+            };
+        } else if (indicator == "hole") {
+            var index = command[1];
+            return function(params) { return params[index]; };
         }
-        //return result;
-        return {result: result, evaluator: evaluator};
+        // other commands are rare in templates: interpret them.
+        return function(params) { return that.evaluate(command, params); };
     },
 
     load_css_async: function(css_name, css_text) {
@@ -628,50 +1510,287 @@ var JSProxyView = widgets.DOMWidgetView.extend({
     callback_factory: function(identifier, data, level, segmented) {
         // create a callback which sends a message back to the Jupyter Kernel
         var that = this;
+        // Handlers find their data in the callback table, so forgetting the identifier drops it.
         // Counter makes sure change is noticed even if other arguments don't change.
-        var counter = 0;
+        var callbacks = that.callback_table();
+        var entry = callbacks[identifier];
+        if (!entry) {
+            entry = callbacks[identifier] = {data: data, level: level, segmented: segmented, counter: 0};
+        }
         var handler = function () {
-            counter += 1;
-            var payload = that.json_safe([identifier, data, arguments, counter], level + 1);
+            var entry = callbacks[identifier];
+            if (!entry) {
+                // the kernel forgot the callback.
+                return;
+            }
+            entry.counter += 1;
+            var counter = entry.counter;
+            var segmented = entry.segmented;
+            var buffers = that.result_buffers();
+            var payload = that.json_safe([identifier, entry.data, arguments, counter], entry.level + 1, buffers);
             //that.model.set("callback_results", payload);
             //that.touch();
             if ((segmented) && (segmented > 0)) {
-                that.send_segmented_message(that.JSON_CB_FRAGMENT, that.JSON_CB_FINAL, payload, segmented);
+                // tag the segments with a stream identifier so concurrent streams can be reassembled.
+                var stream = [that.view_identifier(), identifier, counter];
+                that.send_segmented_message(that.JSON_CB_FRAGMENT, that.JSON_CB_FINAL, payload, segmented, buffers, stream);
             } else {
-                that.send_custom_message("callback_results", payload);
+                that.send_custom_message("callback_results", payload, buffers);
             }
         };
         return handler;
     },
 
-    send_segmented_message(frag_indicator, final_indicator, payload, segmented) {
+    view_identifier: function() {
+        // Identifier for this view, unique in the kernel: callback invocation counters are per view.
+        if (!this._view_identifier) {
+            VIEW_COUNT += 1;
+            this._view_identifier = PAGE_SESSION + "/" + VIEW_COUNT;
+        }
+        return this._view_identifier;
+    },
+
+    callback_table: function() {
+        // Live callbacks by identifier: {identifier: {data, level, segmented, counter}}.
+        var table = this._callbacks;
+        if (!table) {
+            table = this._callbacks = {};
+        }
+        return table;
+    },
+
+    forget_callbacks: function(command) {
+        // ["forget_callbacks", identifier, ...]: handlers for the identifiers stop sending messages.
+        var table = this.callback_table();
+        for (var i=1; i<command.length; i++) {
+            delete table[command[i]];
+        }
+    },
+
+    send_segmented_message(frag_indicator, final_indicator, payload, segmented, buffers, stream) {
+        // Send the JSON encoding of the payload in segments, generating the JSON incrementally
+        // so the whole JSON string is never held in memory at once.
+        // If stream is provided each segment is sent as stream.concat([segment]).
         var that = this;
-        var json_str = JSON.stringify(payload);
-        var json_len = json_str.length;
+        var tag = function(segment) {
+            if (stream) {
+                return stream.concat([segment]);
+            }
+            return segment;
+        };
+        var fragments = that.json_fragments(payload, segmented);
+        var indicator = that.UNSEGMENTED_INDICATORS[final_indicator];
+        if (indicator && that.compression_enabled()) {
+            // Compress the payload instead of sending JSON segments if it is large enough.
+            // Uncompressed fragments are kept only until the size reaches the threshold.
+            var held = [];
+            var length = 0;
+            var threshold = that.model.get("compression_threshold");
+            for (var next = fragments.next(); !next.done; next = fragments.next()) {
+                held.push(next.value);
+                length += next.value.length;
+                if (length >= threshold) {
+                    var rest = fragments;
+                    fragments = (function*() {
+                        yield* held;
+                        yield* rest;
+                    })();
+                    return that.send_compressed_segments(indicator, fragments, segmented, buffers, stream);
+                }
+            }
+            fragments = held;
+        }
+        var pending = [];
+        var pending_length = 0;
+        var add_fragment = function(fragment) {
+            pending.push(fragment);
+            pending_length += fragment.length;
+            if (pending_length > segmented) {
+                var text = pending.join("");
+                var cursor = 0;
+                while (text.length - cursor > segmented) {
+                    that.send_custom_message(frag_indicator, tag(text.substring(cursor, cursor + segmented)));
+                    cursor += segmented;
+                }
+                var tail = text.substring(cursor);
+                pending = [tail];
+                pending_length = tail.length;
+            }
+        };
+        for (var fragment of fragments) {
+            add_fragment(fragment);
+        }
+        // message buffers are sent with the final fragment.
+        that.send_custom_message(final_indicator, tag(pending.join("")), buffers);
+    },
+
+    json_fragments: function*(value, chunk_size) {
+        // Generate successive fragments of JSON.stringify(value).
+        // Strings longer than chunk_size are encoded in pieces of chunk_size characters.
+        var that = this;
+        if ((typeof value) == "string") {
+            if (value.length <= chunk_size) {
+                yield JSON.stringify(value);
+            } else {
+                yield '"';
+                for (var start=0; start<value.length; start+=chunk_size) {
+                    var piece = JSON.stringify(value.substring(start, start + chunk_size));
+                    yield piece.substring(1, piece.length - 1);
+                }
+                yield '"';
+            }
+        } else if (Array.isArray(value)) {
+            yield "[";
+            for (var i=0; i<value.length; i++) {
+                if (i > 0) {
+                    yield ",";
+                }
+                var item = value[i];
+                if ((item === undefined) || ((typeof item) == "function")) {
+                    item = null;
+                }
+                yield* that.json_fragments(item, chunk_size);
+            }
+            yield "]";
+        } else if ((value !== null) && ((typeof value) == "object") && (!value.toJSON)) {
+            yield "{";
+            var first = true;
+            for (var key in value) {
+                var member = value[key];
+                if ((!value.hasOwnProperty(key)) || (member === undefined) || ((typeof member) == "function")) {
+                    continue;
+                }
+                if (!first) {
+                    yield ",";
+                }
+                first = false;
+                yield JSON.stringify(key) + ":";
+                yield* that.json_fragments(member, chunk_size);
+            }
+            yield "}";
+        } else {
+            yield JSON.stringify(value);
+        }
+    },
+
+    decode_binary_commands: function(buffer) {
+        // Decode a binary command payload (see jp_proxy_widget/binary_commands.py).
+        var view = (buffer instanceof ArrayBuffer) ?
+            new DataView(buffer) : new DataView(buffer.buffer, buffer.byteOffset, buffer.byteLength);
+        var bytes = new Uint8Array(view.buffer, view.byteOffset, view.byteLength);
+        var decoder = new TextDecoder("utf-8");
         var cursor = 0;
-        while ((cursor + segmented) < json_len) {
-            var next_cursor = cursor + segmented;
-            var fragment = json_str.substring(cursor, next_cursor);
-            cursor = next_cursor;
-            that.send_custom_message(frag_indicator, fragment);
+        var text = function() {
+            var length = view.getUint32(cursor, true);
+            cursor += 4;
+            var result = decoder.decode(bytes.subarray(cursor, cursor + length));
+            cursor += length;
+            return result;
+        };
+        var decode = function() {
+            var tag = view.getUint8(cursor);
+            cursor += 1;
+            var result, count, i;
+            switch (tag) {
+                case 0: return null;
+                case 1: return false;
+                case 2: return true;
+                case 3:
+                    result = view.getInt32(cursor, true);
+                    cursor += 4;
+                    return result;
+                case 4:
+                    result = view.getFloat64(cursor, true);
+                    cursor += 8;
+                    return result;
+                case 5: return text();
+                case 6:
+                case 8:
+                    if (tag == 8) {
+                        result = [BINARY_OPCODES[view.getUint8(cursor)]];
+                        cursor += 1;
+                    } else {
+                        result = [];
+                    }
+                    count = view.getUint32(cursor, true);
+                    cursor += 4;
+                    for (i=0; i<count; i++) {
+                        result.push(decode());
+                    }
+                    return result;
+                case 7:
+                    result = {};
+                    count = view.getUint32(cursor, true);
+                    cursor += 4;
+                    for (i=0; i<count; i++) {
+                        var key = text();
+                        result[key] = decode();
+                    }
+                    return result;
+            }
+            throw "bad binary command tag " + tag + " at " + (cursor - 1);
+        };
+        return decode();
+    },
+
+    buffer_bytes: function(index) {
+        // Uint8Array view of a message buffer for the current batch (no copy).
+        var buffer = this._batch_buffers[index];
+        if (buffer === undefined) {
+            throw "no message buffer at index " + index;
+        }
+        if (buffer instanceof ArrayBuffer) {
+            return new Uint8Array(buffer);
+        }
+        return new Uint8Array(buffer.buffer, buffer.byteOffset, buffer.byteLength);
+    },
+
+    buffer_text: function(index) {
+        // decode a UTF-8 message buffer for the current batch as a string.
+        return new TextDecoder("utf-8").decode(this.buffer_bytes(index));
+    },
+
+    // typed array constructors for numpy dtype strings without the byte order character.
+    TYPED_ARRAYS: {
+        "b1": Uint8Array,
+        "i1": Int8Array,
+        "u1": Uint8Array,
+        "i2": Int16Array,
+        "u2": Uint16Array,
+        "i4": Int32Array,
+        "u4": Uint32Array,
+        // the kernel sends 64 bit integer arrays only if they are wrapped by bigint_array.
+        "i8": (typeof BigInt64Array != "undefined") ? BigInt64Array : null,
+        "u8": (typeof BigUint64Array != "undefined") ? BigUint64Array : null,
+        "f4": Float32Array,
+        "f8": Float64Array,
+    },
+
+    typed_array: function(bytes, dtype, shape) {
+        // View the Uint8Array bytes as a typed array matching the little endian numpy dtype.
+        var constructor = this.TYPED_ARRAYS[dtype.substring(1)];
+        if (!constructor) {
+            throw "no typed array for dtype " + dtype;
+        }
+        var size = constructor.BYTES_PER_ELEMENT;
+        if ((bytes.byteOffset % size) != 0) {
+            // typed array views must be aligned: copy.
+            bytes = bytes.slice();
         }
-        //var tail = json_str.substring(cursor, json_len);
-        //that.send_custom_message(final_indicator, tail);
-        that.send_custom_message(final_indicator, true);  // disable command results for now (not used)
+        var result = new constructor(bytes.buffer, bytes.byteOffset, bytes.byteLength / size);
+        result.dtype = dtype;
+        result.shape = shape;
+        return result;
     },
 
     to_hex: function(int8) {
+        // look up the two hex character codes for each byte and decode them all at once.
         var length = int8.length;
-        var hex_array = Array(length);
+        var codes = new Uint16Array(length);
         for (var i=0; i<length; i++) {
-            var b = int8[i];
-            var h = b.toString(16);
-            if (h.length==1) {
-                h = "0" + h
-            }
-            hex_array[i] = h;
+            codes[i] = HEX_CODES[int8[i]];
         }
-        return hex_array.join("");
+        return new TextDecoder("ascii").decode(codes);
     },
 
     from_hex: function(hexstr) {
@@ -683,20 +1802,77 @@ var JSProxyView = widgets.DOMWidgetView.extend({
         var result = new Uint8Array(length);
         for (var i=0; i<length; i++) {
             var i2 = 2 * i;
-            var h = hexstr.substring(i2, i2+2);
-            var b = parseInt(h, 16);
-            result[i] = b;
+            var high = HEX_VALUES[hexstr.charCodeAt(i2)];
+            var low = HEX_VALUES[hexstr.charCodeAt(i2 + 1)];
+            if ((high === undefined) || (low === undefined) || (high > 15) || (low > 15)) {
+                throw "invalid hex string at " + i2;
+            }
+            result[i] = (high << 4) | low;
         }
         return result;
     },
 
-    json_safe: function(val, depth) {
+    // Marker for binary values sent as message buffers: {BUFFER_REFERENCE: [buffer_index, dtype]}
+    BUFFER_REFERENCE: "__jp_proxy_buffer__",
+
+    result_buffers: function() {
+        // Return an array to collect binary values sent to Python, or null if they should be JSON encoded.
+        if (this.model.get("binary_buffers")) {
+            return [];
+        }
+        return null;
+    },
+
+    buffer_dtype: function(val) {
+        // numpy dtype string for binary values, or null if val is not binary.
+        if ((val instanceof ArrayBuffer) || (val instanceof DataView)) {
+            return "|u1";
+        }
+        if (ArrayBuffer.isView(val)) {
+            for (var dtype in this.TYPED_ARRAYS) {
+                var constructor = this.TYPED_ARRAYS[dtype];
+                // Uint8Array is also the constructor for "b1": only numpy sends booleans.
+                if ((constructor) && (dtype != "b1") && (val instanceof constructor)) {
+                    var order = (constructor.BYTES_PER_ELEMENT == 1) ? "|" : "<";
+                    return order + dtype;
+                }
+            }
+            if (val instanceof Uint8ClampedArray) {
+                return "|u1";
+            }
+        }
+        return null;
+    },
+
+    buffer_reference: function(val, dtype, buffers) {
+        // add the binary value to the buffers and return a reference to it.
+        var buffer = val;
+        if (!(val instanceof ArrayBuffer)) {
+            if ((val.byteOffset != 0) || (val.byteLength != val.buffer.byteLength)) {
+                // message buffers must cover the whole underlying ArrayBuffer: copy.
+                buffer = new Uint8Array(val.buffer, val.byteOffset, val.byteLength).slice();
+            }
+        }
+        buffers.push(buffer);
+        var result = {};
+        result[this.BUFFER_REFERENCE] = [buffers.length - 1, dtype];
+        return result;
+    },
+
+    json_safe: function(val, depth, buffers) {
         // maybe expand later as need arises
+        // If buffers is an array binary values are sent as message buffers.
         var that = this;
         var ty = (typeof val);
         if ((ty == "number") || (ty == "string") || (ty == "boolean")) {
             return val;
         }
+        if ((buffers) && (val) && (ty == "object")) {
+            var dtype = that.buffer_dtype(val);
+            if (dtype) {
+                return that.buffer_reference(val, dtype, buffers);
+            }
+        }
         if ((val instanceof Uint8Array) || (val instanceof Uint8ClampedArray)) {
             // send as hexidecimal string
             return that.to_hex(val);
@@ -709,7 +1885,7 @@ var JSProxyView = widgets.DOMWidgetView.extend({
             if (jquery_.isArray(val)) {
                 var result = [];
                 _.each(val, function(elt, i) {
-                    var r = that.json_safe(elt, depth-1);
+                    var r = that.json_safe(elt, depth-1, buffers);
                     //if (r != null) {
                     result[i] = r;
                     //}
@@ -718,7 +1894,7 @@ var JSProxyView = widgets.DOMWidgetView.extend({
             } else {
                 var result = {};
                 for (var key in val) {
-                    var jv = that.json_safe(val[key], depth-1);
+                    var jv = that.json_safe(val[key], depth-1, buffers);
                     //if (jv != null) {
                     result[key] = jv;
                     //}
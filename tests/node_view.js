@@ -0,0 +1,73 @@
+// Load js/lib/proxy_implementation.js in node with minimal stand ins for the
+// widget modules, for tests which check messages produced by JSProxyView.
+// (See test_proxy_widget.py run_view_script.)
+
+var path = require("path");
+var Module = require("module");
+
+var stand_ins = {
+    "@jupyter-widgets/base": (function() {
+        var extend = function(properties) {
+            var constructor = function() {};
+            Object.assign(constructor.prototype, properties);
+            constructor.extend = extend;
+            return constructor;
+        };
+        var defaults = function() { return {}; };
+        return {
+            DOMWidgetModel: {extend: extend, prototype: {defaults: defaults}},
+            DOMWidgetView: {extend: extend},
+        };
+    })(),
+    "lodash": {
+        extend: Object.assign,
+        each: function(items, f) { items.forEach(f); },
+    },
+    "jquery": (function() {
+        var jquery = function() {};
+        jquery.isArray = Array.isArray;
+        return jquery;
+    })(),
+};
+
+var original_require = Module.prototype.require;
+Module.prototype.require = function(name) {
+    if (name in stand_ins) {
+        return stand_ins[name];
+    }
+    return original_require.apply(this, arguments);
+};
+
+global.window = global;
+
+var IMPLEMENTATION = path.join(path.dirname(__dirname), "js", "lib", "proxy_implementation.js");
+
+function make_view(attributes, model) {
+    // Return a view with the element {} whose messages are recorded in view.sent
+    // as [indicator, payload, buffers] with buffers as arrays of bytes.
+    // Views sharing the model object share model state like command templates.
+    var JSProxyView = require(IMPLEMENTATION).JSProxyView;
+    var view = Object.create(JSProxyView.prototype);
+    attributes = attributes || {};
+    model = model || {};
+    model.get = function(name) { return attributes[name]; };
+    model.set = function(name, value) { attributes[name] = value; };
+    view.model = model;
+    view.touch = function() {};
+    view.sent = [];
+    view.send_custom_message = function(indicator, payload, buffers) {
+        var bytes = (buffers || []).map(function(buffer) {
+            var octets = ArrayBuffer.isView(buffer) ?
+                new Uint8Array(buffer.buffer, buffer.byteOffset, buffer.byteLength) : new Uint8Array(buffer);
+            return Array.from(octets);
+        });
+        view.sent.push([indicator, payload, bytes]);
+    };
+    view.set_error_msg = function(message) {
+        view.error_msg = message;
+    };
+    view.$$el = {};
+    return view;
+}
+
+exports.make_view = make_view;
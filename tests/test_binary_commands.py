@@ -0,0 +1,44 @@
+import unittest
+import json
+from jp_proxy_widget import binary_commands
+
+PAYLOAD = [
+    7,
+    [
+        ["method", ["get", ["element"], "_FRAGILE_THIS"], "attr", "cx", 12.5],
+        ["set", ["element"], "uü☃", ["list", 1, -2, 2 ** 31, -(2 ** 31), True, False, None]],
+        ["method", ["window"], "f", ["dict", {"k": ["id", {"a": [1, "b"], "c": {}}]}]],
+        ["ndarray", "<f4", [2, 3], ["bytes", 0]],
+        ["callback", 3, ["not", "a", "command"], 2, None],
+    ],
+    2,
+]
+
+class TestBinaryCommands(unittest.TestCase):
+
+    def test_round_trip(self):
+        encoded = binary_commands.encode_commands(PAYLOAD)
+        self.assertEqual(binary_commands.decode_commands(encoded), PAYLOAD)
+
+    def test_compact_for_numbers(self):
+        commands = [3, [["method", ["element"], "attr", "x", i * 0.5] for i in range(1000)], 1]
+        encoded = binary_commands.encode_commands(commands)
+        self.assertTrue(len(encoded) < len(json.dumps(commands)))
+
+    def test_command_opcodes(self):
+        encoded = binary_commands.encode_commands(["element"])
+        self.assertEqual(bytes(encoded), bytes([binary_commands.COMMAND, binary_commands.OPCODE["element"], 0, 0, 0, 0]))
+        encoded = binary_commands.encode_commands(["not an indicator"])
+        self.assertEqual(encoded[0], binary_commands.LIST)
+
+    def test_numbers(self):
+        for value in (0, 1, -1, 2 ** 31 - 1, 2 ** 31, -(2 ** 31) - 1, 0.1, 1e300, True):
+            decoded = binary_commands.decode_commands(binary_commands.encode_commands(value))
+            self.assertEqual(decoded, value)
+            self.assertEqual(type(decoded) is bool, type(value) is bool)
+
+    def test_bad_values(self):
+        with self.assertRaises(TypeError):
+            binary_commands.encode_commands([1, object()])
+        with self.assertRaises(ValueError):
+            binary_commands.decode_commands(bytes([99]))
@@ -0,0 +1,86 @@
+import unittest
+from jp_proxy_widget import command_optimizer
+
+THIS = "_FRAGILE_THIS"
+REF = "_FRAGILE_JS_REFERENCE"
+FRAGILE = (THIS, REF)
+READERS = {"_SEND_FRAGILE_JS_REFERENCE": REF}
+ELEMENT = ["element"]
+
+def optimize(commands):
+    return command_optimizer.optimize_commands(commands, FRAGILE, READERS)
+
+def set_slot(name, value):
+    return ["set", ELEMENT, name, value]
+
+def get_slot(name):
+    return ["get", ELEMENT, name]
+
+class TestCommandOptimizer(unittest.TestCase):
+
+    def test_dead_fragile_writes_removed(self):
+        commands = [
+            set_slot(THIS, ELEMENT),
+            set_slot(REF, get_slot(REF)),
+            set_slot(THIS, ELEMENT),
+            set_slot(REF, ["get", ELEMENT, "b"]),
+        ]
+        (optimized, changes) = optimize(commands)
+        self.assertEqual(optimized, commands[2:])
+        self.assertEqual(changes, [(commands[0], None), (commands[1], None)])
+
+    def test_property_reads_keep_side_effects(self):
+        # the property may have a getter.
+        read = ["get", ["get", ELEMENT, THIS], "a"]
+        commands = [set_slot(REF, read), set_slot(REF, 2)]
+        (optimized, changes) = optimize(commands)
+        self.assertEqual(optimized, [["null", read], set_slot(REF, 2)])
+
+    def test_impure_dead_writes_keep_side_effects(self):
+        call = ["method", ELEMENT, "f", 1]
+        commands = [set_slot(REF, call), set_slot(REF, 2)]
+        (optimized, changes) = optimize(commands)
+        self.assertEqual(optimized, [["null", call], set_slot(REF, 2)])
+
+    def test_reads_keep_writes_alive(self):
+        commands = [
+            set_slot(REF, 1),
+            set_slot(THIS, get_slot(REF)),
+            set_slot(REF, 2),
+            ["method", ELEMENT, "_SEND_FRAGILE_JS_REFERENCE", 100],
+            set_slot(REF, 3),
+        ]
+        (optimized, changes) = optimize(commands)
+        self.assertIs(optimized, commands)
+        self.assertEqual(changes, [])
+
+    def test_write_reading_its_own_slot(self):
+        commands = [set_slot(REF, 1), set_slot(REF, ["method", get_slot(REF), "g"])]
+        (optimized, changes) = optimize(commands)
+        self.assertEqual(changes, [])
+
+    def test_calls_keep_other_slots_alive(self):
+        commands = [
+            set_slot("color", "red"),
+            set_slot(THIS, 1),
+            ["method", ["window"], "redraw"],
+            set_slot("color", "blue"),
+            set_slot(THIS, 2),
+        ]
+        (optimized, changes) = optimize(commands)
+        self.assertEqual(optimized, [commands[0]] + commands[2:])
+
+    def test_null_of_pure_reads_removed(self):
+        commands = [
+            ["null", get_slot(REF)],
+            ["null", ["method", ["window"], "f"]],
+            ["null", ["list", 1, ["id", {"a": 1}]]],
+            ["null", ["get", ["window"], "x"]],
+        ]
+        (optimized, changes) = optimize(commands)
+        self.assertEqual(optimized, [commands[1], commands[3]])
+
+    def test_untranslated_data_is_not_searched(self):
+        commands = [set_slot(REF, 1), ["method", ELEMENT, "f", ["id", ["get", ELEMENT, REF]]], set_slot(REF, 2)]
+        (optimized, changes) = optimize(commands)
+        self.assertEqual(optimized, commands[1:])
@@ -20,3 +20,33 @@ class TestHexCodec(unittest.TestCase):
         dumped = json.dumps([encoded])
         undumped = json.loads(dumped)
         assert undumped[0] == encoded
+
+    def test_memoryview_to_hex(self):
+        s = hex_codec.bytearray_to_hex(memoryview(bytestr))
+        self.assertEqual(s, hexstr)
+
+    def test_base64_roundtrip(self):
+        binary = bytes(range(256))
+        text = hex_codec.bytes_to_base64(memoryview(binary))
+        assert "\n" not in text
+        self.assertEqual(hex_codec.base64_to_bytes(text), binary)
+
+    def test_hex_stream_decoder(self):
+        binary = bytes(range(256))
+        text = hex_codec.bytes_to_hex(binary)
+        chunks = [text[i: i+7] for i in range(0, len(text), 7)]
+        decoded = b"".join(hex_codec.HexStreamDecoder().iter_decode(chunks))
+        self.assertEqual(decoded, binary)
+
+    def test_base64_stream_decoder(self):
+        binary = bytes(range(100))
+        text = hex_codec.bytes_to_base64(binary)
+        chunks = [text[i: i+5] for i in range(0, len(text), 5)]
+        decoded = b"".join(hex_codec.Base64StreamDecoder().iter_decode(chunks))
+        self.assertEqual(decoded, binary)
+
+    def test_stream_decoder_incomplete(self):
+        decoder = hex_codec.HexStreamDecoder()
+        self.assertEqual(decoder.decode("12f"), b"\x12")
+        with self.assertRaises(ValueError):
+            decoder.finish()
@@ -0,0 +1,33 @@
+import unittest
+import json
+from jp_proxy_widget import json_stream
+
+VALUES = [
+    {"a": [1, 2.5, None, True, "x" * 25, {1: "b", u"ü": u"☃\n"}], "b": [], "c": {}},
+    "",
+    [[]],
+    ("a", "tuple"),
+    "abcdefghij" * 7,
+]
+
+class TestJsonStream(unittest.TestCase):
+
+    def test_iter_json_matches_dumps(self):
+        for value in VALUES:
+            for chunk_size in (1, 3, 100):
+                text = "".join(json_stream.iter_json(value, chunk_size))
+                self.assertEqual(text, json.dumps(value))
+
+    def test_long_strings_are_split(self):
+        fragments = list(json_stream.iter_json(["y" * 100], 10))
+        self.assertTrue(max(len(f) for f in fragments) <= 10)
+
+    def test_iter_segments(self):
+        for value in VALUES:
+            text = json.dumps(value)
+            for size in (2, 5, 1000):
+                segments = list(json_stream.iter_segments(json_stream.iter_json(value, size), size))
+                self.assertEqual("".join(segments), text)
+                for segment in segments[:-1]:
+                    self.assertEqual(len(segment), size)
+                self.assertTrue(0 < len(segments[-1]) <= size)
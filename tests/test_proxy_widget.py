@@ -2,9 +2,17 @@ import unittest
 from unittest.mock import patch
 from unittest.mock import MagicMock
 from jp_proxy_widget import proxy_widget
+from jp_proxy_widget import binary_commands
 import jp_proxy_widget
 import tempfile
 import os
+import json
+import asyncio
+import zlib
+import random
+import weakref
+import shutil
+import subprocess
 
 class TestProxyWidget(unittest.TestCase):
 
@@ -141,6 +149,124 @@ class TestProxyWidget(unittest.TestCase):
             widget = proxy_widget.JSProxyWidget()
             widget.handle_custom_message(None, data)
 
+    def test_handle_custom_message_buffers(self, *mocks):
+        import numpy as np
+        i = proxy_widget.INDICATOR
+        p = proxy_widget.PAYLOAD
+        ref = {proxy_widget.BUFFER_REFERENCE: [0, "<f4"]}
+        data = np.arange(4, dtype=np.float32)
+        buffers = [memoryview(data.tobytes())]
+        widget = proxy_widget.JSProxyWidget()
+        m = widget.handle_callback_results = MagicMock()
+        widget.handle_custom_message(None, {i: proxy_widget.CALLBACK_RESULTS, p: [1, "data", {"0": ref}, 1]}, buffers)
+        [identifier, json_value, arguments, counter] = m.call_args[0][0]
+        self.assertEqual(arguments["0"].tolist(), data.tolist())
+        self.assertFalse(arguments["0"].flags.owndata)
+        widget.handle_custom_message(None, {i: proxy_widget.JSON_CB_FRAGMENT, p: ["v", 1, 2, '[1, "data", {"0": ']})
+        widget.handle_custom_message(None, {i: proxy_widget.JSON_CB_FINAL, p: ["v", 1, 2, json.dumps(ref) + '}, 2]']}, buffers)
+        [identifier, json_value, arguments, counter] = m.call_args[0][0]
+        self.assertEqual(arguments["0"].dtype, np.float32)
+
+    def run_view_script(self, script):
+        "Run a node script using make_view (see node_view.js) and return the JSON value it prints."
+        node = shutil.which("node")
+        if node is None:
+            self.skipTest("node is not available")
+        loader = os.path.join(os.path.dirname(os.path.abspath(__file__)), "node_view.js")
+        prefix = "var make_view = require(%s).make_view;\n" % json.dumps(loader)
+        return json.loads(subprocess.check_output([node, "-e", prefix + script]))
+
+    def decoded_messages(self, sent):
+        "Decode the [indicator, payload, buffers] messages recorded by a node_view.js view."
+        return [(indicator, proxy_widget.decode_buffers(payload, [bytes(b) for b in buffers]) if buffers else payload)
+            for (indicator, payload, buffers) in sent]
+
+    def test_uint8_result_round_trip(self, *mocks):
+        sent = self.run_view_script("""
+            var view = make_view({binary_buffers: true});
+            view.$$el.data = new Uint8Array([0, 1, 2, 255]);
+            view.$$el.flags = new Int8Array([-1, 1]);
+            view.execute_commands([1, [["evaluate", 0, 2, ["list", ["get", ["element"], "data"], ["get", ["element"], "flags"]]]], 1]);
+            console.log(JSON.stringify(view.sent));
+        """)
+        [(indicator, [identifier, ok, [data, flags]]), results] = self.decoded_messages(sent)
+        self.assertEqual(indicator, proxy_widget.EVALUATED)
+        self.assertEqual(data.dtype.str, "|u1")
+        self.assertEqual(data.tolist(), [0, 1, 2, 255])
+        self.assertEqual(flags.dtype.str, "|i1")
+        self.assertEqual(flags.tolist(), [-1, 1])
+
+    def test_decode_buffers(self, *mocks):
+        ref = {proxy_widget.BUFFER_REFERENCE: [1, "|u1"]}
+        buffers = [b"", b"\x01\x02"]
+        decoded = proxy_widget.decode_buffers([{"a": ref, "b": [ref, "c"]}, None], buffers)
+        self.assertEqual(decoded[0]["a"].tolist(), [1, 2])
+        self.assertEqual(decoded[0]["b"][1:], ["c"])
+        self.assertEqual(decoded[1], None)
+
+    def test_interleaved_segment_streams(self, *mocks):
+        i = proxy_widget.INDICATOR
+        p = proxy_widget.PAYLOAD
+        widget = proxy_widget.JSProxyWidget()
+        m = widget.handle_callback_results = MagicMock()
+        first = json.dumps([7, "data", {"0": "first" * 10}, 1])
+        second = json.dumps([7, "data", {"0": "second" * 10}, 2])
+        widget.handle_custom_message(None, {i: proxy_widget.JSON_CB_FRAGMENT, p: ["v", 7, 1, first[:20]]})
+        # the same callback invocation counter in another view
+        widget.handle_custom_message(None, {i: proxy_widget.JSON_CB_FRAGMENT, p: ["w", 7, 1, second[:20]]})
+        widget.handle_custom_message(None, {i: proxy_widget.JSON_CB_FRAGMENT, p: ["v", 7, 1, first[20:40]]})
+        widget.handle_custom_message(None, {i: proxy_widget.JSON_CB_FINAL, p: ["w", 7, 1, second[20:]]})
+        widget.handle_custom_message(None, {i: proxy_widget.JSON_CB_FINAL, p: ["v", 7, 1, first[40:]]})
+        results = [c[0][0] for c in m.call_args_list]
+        self.assertEqual(results, [json.loads(second), json.loads(first)])
+        self.assertEqual(widget._json_streams, {})
+        # streams are not shared between widgets
+        other = proxy_widget.JSProxyWidget()
+        widget.handle_custom_message(None, {i: proxy_widget.JSON_CB_FRAGMENT, p: ["v", 7, 3, "[1, "]})
+        self.assertEqual(other._json_streams, {})
+
+    def test_stale_segment_streams_dropped(self, *mocks):
+        i = proxy_widget.INDICATOR
+        p = proxy_widget.PAYLOAD
+        widget = proxy_widget.JSProxyWidget()
+        m = widget.handle_callback_results = MagicMock()
+        widget.handle_custom_message(None, {i: proxy_widget.JSON_CB_FRAGMENT, p: ["v", 7, 1, "[1, "]})
+        widget.handle_custom_message(None, {i: proxy_widget.JSON_CB_FRAGMENT, p: ["v", 8, 1, "[2, "]})
+        widget.handle_custom_message(None, {i: proxy_widget.JSON_CB_FRAGMENT, p: ["w", 7, 1, "[4, "]})
+        # a later message from the same callback in the view completes: the earlier one was abandoned.
+        widget.handle_custom_message(None, {i: proxy_widget.JSON_CB_FINAL, p: ["v", 7, 2, "[3]"]})
+        m.assert_called_with([3])
+        self.assertEqual(sorted(widget._json_streams), [("v", 8, 1), ("w", 7, 1)])
+        widget.handle_custom_message(None, {i: proxy_widget.COMPRESSED_FRAGMENT, p: ["v", 9, 1]}, [b""])
+        widget.handle_custom_message(None, {i: proxy_widget.COMPRESSED_FRAGMENT, p: ["w", 9, 1]}, [b""])
+        # a view rendering again drops only its own partial messages.
+        widget.handle_custom_message(None, {i: proxy_widget.VIEW_RENDERED, p: ["session", "v"]})
+        self.assertEqual(list(widget._json_streams), [("w", 7, 1)])
+        self.assertEqual(list(widget._compressed_streams), [json.dumps(["w", 9, 1])])
+        self.assertEqual(widget._frontend_sessions, set(["session"]))
+
+    def test_view_segment_streams_tagged_by_view(self, *mocks):
+        sent = self.run_view_script("""
+            var views = [make_view({}), make_view({})];
+            views.forEach(function(view) {
+                view.callback_factory(7, "data", 1, 20)("x".repeat(50));
+            });
+            console.log(JSON.stringify(views.map(function(view) { return view.sent; })));
+        """)
+        tags = [[payload[:3] for (indicator, payload, buffers) in messages] for messages in sent]
+        (first, second) = tags
+        self.assertTrue(len(first) > 1)
+        self.assertEqual(set(tuple(tag) for tag in first), set([tuple(first[0])]))
+        self.assertEqual(first[0][1:], [7, 1])
+        self.assertEqual(second[0][1:], [7, 1])
+        self.assertNotEqual(first[0][0], second[0][0])
+        # the kernel reassembles both messages.
+        widget = proxy_widget.JSProxyWidget()
+        m = widget.handle_callback_results = MagicMock()
+        for (indicator, payload, buffers) in [message for pair in zip(*sent) for message in pair]:
+            widget.handle_custom_message(None, {proxy_widget.INDICATOR: indicator, proxy_widget.PAYLOAD: payload})
+        self.assertEqual([c[0][0][2] for c in m.call_args_list], [{"0": "x" * 50}] * 2)
+
     def test_handle_custom_message_error(self, *mocks):
         i = proxy_widget.INDICATOR
         p = proxy_widget.PAYLOAD
@@ -417,6 +543,1097 @@ class TestProxyWidget(unittest.TestCase):
         widget.send_segmented_message("frag", "final", payload, 100)
         assert s.called
 
+    def test_send_binary_buffers(self, *args):
+        widget = proxy_widget.JSProxyWidget()
+        widget.rendered = True
+        s = widget.send = MagicMock()
+        data = bytearray(b"\x12\xff binary bytes")
+        widget.send_command(widget.get_element().download("name", data))
+        (package, buffers) = s.call_args[0]
+        [count, commands, level] = package[proxy_widget.PAYLOAD]
+        self.assertEqual(commands[0][-1], ["bytes", 0])
+        self.assertEqual(buffers, [data])
+
+    def test_send_shared_structure(self, *args):
+        widget = proxy_widget.JSProxyWidget()
+        widget.rendered = True
+        s = widget.send = MagicMock()
+        element = widget.element
+        with widget.delay_flush():
+            for i in range(5):
+                element.append_some_long_method_name("a repeated argument string")
+        (package, buffers) = s.call_args[0]
+        shared_payload = package[proxy_widget.PAYLOAD]
+        [count, commands, level, table] = shared_payload
+        self.assertTrue(table)
+        self.assertIn(["ref", 0], commands)
+        widget.share_structure = False
+        with widget.delay_flush():
+            for i in range(5):
+                element.append_some_long_method_name("a repeated argument string")
+        (package, buffers) = s.call_args[0]
+        payload = package[proxy_widget.PAYLOAD]
+        self.assertEqual(len(payload), 3)
+        self.assertTrue(len(json.dumps(shared_payload)) < len(json.dumps(payload)))
+
+    def test_send_binary_commands(self, *args):
+        widget = proxy_widget.JSProxyWidget()
+        widget.rendered = True
+        widget.binary_commands = True
+        s = widget.send = MagicMock()
+        data = b"\x12\xff"
+        widget.send_command(widget.get_element().download("name", data))
+        # not accepted by the view: JSON is sent.
+        (package, buffers) = s.call_args[0]
+        self.assertEqual(package[proxy_widget.INDICATOR], proxy_widget.COMMANDS)
+        widget.binary_commands_accepted = True
+        widget.send_command(widget.get_element().download("name", data))
+        (package, buffers) = s.call_args[0]
+        self.assertEqual(package[proxy_widget.INDICATOR], proxy_widget.BINARY_COMMANDS)
+        self.assertEqual(buffers[0], data)
+        payload = binary_commands.decode_commands(buffers[-1])
+        self.assertEqual(payload, widget.last_commands_sent)
+        self.assertEqual(payload[1][0][-1], ["bytes", 0])
+
+    def test_send_compressed(self, *args):
+        widget = proxy_widget.JSProxyWidget()
+        widget.compression_threshold = 1000
+        s = widget.send = MagicMock()
+        payload = [1, [["method", ["element"], "html", "<b>bold</b>" * 200]], 1]
+        widget.send_custom_message(proxy_widget.COMMANDS, payload)
+        # not accepted by the view: sent as is.
+        (package, buffers) = s.call_args[0]
+        self.assertEqual(package[proxy_widget.PAYLOAD], payload)
+        widget.compression_accepted = True
+        widget.send_custom_message(proxy_widget.COMMANDS, payload, [b"data"])
+        (package, buffers) = s.call_args[0]
+        self.assertEqual(package, {proxy_widget.INDICATOR: proxy_widget.COMPRESSED, proxy_widget.PAYLOAD: proxy_widget.COMMANDS})
+        self.assertEqual(buffers[0], b"data")
+        self.assertTrue(len(buffers[1]) * 5 < len(json.dumps(payload)))
+        self.assertEqual(json.loads(zlib.decompress(buffers[1])), payload)
+        # small messages are not compressed
+        widget.send_custom_message(proxy_widget.RESULTS, [1, True])
+        (package, buffers) = s.call_args[0]
+        self.assertEqual(package[proxy_widget.INDICATOR], proxy_widget.RESULTS)
+
+    def test_send_segmented_compressed(self, *args):
+        widget = proxy_widget.JSProxyWidget()
+        widget.compression_threshold = 1000
+        widget.compression_accepted = True
+        s = widget.send = MagicMock()
+        text = "".join("%08x" % random.getrandbits(32) for i in range(300))
+        payload = [1, [["method", ["element"], "html", text]], 1]
+        widget.send_segmented_message(proxy_widget.COMMANDS_FRAGMENT, proxy_widget.COMMANDS_FINAL, payload, 100)
+        # the compressed bytes are segmented too.
+        self.assertTrue(s.call_count > 1)
+        calls = [c[0] for c in s.call_args_list]
+        for (package, buffers) in calls[:-1]:
+            self.assertEqual(package[proxy_widget.INDICATOR], proxy_widget.COMPRESSED_FRAGMENT)
+            self.assertEqual(len(buffers[0]), 100)
+        (package, buffers) = calls[-1]
+        self.assertEqual(package[proxy_widget.PAYLOAD], [proxy_widget.COMMANDS, None])
+        self.assertTrue(len(buffers[-1]) <= 100)
+        compressed = b"".join(buffers[-1] for (package, buffers) in calls)
+        self.assertEqual(json.loads(zlib.decompress(compressed)), payload)
+        # the receiving side decompresses the fragments as they arrive.
+        receiver = proxy_widget.JSProxyWidget()
+        h = receiver.handle_callback_results = MagicMock()
+        for (package, buffers) in calls:
+            package = dict(package)
+            if package[proxy_widget.INDICATOR] == proxy_widget.COMPRESSED:
+                package[proxy_widget.PAYLOAD] = [proxy_widget.CALLBACK_RESULTS, ["stream", 3]]
+            else:
+                package[proxy_widget.PAYLOAD] = ["stream", 3]
+            receiver.handle_custom_message(receiver, package, buffers)
+        h.assert_called_with(payload)
+        self.assertEqual(receiver._compressed_streams, {})
+        # below the threshold: segments are sent.
+        s.reset_mock()
+        small = [2, [["method", ["element"], "html", "x" * 250]], 1]
+        widget.send_segmented_message(proxy_widget.COMMANDS_FRAGMENT, proxy_widget.COMMANDS_FINAL, small, 100)
+        self.assertEqual(s.call_count, 3)
+        text = "".join(c[0][0][proxy_widget.PAYLOAD] for c in s.call_args_list)
+        self.assertEqual(json.loads(text), small)
+
+    def test_size_at_least(self, *args):
+        value = [1, {"key": "x" * 100, "other": [None, 2.5]}, "y" * 50]
+        size = len(json.dumps(value))
+        self.assertTrue(proxy_widget.size_at_least(value, size // 2))
+        self.assertFalse(proxy_widget.size_at_least(value, size * 2))
+
+    def test_handle_compressed_message(self, *args):
+        widget = proxy_widget.JSProxyWidget()
+        h = widget.handle_callback_results = MagicMock()
+        payload = [5, "data", {"0": "arg"}, 1]
+        compressed = zlib.compress(json.dumps(payload).encode("utf-8"))
+        data = {proxy_widget.INDICATOR: proxy_widget.COMPRESSED, proxy_widget.PAYLOAD: proxy_widget.CALLBACK_RESULTS}
+        widget.handle_custom_message(widget, data, [memoryview(compressed)])
+        h.assert_called_with(payload)
+
+    def test_view_compressed_segments_round_trip(self, *mocks):
+        text = "".join("%08x" % random.getrandbits(32) for i in range(300))
+        payload = [7, "data", {"0": text}, 1]
+        # Python segments are decompressed by the view ...
+        widget = proxy_widget.JSProxyWidget()
+        widget.compression_threshold = 1000
+        widget.compression_accepted = True
+        s = widget.send = MagicMock()
+        widget.send_segmented_message(proxy_widget.COMMANDS_FRAGMENT, proxy_widget.COMMANDS_FINAL, payload, 100)
+        incoming = [[package, [list(b) for b in buffers]] for (package, buffers) in (c[0] for c in s.call_args_list)]
+        # ... and view segments are decompressed by Python.
+        result = self.run_view_script("""
+            var incoming = %s;
+            var view = make_view({compression_accepted: true, compression_threshold: 1000});
+            var received = [];
+            var sent = [];
+            view.dispatch_custom_message = function(content, buffers) {
+                received.push(content);
+            };
+            view.model.send = function(content, callbacks, buffers) {
+                sent.push([content, buffers.map(function(buffer) { return Array.from(buffer); })]);
+            };
+            incoming.forEach(function(message) {
+                view.handle_custom_message(message[0], message[1].map(function(b) { return new Uint8Array(b); }));
+            });
+            view.send_segmented_message("jcb_results", "jcb_final", %s, 100, [], ["stream", 2]);
+            setTimeout(function() {
+                console.log(JSON.stringify({received: received, sent: sent}));
+            }, 200);
+        """ % (json.dumps(incoming), json.dumps(payload)))
+        self.assertEqual(result["received"], [{proxy_widget.INDICATOR: proxy_widget.COMMANDS, proxy_widget.PAYLOAD: payload}])
+        sent = result["sent"]
+        self.assertTrue(len(sent) > 1)
+        for (package, buffers) in sent:
+            self.assertTrue(len(buffers[-1]) <= 100)
+        self.assertEqual(sent[0][0], {proxy_widget.INDICATOR: proxy_widget.COMPRESSED_FRAGMENT, proxy_widget.PAYLOAD: ["stream", 2]})
+        h = widget.handle_callback_results = MagicMock()
+        for (package, buffers) in sent:
+            widget.handle_custom_message(widget, package, [bytes(b) for b in buffers])
+        h.assert_called_with(payload)
+
+    ORDERED_BATCHES_SCRIPT = """
+        var view = make_view({});
+        var order = [];
+        view.$$el.log = function(x) { order.push(x); };
+        // loads resolve later, like stylesheets appearing in the page.
+        view.load_css_async = function(name, text) {
+            return function(resolver) {
+                setTimeout(function() { order.push("loaded " + name); resolver(name); }, 20);
+            };
+        };
+        %s.forEach(function(batch) {
+            view.execute_commands(batch);
+        });
+        setTimeout(function() {
+            console.log(JSON.stringify({order: order, sent: view.sent}));
+        }, 200);
+    """
+
+    def test_view_batches_run_in_order(self, *mocks):
+        def log(x):
+            return ["method", ["element"], "log", x]
+        # a method of an undefined property
+        fails = ["method", ["get", ["element"], "missing"], "x"]
+        batches = [
+            [1, [log("1a"), ["load_css", "s1", "x"], log("1b")], 1],
+            [2, [log("2")], 1],
+            # fails after waiting for a load, then synchronously while later batches wait.
+            [3, [["load_css", "s2", "x"], fails, log("3")], 1],
+            [4, [log("4")], 1],
+            [5, [fails], 1],
+            [6, [log("6")], 1],
+        ]
+        result = self.run_view_script(self.ORDERED_BATCHES_SCRIPT % json.dumps(batches))
+        # later batches wait for the loads of earlier batches.
+        self.assertEqual(result["order"], ["1a", "loaded s1", "1b", "2", "loaded s2", "4", "6"])
+        acknowledgements = [payload for (indicator, payload, buffers) in result["sent"] if indicator == proxy_widget.RESULTS]
+        self.assertEqual(acknowledgements, [[1, True], [2, True], [3, False], [4, True], [5, False], [6, True]])
+
+    def test_view_frame_budget(self, *mocks):
+        result = self.run_view_script("""
+            var view = make_view({frame_budget_ms: 25});
+            var order = [];
+            // each command takes 10 milliseconds.
+            var clock = 0;
+            view.now = function() { return clock; };
+            view.$$el.log = function(x) { clock += 10; order.push(x); };
+            view.next_frame = function() {
+                return new Promise(function(resolve) {
+                    setTimeout(function() { order.push("frame"); resolve(); }, 5);
+                });
+            };
+            var send = view.send_custom_message;
+            view.send_custom_message = function(indicator, payload, buffers) {
+                if (indicator == "results") {
+                    order.push(payload);
+                }
+                return send(indicator, payload, buffers);
+            };
+            var log = function(x) { return ["method", ["element"], "log", x]; };
+            view.execute_commands([1, [log(1), log(2), log(3), log(4), log(5), log(6)], 1]);
+            view.execute_commands([2, [log("after")], 1]);
+            order.push("queued");
+            setTimeout(function() {
+                console.log(JSON.stringify(order));
+            }, 100);
+        """)
+        # the batch yields when a slice exceeds the budget and is acknowledged after the last slice;
+        # the next batch waits for it.
+        self.assertEqual(result, [1, 2, 3, "queued", "frame", 4, 5, 6, [1, True], "after", [2, True]])
+
+    def test_failed_batch_acknowledged(self, *mocks):
+        widget = proxy_widget.JSProxyWidget()
+        widget.rendered = True
+        widget.flow_control_window = 1
+        widget.send = MagicMock()
+        outcomes = []
+        element = widget.get_element()
+        def run_in_view():
+            payload = widget.send.call_args[0][0][proxy_widget.PAYLOAD]
+            result = self.run_view_script(self.ORDERED_BATCHES_SCRIPT % json.dumps([payload]))
+            for (indicator, payload, buffers) in result["sent"]:
+                widget.handle_custom_message(None, {proxy_widget.INDICATOR: indicator, proxy_widget.PAYLOAD: payload})
+            return result
+        widget.send_command(["load_css", "s1", "x"], results_callback=outcomes.append)
+        # the window holds the next batch until the view acknowledges the first.
+        widget.send_command(element.missing.x(), results_callback=outcomes.append)
+        self.assertEqual(widget.send.call_count, 1)
+        run_in_view()
+        self.assertEqual(widget.send.call_count, 2)
+        widget.send_command(element.log("ok"), results_callback=outcomes.append)
+        run_in_view()
+        self.assertEqual(widget.send.call_count, 3)
+        result = run_in_view()
+        # the failure is reported to its callback and the next batch runs.
+        self.assertEqual(outcomes, [True, False, True])
+        self.assertEqual(result["order"], ["ok"])
+        self.assertEqual(widget.backlog()["in_flight"], 0)
+
+    def flow_controlled_widget(self, policy):
+        widget = proxy_widget.JSProxyWidget()
+        widget.rendered = True
+        widget.flow_control_window = 2
+        widget.flow_control_policy = policy
+        widget.send = MagicMock()
+        # batch counts relative to the first batch sent by the test.
+        widget.test_base = widget.counter
+        return widget
+
+    def sent_counts(self, widget):
+        return [c[0][0][proxy_widget.PAYLOAD][0] - widget.test_base for c in widget.send.call_args_list]
+
+    def acknowledge(self, widget, count, value=True):
+        widget.handle_results([widget.test_base + count, value])
+
+    def test_flow_control_coalesce(self, *args):
+        widget = self.flow_controlled_widget(proxy_widget.COALESCE)
+        callback = MagicMock()
+        for i in range(5):
+            widget.send_command(widget.get_element().attr("x", i), results_callback=callback)
+        self.assertEqual(self.sent_counts(widget), [0, 1])
+        self.assertEqual(widget.backlog(), dict(in_flight=2, in_flight_bytes=0, held=1, held_commands=3, dropped=0))
+        self.acknowledge(widget, 0)
+        # the held batches are sent merged as one batch
+        self.assertEqual(self.sent_counts(widget), [0, 1, 5])
+        self.assertEqual(len(widget.last_commands_sent[1]), 3)
+        self.assertEqual(widget.backlog()["held"], 0)
+        self.acknowledge(widget, 5)
+        # callbacks for the first batch and all three merged batches
+        self.assertEqual(callback.call_count, 4)
+        widget.send_command(widget.get_element().attr("x", 5))
+        self.assertEqual(self.sent_counts(widget), [0, 1, 5, 6])
+
+    def test_flow_control_drop_oldest(self, *args):
+        widget = self.flow_controlled_widget(proxy_widget.DROP_OLDEST)
+        for i in range(5):
+            widget.send_command(widget.get_element().attr("x", i))
+        self.assertEqual(widget.backlog()["held"], 1)
+        self.assertEqual(widget.backlog()["dropped"], 2)
+        self.acknowledge(widget, 1)
+        self.assertEqual(widget.last_commands_sent[1][0][-1], 4)
+        widget.reset_flow_control()
+        self.assertEqual(widget.backlog()["in_flight"], 0)
+
+    def test_flow_control_drop_oldest_callbacks(self, *args):
+        widget = self.flow_controlled_widget(proxy_widget.DROP_OLDEST)
+        outcomes = []
+        for i in range(5):
+            widget.send_command(widget.get_element().attr("x", i), results_callback=lambda value, i=i: outcomes.append((i, value)))
+        # dropped batches are reported as failed at once.
+        self.assertEqual(outcomes, [(2, False), (3, False)])
+        self.acknowledge(widget, 0)
+        self.acknowledge(widget, 1)
+        self.acknowledge(widget, 5)
+        self.assertEqual(outcomes, [(2, False), (3, False), (0, True), (1, True), (4, True)])
+
+    def test_flow_control_bytes(self, *args):
+        widget = self.flow_controlled_widget(proxy_widget.COALESCE)
+        widget.flow_control_window = 100
+        widget.flow_control_bytes = 50
+        widget.send_command(widget.get_element().html("x" * 100))
+        widget.send_command(widget.get_element().html("y"))
+        self.assertEqual(self.sent_counts(widget), [0])
+        self.assertTrue(widget.backlog()["in_flight_bytes"] > 100)
+        self.acknowledge(widget, 0, False)
+        self.assertEqual(self.sent_counts(widget), [0, 2])
+
+    @patch("jp_proxy_widget.proxy_widget.run_ui_poll_loop")
+    def test_flow_control_block(self, poll, *args):
+        widget = self.flow_controlled_widget(proxy_widget.BLOCK)
+        widget.flow_control_window = 1
+        widget.send_command(widget.get_element().attr("x", 1))
+        poll.side_effect = lambda test: self.acknowledge(widget, 0)
+        widget.send_command(widget.get_element().attr("x", 2))
+        self.assertEqual(poll.call_count, 1)
+        # (the waiting batch is numbered when it is sent, like other held batches.)
+        self.assertEqual(self.sent_counts(widget), [0, 2])
+        poll.side_effect = None
+        widget.flow_control_timeout = 0
+        with self.assertRaises(TimeoutError):
+            widget.send_command(widget.get_element().attr("x", 3))
+        self.assertEqual(widget.backlog()["held"], 0)
+
+    @patch("jp_proxy_widget.proxy_widget.run_ui_poll_loop")
+    def test_flow_control_block_reentrant(self, poll, *args):
+        widget = self.flow_controlled_widget(proxy_widget.BLOCK)
+        widget.flow_control_window = 1
+        widget.send_command(widget.get_element().attr("x", 1))
+        def handle_messages(test):
+            # a message handler sends commands while the kernel waits for the window.
+            widget.send_command(widget.get_element().attr("x", 3))
+            self.acknowledge(widget, 0)
+            self.assertTrue(test())
+        poll.side_effect = handle_messages
+        widget.send_command(widget.get_element().attr("x", 2))
+        # the handler did not wait (no nested polling) and its batch is sent after the waiting batch.
+        self.assertEqual(poll.call_count, 1)
+        self.assertEqual([c[-1] for c in widget.last_commands_sent[1]], [2])
+        self.assertEqual(widget.backlog()["held"], 1)
+        self.acknowledge(widget, 3)
+        self.assertEqual([c[-1] for c in widget.last_commands_sent[1]], [3])
+
+    def coalescing_widget(self):
+        widget = proxy_widget.JSProxyWidget()
+        widget.rendered = True
+        widget.coalesce_flush_ms = 5
+        widget.send = MagicMock()
+        return widget
+
+    def test_coalesce_flush(self, *args):
+        widget = self.coalescing_widget()
+        async def run():
+            for i in range(10):
+                widget(widget.get_element().attr("x", i))
+            self.assertEqual(widget.send.call_count, 0)
+            await asyncio.sleep(0.05)
+        asyncio.run(run())
+        self.assertEqual(widget.send.call_count, 1)
+        self.assertEqual(len(widget.last_commands_sent[1]), 10)
+        self.assertEqual(widget.last_commands_sent[1][0], ["method", ["element"], "attr", "x", 0])
+
+    def test_coalesce_flush_budgets(self, *args):
+        widget = self.coalescing_widget()
+        widget.coalesce_flush_commands = 4
+        async def run():
+            for i in range(10):
+                widget(widget.get_element().attr("x", i))
+            self.assertEqual(widget.send.call_count, 2)
+            await asyncio.sleep(0.05)
+            self.assertEqual(widget.send.call_count, 3)
+            widget.coalesce_flush_bytes = 1000
+            widget(widget.get_element().html("x" * 1000))
+            self.assertEqual(widget.send.call_count, 4)
+        asyncio.run(run())
+
+    def test_coalesce_flush_before_evaluate(self, *args):
+        widget = self.coalescing_widget()
+        async def run():
+            widget(widget.get_element().attr("x", 1))
+            widget._send_synced_command(widget.get_element().attr("x"), 1)
+            self.assertEqual(widget.send.call_count, 1)
+            self.assertIs(widget._flush_handle, None)
+        asyncio.run(run())
+
+    def test_coalesce_flush_without_event_loop(self, *args):
+        import warnings
+        widget = self.coalescing_widget()
+        with warnings.catch_warnings():
+            # (asyncio.get_event_loop is deprecated without a running loop.)
+            warnings.simplefilter("error", DeprecationWarning)
+            widget(widget.get_element().attr("x", 1))
+        self.assertEqual(widget.send.call_count, 1)
+
+    def test_approximate_size(self, *args):
+        import numpy as np
+        self.assertEqual(proxy_widget.approximate_size(["bytes", b"1234"]), 13)
+        self.assertEqual(proxy_widget.approximate_size(np.zeros(10)), 80)
+
+    def test_callback_transaction(self, *args):
+        widget = proxy_widget.JSProxyWidget()
+        other = proxy_widget.JSProxyWidget()
+        for w in (widget, other):
+            w.rendered = True
+            w.send = MagicMock()
+        def handler(x):
+            for i in range(x):
+                widget.element.attr("x", i)
+                other.element.attr("y", i)
+            self.assertEqual(widget.send.call_count, 0)
+            # nested transactions commit with the outermost one
+            with proxy_widget.CallbackTransaction():
+                other.element.attr("z", 1)
+            self.assertEqual(other.send.call_count, 0)
+        callback = widget.callable(handler)
+        identifier = callback._cmd()[1]
+        widget.handle_callback_results([identifier, "data", {"0": 5}, 1])
+        self.assertEqual(widget.send.call_count, 1)
+        self.assertEqual(other.send.call_count, 1)
+        self.assertIs(proxy_widget.CallbackTransaction.widgets, None)
+        other(other.get_element().attr("y", 1))
+        self.assertEqual(other.send.call_count, 2)
+
+    def test_callback_transaction_error(self, *args):
+        widget = proxy_widget.JSProxyWidget()
+        widget.rendered = True
+        widget.send = MagicMock()
+        widget.print_on_error = False
+        def handler():
+            widget.element.attr("x", 1)
+            raise KeyError("handler error")
+        callback = widget.callable(handler)
+        with self.assertRaises(KeyError):
+            widget.handle_callback_results([callback._cmd()[1], "data", {}, 1])
+        # commands issued before the error are sent
+        self.assertEqual(widget.send.call_count, 1)
+        self.assertIs(proxy_widget.CallbackTransaction.widgets, None)
+
+    def test_callback_transaction_flush_error(self, *args):
+        widgets = []
+        for i in range(3):
+            w = proxy_widget.JSProxyWidget()
+            w.rendered = True
+            w.send = MagicMock(side_effect=ValueError("send failed %s" % i) if i < 2 else None)
+            widgets.append(w)
+        with self.assertRaises(ValueError) as context:
+            with proxy_widget.CallbackTransaction():
+                for w in widgets:
+                    w.element.attr("x", 1)
+        # every widget is flushed and the first failure is raised.
+        self.assertEqual(str(context.exception), "send failed 0")
+        self.assertEqual([w.send.call_count for w in widgets], [1, 1, 1])
+        self.assertIs(proxy_widget.CallbackTransaction.widgets, None)
+
+    def expression_widget(self):
+        widget = proxy_widget.JSProxyWidget()
+        widget.rendered = True
+        widget.expression_mode = True
+        widget.send = MagicMock()
+        return widget
+
+    def sent_commands(self, widget):
+        return [c for call in widget.send.call_args_list for c in call[0][0][proxy_widget.PAYLOAD][1]]
+
+    def test_expression_mode_chain(self, *args):
+        widget = self.expression_widget()
+        widget.element.a.b("c").d
+        self.assertEqual(widget.send.call_count, 0)
+        widget.flush()
+        chain = ["get", ["method", ["get", ["element"], "a"], "b", "c"], "d"]
+        self.assertEqual(self.sent_commands(widget), [["set", ["element"], proxy_widget.FRAGILE_JS_REFERENCE, chain]])
+
+    def test_expression_mode_arguments(self, *args):
+        widget = self.expression_widget()
+        element = widget.element
+        element.append(element.make_div("x"))
+        # pure property reads are not sent as statements
+        element.width
+        element.f()(1)
+        widget.flush()
+        make_div = ["method", ["element"], "make_div", "x"]
+        self.assertEqual(self.sent_commands(widget), [
+            ["set", ["element"], proxy_widget.FRAGILE_JS_REFERENCE, ["method", ["element"], "append", make_div]],
+            ["set", ["element"], proxy_widget.FRAGILE_JS_REFERENCE, ["function", ["method", ["element"], "f"], 1]],
+        ])
+
+    def test_expression_mode_commit_triggers(self, *args):
+        widget = self.expression_widget()
+        widget.element.f(1)
+        widget(widget.get_element().g(2))
+        self.assertEqual([c[3][2] for c in self.sent_commands(widget)[:1]], ["f"])
+        self.assertEqual(self.sent_commands(widget)[1][2], "g")
+        widget.element.h(3)
+        proxy_widget.commit_pending_expressions()
+        self.assertEqual(self.sent_commands(widget)[-1][3][2], "h")
+        self.assertIs(widget._pending_expression, None)
+        # a committed value is reused through the fragile reference slot
+        self.assertEqual(widget.last_fragile_reference._cmd()[2], "h")
+
+    def test_expression_mode_committed_reference(self, *args):
+        widget = self.expression_widget()
+        appended = widget.element.append("<b>x</b>")
+        widget.flush()
+        appended.css("color", "red")
+        widget.flush()
+        append = ["method", ["element"], "append", "<b>x</b>"]
+        fragile = ["get", ["element"], proxy_widget.FRAGILE_JS_REFERENCE]
+        # append runs once: the css call uses the committed value.
+        self.assertEqual(self.sent_commands(widget), [
+            ["set", ["element"], proxy_widget.FRAGILE_JS_REFERENCE, append],
+            ["set", ["element"], proxy_widget.FRAGILE_JS_REFERENCE, ["method", fragile, "css", "color", "red"]],
+        ])
+        # no empty batches
+        self.assertEqual(widget.send.call_count, 2)
+        widget.flush()
+        self.assertEqual(widget.send.call_count, 2)
+
+    def test_expression_mode_sync_value(self, *args):
+        widget = self.expression_widget()
+        widget.evaluate = MagicMock()
+        expression = widget.element.f(1)
+        expression.sync_value()
+        widget.evaluate.assert_called()
+        widget._send_synced_command(expression, 1)
+        commands = self.sent_commands(widget)
+        self.assertEqual(commands[0], ["set", ["element"], proxy_widget.FRAGILE_JS_REFERENCE, ["method", ["element"], "f", 1]])
+        self.assertEqual(commands[1][2], proxy_widget.SEND_FRAGILE_JS_REFERENCE)
+        self.assertEqual(len(commands), 2)
+
+    def test_optimize_commands(self, *args):
+        widget = proxy_widget.JSProxyWidget()
+        widget.rendered = True
+        widget.send = MagicMock()
+        # (opt in)
+        self.assertFalse(widget.optimize_commands)
+        widget.optimize_commands = True
+        with widget.delay_flush():
+            widget.element.a.b("c")
+            widget.element.html("hi")
+        stats = widget.optimizer_stats
+        self.assertEqual(stats["batches"], 1)
+        # dead writes of property reads keep the reads (which may run getters) as null commands.
+        self.assertEqual(stats["commands_removed"], 0)
+        self.assertTrue(stats["bytes_removed"] > 0)
+        sent = len(widget.last_commands_sent[1])
+        widget.optimize_commands = False
+        with widget.delay_flush():
+            widget.element.a.b("c")
+            widget.element.html("hi")
+        self.assertEqual(len(widget.last_commands_sent[1]), sent + stats["commands_removed"])
+        self.assertEqual(widget.optimizer_stats["batches"], 1)
+
+    def cached_function_commands(self, widget):
+        sent = [c for call in widget.send.call_args_list for c in call[0][0][proxy_widget.PAYLOAD][1]]
+        return [c[1] for c in sent if c[0] == "function" and c[1][0] == "cached_function"]
+
+    def rendered_message(self, widget, session):
+        widget.handle_custom_message(None, {proxy_widget.INDICATOR: proxy_widget.VIEW_RENDERED,
+            proxy_widget.PAYLOAD: [session, session + "/1"]})
+
+    def known_message(self, widget, session, hashes):
+        widget.handle_custom_message(None, {proxy_widget.INDICATOR: proxy_widget.FUNCTIONS_KNOWN,
+            proxy_widget.PAYLOAD: [session, hashes]})
+
+    def test_js_init_function_cache(self, *args):
+        session = "test-session-function-cache"
+        widgets = []
+        for i in range(2):
+            widget = proxy_widget.JSProxyWidget()
+            widget.rendered = True
+            self.rendered_message(widget, session)
+            widget.send = MagicMock()
+            widgets.append(widget)
+        widgets[0].js_init("element.html(x);", x=0)
+        [first] = self.cached_function_commands(widgets[0])
+        self.assertEqual(first[2:], ["element,x", "element.html(x);"])
+        # the body is sent until the page acknowledges compiling it.
+        widgets[1].js_init("element.html(x);", x=1)
+        self.assertEqual(self.cached_function_commands(widgets[1]), [first])
+        self.known_message(widgets[0], session, [first[1]])
+        widgets[1].send = MagicMock()
+        widgets[1].js_init("element.html(x);", x=2)
+        self.assertEqual(self.cached_function_commands(widgets[1]), [first[:2]])
+        # a miss in the page sends the body for the waiting batch and with the next js_init.
+        widgets[1].send = MagicMock()
+        widgets[1].handle_custom_message(None, {proxy_widget.INDICATOR: proxy_widget.FUNCTION_MISS,
+            proxy_widget.PAYLOAD: [session, [first[1]]]})
+        package = widgets[1].send.call_args[0][0]
+        self.assertEqual(package, {proxy_widget.INDICATOR: proxy_widget.FUNCTION_BODIES,
+            proxy_widget.PAYLOAD: [first[1:]]})
+        widgets[1].send = MagicMock()
+        widgets[1].js_init("element.html(x);", x=3)
+        self.assertEqual(self.cached_function_commands(widgets[1]), [first])
+        # each page displaying the widget must know the function.
+        self.rendered_message(widgets[0], "test-session-function-cache-2")
+        widgets[0].send = MagicMock()
+        widgets[0].js_init("element.html(x);", x=4)
+        self.assertEqual(self.cached_function_commands(widgets[0]), [first])
+        del proxy_widget.KNOWN_FUNCTIONS[session]
+        proxy_widget.KNOWN_FUNCTIONS.pop("test-session-function-cache-2", None)
+
+    def test_view_function_miss_waits_for_body(self, *args):
+        sent = self.run_view_script("""
+            var view = make_view({});
+            var full = [1, [["function", ["cached_function", "hash1", "element,x", "element.x = x;"], ["element"], 1]], 1];
+            view.execute_commands(full);
+            var short = [2, [["function", ["cached_function", "hash2"], ["element"], 2]], 1];
+            view.execute_commands(short);
+            var before = view.$$el.y;
+            view.execute_commands([3, [["set", ["element"], "z", 3]], 1]);
+            view.handle_custom_message({indicator: "function_bodies", payload: [["hash2", "element,y", "element.y = y;"]]});
+            setTimeout(function() {
+                view.sent.push(["element", [before, view.$$el]]);
+                console.log(JSON.stringify(view.sent));
+            }, 50);
+        """)
+        session = sent[0][1][0]
+        self.assertEqual([m[:2] for m in sent], [
+            [proxy_widget.FUNCTIONS_KNOWN, [session, ["hash1"]]],
+            [proxy_widget.RESULTS, [1, True]],
+            # the short form batch and the following batch wait for the body.
+            [proxy_widget.FUNCTION_MISS, [session, ["hash2"]]],
+            [proxy_widget.FUNCTIONS_KNOWN, [session, ["hash2"]]],
+            [proxy_widget.RESULTS, [2, True]],
+            [proxy_widget.RESULTS, [3, True]],
+            ["element", [None, {"x": 1, "y": 2, "z": 3}]],
+        ])
+
+    def test_js_init_function_cache_off(self, *args):
+        widget = proxy_widget.JSProxyWidget()
+        widget.rendered = True
+        widget.function_cache = False
+        widget.send = MagicMock()
+        widget.js_init("element.html(x);", x=1)
+        self.assertEqual(self.cached_function_commands(widget), [])
+
+    def test_template(self, *args):
+        widget = proxy_widget.JSProxyWidget()
+        widget.rendered = True
+        widget.send = MagicMock()
+        move = widget.template(lambda element, x, y: element.attr("x", x).attr("y", y))
+        self.assertEqual(move.holes, 2)
+        [define] = widget.last_commands_sent[1]
+        element = ["element"]
+        attrs = ["method", ["method", element, "attr", "x", ["hole", 0]], "attr", "y", ["hole", 1]]
+        self.assertEqual(define, ["template_define", move.identifier, ["list", attrs]])
+        move("a", 2)
+        self.assertEqual(widget.last_commands_sent[1], [["template_call", move.identifier, ["list", "a", 2]]])
+        self.assertRaises(AssertionError, move, 1)
+
+    def test_template_packed(self, *args):
+        import numpy as np
+        widget = proxy_widget.JSProxyWidget()
+        widget.rendered = True
+        widget.send = MagicMock()
+        first = widget.template(lambda element: [element.show(), element.hide()])
+        [define] = widget.last_commands_sent[1]
+        self.assertEqual(len(define[2]), 3)
+        move = widget.template(lambda element, x, y: element.css("left", x), holes=2)
+        self.assertEqual(move.identifier, first.identifier + 1)
+        move(1, 2.5)
+        [[indicator, identifier, params]] = widget.last_commands_sent[1]
+        self.assertEqual((indicator, identifier), ("template_call", move.identifier))
+        self.assertEqual(params[:3], ["ndarray", "<f8", [2]])
+        self.assertEqual(bytes(widget.send.call_args[0][1][0]), np.array([1, 2.5]).tobytes())
+        move.packed(np.array([1, 2], dtype=np.float32))
+        self.assertEqual(widget.last_commands_sent[1][0][2][:3], ["ndarray", "<f4", [2]])
+
+    def test_visible(self, *args):
+        widget = proxy_widget.JSProxyWidget()
+        self.assertFalse(widget.defer_while_hidden)
+        self.assertTrue(widget.visible())
+        widget.visibility = {"c1": False, "c2": False}
+        self.assertFalse(widget.visible())
+        widget.visibility = {"c1": False, "c2": True}
+        self.assertTrue(widget.visible())
+
+    def test_hidden_view_runs_sync_value(self, *args):
+        widget = proxy_widget.JSProxyWidget()
+        widget.rendered = True
+        widget.auto_flush = False
+        widget.send = MagicMock()
+        widget._send_synced_command(widget.element.width(), 3)
+        batch = widget.last_commands_sent
+        sent = self.run_view_script("""
+            var view = make_view({defer_while_hidden: true, max_deferred_commands: 3});
+            view.observe_visibility();
+            view._hidden = true;
+            var replies = [];
+            view.$$el.width = function() { return 7; };
+            view.$$el._SEND_FRAGILE_JS_REFERENCE = function() { replies.push(view.$$el._FRAGILE_JS_REFERENCE); };
+            view.execute_commands(%s);
+            var deferred_runs = 0;
+            view.$$el.count = function() { deferred_runs++; };
+            for (var i=0; i<3; i++) {
+                view.execute_commands([10 + i, [["method", ["element"], "count"], ["method", ["element"], "count"]], 1]);
+            }
+            Promise.resolve().then(function() {
+                console.log(JSON.stringify([replies, deferred_runs, view._deferred.length]));
+            });
+        """ % json.dumps(batch))
+        [replies, deferred_runs, queued] = sent
+        # the kernel polling for sync_value gets its reply while the view is hidden.
+        self.assertEqual(replies, [7])
+        # the queue ran when it grew beyond max_deferred_commands.
+        self.assertEqual((deferred_runs, queued), (4, 2))
+
+    def evaluated(self, widget, identifier, ok, value):
+        widget.handle_custom_message(None, {proxy_widget.INDICATOR: proxy_widget.EVALUATED,
+            proxy_widget.PAYLOAD: [identifier, ok, value]})
+
+    def test_lazy_property_names(self, *args):
+        widget = proxy_widget.JSProxyWidget()
+        widget.rendered = True
+        widget.expression_mode = True
+        widget.send = MagicMock()
+        # javascript properties with the names of widget methods are not hidden.
+        for name in ("value", "handle", "sync_values"):
+            self.assertEqual(widget.validate_command(getattr(widget.element.input, name)),
+                ["get", ["get", ["element"], "input"], name])
+        self.assertEqual(widget.validate_command(widget.element.sync_values), ["get", ["element"], "sync_values"])
+
+    def test_evaluate_async(self, *args):
+        widget = proxy_widget.JSProxyWidget()
+        widget.rendered = True
+        widget.send = MagicMock()
+        element = widget.get_element()
+        async def run():
+            width = asyncio.ensure_future(widget.evaluate_async(element.width()))
+            height = asyncio.ensure_future(widget.evaluate_async(widget.element.height()))
+            await asyncio.sleep(0)
+            sent = [c for call in widget.send.call_args_list for c in call[0][0][proxy_widget.PAYLOAD][1]]
+            requests = [c for c in sent if c[0] == "evaluate"]
+            [first, second] = sorted(widget._evaluations)
+            self.assertEqual([r[1] for r in requests], [first, second])
+            self.evaluated(widget, second, True, 20)
+            self.evaluated(widget, first, True, 10)
+            return await asyncio.gather(width, height)
+        self.assertEqual(asyncio.run(run()), [10, 20])
+        self.assertEqual(widget._evaluations, {})
+
+    def test_evaluate_async_errors(self, *args):
+        widget = proxy_widget.JSProxyWidget()
+        widget.rendered = True
+        widget.send = MagicMock()
+        async def run():
+            result = asyncio.ensure_future(widget.evaluate_async(widget.get_element().width()))
+            await asyncio.sleep(0)
+            [identifier] = widget._evaluations
+            self.evaluated(widget, identifier, False, "no such method")
+            with self.assertRaises(proxy_widget.JavascriptException):
+                await result
+            with self.assertRaises(asyncio.TimeoutError):
+                await widget.evaluate_async(widget.get_element().width(), timeout=0.01)
+        asyncio.run(run())
+        self.assertEqual(widget._evaluations, {})
+
+    @patch("jp_proxy_widget.proxy_widget.run_ui_poll_loop")
+    def test_sync_values(self, run_ui_poll_loop):
+        widget = proxy_widget.JSProxyWidget()
+        widget.rendered = True
+        widget.send = MagicMock()
+        def fake_poll(replied):
+            [identifier] = widget._evaluations
+            sent = [c for call in widget.send.call_args_list for c in call[0][0][proxy_widget.PAYLOAD][1]]
+            [request] = [c for c in sent if c[0] == "evaluate_many"]
+            self.assertEqual(request[:3], ["evaluate_many", identifier, 3])
+            self.assertEqual(request[3][1]["style.width"],
+                ["get", ["get", ["element"], "style"], "width"])
+            self.evaluated(widget, identifier, True,
+                {"scrollTop": [True, 12], "style.width": [False, "no such property"]})
+            self.assertTrue(replied())
+        run_ui_poll_loop.side_effect = fake_poll
+        values = widget.sync_values(widget.get_element(), ["scrollTop", "style.width"])
+        self.assertEqual(values["scrollTop"], 12)
+        self.assertIsInstance(values["style.width"], proxy_widget.JavascriptException)
+        self.assertEqual(widget._evaluations, {})
+
+    @patch("jp_proxy_widget.proxy_widget.run_ui_poll_loop")
+    def test_evaluate_many_timeout(self, run_ui_poll_loop):
+        widget = proxy_widget.JSProxyWidget()
+        widget.rendered = True
+        widget.send = MagicMock()
+        run_ui_poll_loop.side_effect = lambda replied: self.assertTrue(replied())
+        with self.assertRaises(TimeoutError):
+            widget.evaluate_many({"width": widget.get_element().width()}, timeout=0)
+        self.assertEqual(widget._evaluations, {})
+
+    def test_evaluate_many_async(self, *args):
+        widget = proxy_widget.JSProxyWidget()
+        widget.rendered = True
+        widget.send = MagicMock()
+        element = widget.get_element()
+        async def run():
+            result = asyncio.ensure_future(widget.evaluate_many_async({"w": element.width(), "h": element.height()}))
+            await asyncio.sleep(0)
+            [identifier] = widget._evaluations
+            self.evaluated(widget, identifier, True, {"w": [True, 10], "h": [True, 20]})
+            return await result
+        self.assertEqual(asyncio.run(run()), {"w": 10, "h": 20})
+
+    def test_result_stream(self, *args):
+        widget = proxy_widget.JSProxyWidget()
+        widget.rendered = True
+        widget.send = MagicMock()
+        element = widget.get_element()
+        streamed = []
+        done = MagicMock()
+        widget.send_commands([element.attr("x", 1), widget.result("width", element.width(), level=2)],
+            results_callback=done, stream_callback=lambda key, value: streamed.append((key, value)))
+        [count, commands, level] = widget.last_commands_sent
+        self.assertEqual(commands[0][0], "method")
+        self.assertEqual(commands[1], ["result", "width", 2, ["method", ["element"], "width"]])
+        i = proxy_widget.INDICATOR
+        p = proxy_widget.PAYLOAD
+        widget.handle_custom_message(None, {i: proxy_widget.RESULT, p: [count, "width", 100]})
+        self.assertEqual(streamed, [("width", 100)])
+        self.assertFalse(done.called)
+        widget.handle_custom_message(None, {i: proxy_widget.RESULTS, p: [count, True]})
+        done.assert_called_with(True)
+        self.assertEqual(widget.count_to_results_callback, {})
+        # results arriving after the acknowledgement are ignored.
+        widget.handle_custom_message(None, {i: proxy_widget.RESULT, p: [count, "width", 200]})
+        self.assertEqual(streamed, [("width", 100)])
+
+    def test_result_stream_held(self, *args):
+        widget = self.flow_controlled_widget(proxy_widget.COALESCE)
+        streamed = []
+        element = widget.get_element()
+        for i in range(4):
+            widget.send_command(widget.result(i, element.attr("x", i)),
+                stream_callback=lambda key, value, i=i: streamed.append((i, key, value)))
+        self.assertEqual(self.sent_counts(widget), [0, 1])
+        self.acknowledge(widget, 0)
+        [count, commands, level] = widget.last_commands_sent
+        # each result of the merged batch streams only to the callback of the batch with its key.
+        widget.handle_result([count, 3, "ok"])
+        widget.handle_result([count, 2, "fine"])
+        self.assertEqual(streamed, [(3, 3, "ok"), (2, 2, "fine")])
+
+    def test_handle(self, *args):
+        import gc
+        widget = proxy_widget.JSProxyWidget()
+        widget.rendered = True
+        widget.expression_mode = True
+        widget.send = MagicMock()
+        handle = widget.handle(widget.element.find("p"))
+        self.assertEqual(widget.last_commands_sent[1],
+            [["handle_set", 0, ["method", ["element"], "find", "p"]]])
+        handle.hide()
+        widget.flush()
+        sent = [c for call in widget.send.call_args_list for c in call[0][0][proxy_widget.PAYLOAD][1]]
+        self.assertIn(["set", ["element"], proxy_widget.FRAGILE_JS_REFERENCE, ["method", ["handle", 0], "hide"]], sent)
+        shared = widget.handle(handle)
+        self.assertEqual(shared.identifier, 0)
+        sends = widget.send.call_count
+        widget.flush()
+        del shared
+        gc.collect()
+        widget.flush()
+        # released only when the last JSHandle is collected, with the next flush.
+        self.assertEqual(widget.send.call_count, sends)
+        # (the last statement is kept as the fragile reference.)
+        widget.element.html("x")
+        widget.flush()
+        del handle
+        gc.collect()
+        widget.flush()
+        self.assertEqual(widget.last_commands_sent[1], [["handle_release", 0]])
+        sends = widget.send.call_count
+        widget.flush()
+        self.assertEqual(widget.send.call_count, sends)
+
+    def test_handle_does_not_keep_widget(self, *args):
+        import gc
+        class Widget(object):
+            def release_handle(self, identifier):
+                released.append(identifier)
+        released = []
+        widget = Widget()
+        handle = proxy_widget.JSHandle(widget, 4)
+        del handle
+        gc.collect()
+        self.assertEqual(released, [4])
+        handle = proxy_widget.JSHandle(widget, 5)
+        widget_reference = weakref.ref(widget)
+        handle.for_widget = None
+        del widget
+        gc.collect()
+        # the finalizer does not keep the widget alive, and does nothing after it is gone.
+        self.assertIsNone(widget_reference())
+        del handle
+        gc.collect()
+        self.assertEqual(released, [4])
+
+    def test_handle_set_kept_on_drop(self, *args):
+        widget = self.flow_controlled_widget(proxy_widget.DROP_OLDEST)
+        widget.flow_control_held = 1
+        widget.expression_mode = True
+        for i in range(3):
+            widget.send_command(["element"])
+        handle = widget.handle(widget.element.find("p"))
+        self.assertEqual(widget._dropped_batches, 1)
+        widget.send_command(["window"])
+        # the batch with the handle_set is merged into the next held batch instead of dropped.
+        self.assertEqual(widget._dropped_batches, 1)
+        [[commands, callbacks, level, segmented, streams]] = widget._held_batches
+        self.assertEqual(commands, [["handle_set", handle.identifier, ["method", ["element"], "find", "p"]], ["list", "window"]])
+
+    def test_view_handles_shared_by_views(self, *mocks):
+        values = self.run_view_script("""
+            var model = {};
+            var first = make_view({}, model);
+            first.$$el.p = "paragraph";
+            first.execute_commands([1, [["handle_set", 0, ["get", ["element"], "p"]]], 1]);
+            var later = make_view({}, model);
+            later.execute_commands([2, [["set", ["element"], "q", ["handle", 0]]], 1]);
+            later.execute_commands([3, [["handle_release", 0]], 1]);
+            first.execute_commands([3, [["handle_release", 0]], 1]);
+            console.log(JSON.stringify([later.$$el.q, later.error_msg || null, model.handle_table]));
+        """)
+        self.assertEqual(values, ["paragraph", None, {}])
+
+    def test_send_binary_as_hex(self, *args):
+        widget = proxy_widget.JSProxyWidget()
+        widget.rendered = True
+        widget.binary_buffers = False
+        s = widget.send = MagicMock()
+        widget.send_command(widget.get_element().download("name", b"\x12\xff"))
+        (package, buffers) = s.call_args[0]
+        [count, commands, level] = package[proxy_widget.PAYLOAD]
+        self.assertEqual(commands[0][-1], ["bytes", "12ff"])
+        self.assertEqual(buffers, None)
+
+    def test_send_segmented_message_content(self, *args):
+        payload = [1, ["method", ["element"], "html", "x" * 250], 2]
+        widget = proxy_widget.JSProxyWidget()
+        s = widget.send_custom_message = MagicMock()
+        widget.send_segmented_message("frag", "final", payload, 100)
+        indicators = [c[0][0] for c in s.call_args_list]
+        self.assertEqual(indicators, ["frag", "frag", "final"])
+        text = "".join(c[0][1] for c in s.call_args_list)
+        self.assertEqual(json.loads(text), payload)
+
+    def test_send_segmented_message_buffers(self, *args):
+        payload = list(range(1000))
+        widget = proxy_widget.JSProxyWidget()
+        s = widget.send_custom_message = MagicMock()
+        buffers = [b"binary"]
+        widget.send_segmented_message("frag", "final", payload, 100, buffers)
+        self.assertEqual(s.call_args[0], ("final", s.call_args[0][1], buffers))
+
+    def test_encode_binary(self, *args):
+        text = "a long string " * 10
+        command = [
+            "method", ["element"], "html", text, ["bytes", b"\x01"], ["id", b"untranslated"],
+            ["dict", {"key": ["bytes", memoryview(b"\x02")]}],
+        ]
+        buffers = []
+        encoded = proxy_widget.encode_binary(command, buffers, text_threshold=100)
+        self.assertEqual(encoded, [
+            "method", ["element"], "html", ["text", 0], ["bytes", 1], ["id", b"untranslated"],
+            ["dict", {"key": ["bytes", 2]}],
+        ])
+        self.assertEqual(bytes(buffers[0]), text.encode("utf8"))
+        self.assertEqual(len(buffers), 3)
+        # short strings and method names are not moved to buffers
+        encoded = proxy_widget.encode_binary(command, [], text_threshold=1000)
+        self.assertEqual(encoded[3], text)
+        # hex encoding fallback
+        hexed = proxy_widget.encode_binary(["bytes", bytearray(b"\x12\xff")], None)
+        self.assertEqual(hexed, ["bytes", "12ff"])
+        # templates run with the buffers of later messages: keep their values inline.
+        buffers = []
+        define = ["template_define", 0, ["list", ["method", ["element"], "html", text, ["bytes", b"\x12"]]]]
+        encoded = proxy_widget.encode_binary(define, buffers, text_threshold=100)
+        self.assertEqual(encoded[2], ["list", ["method", ["element"], "html", text, ["bytes", "12"]]])
+        self.assertEqual(buffers, [])
+
+    def test_text_buffers_round_trip(self, *args):
+        widget = proxy_widget.JSProxyWidget()
+        widget.rendered = True
+        widget.binary_buffers = True
+        widget.utf8_buffer_threshold = 20
+        s = widget.send = MagicMock()
+        method = "method_with_a_long_name"
+        key = "result_key_with_a_long_name"
+        argument = "an argument long enough to send as text"
+        widget(widget.result(key, getattr(widget.get_element(), method)(argument)))
+        (package, buffers) = s.call_args[0]
+        # only the argument is moved to a message buffer.
+        self.assertEqual(package[proxy_widget.PAYLOAD][1],
+            [["result", key, 1, ["method", ["element"], method, ["text", 0]]]])
+        incoming = [package, [list(bytes(b)) for b in buffers]]
+        sent = self.run_view_script("""
+            var incoming = %s;
+            var view = make_view({binary_buffers: true});
+            view.$$el.%s = function(x) { return x + "!"; };
+            view.handle_custom_message(incoming[0], incoming[1].map(function(b) { return new Uint8Array(b); }));
+            console.log(JSON.stringify(view.sent));
+        """ % (json.dumps(incoming), method))
+        self.assertEqual([m[:2] for m in sent], [
+            [proxy_widget.RESULT, [package[proxy_widget.PAYLOAD][0], key, argument + "!"]],
+            [proxy_widget.RESULTS, [package[proxy_widget.PAYLOAD][0], True]],
+        ])
+
+    def test_js_init_ndarray(self, *args):
+        import numpy as np
+        widget = proxy_widget.JSProxyWidget()
+        widget.rendered = True
+        s = widget.send = MagicMock()
+        A = np.arange(12, dtype=np.float32).reshape((3, 4))
+        widget.js_init("element.array = A;", A=A, scalar=np.float32(1.5))
+        (package, buffers) = s.call_args_list[-1][0]
+        [count, commands, level] = package[proxy_widget.PAYLOAD]
+        call = commands[-1]
+        self.assertIn(["ndarray", "<f4", [3, 4], ["bytes", 0]], call)
+        self.assertIn(1.5, call)
+        self.assertEqual(bytes(buffers[0]), A.tobytes())
+
+    def test_ndarray_command(self, *args):
+        import numpy as np
+        A = np.arange(6, dtype=">i2").reshape((2, 3))[:, 1:]
+        [indicator, dtype, shape, [bytes_indicator, data]] = proxy_widget.ndarray_command(A)
+        self.assertEqual((indicator, dtype, shape, bytes_indicator), ("ndarray", "<i2", [2, 2], "bytes"))
+        self.assertEqual(bytes(data), np.array([1, 2, 4, 5], dtype="<i2").tobytes())
+        H = np.array([1.5], dtype=np.float16)
+        self.assertEqual(proxy_widget.ndarray_command(H)[1], "<f8")
+        S = np.array(["a", "b"])
+        self.assertEqual(proxy_widget.ndarray_command(S), ["list", "a", "b"])
+
+    def test_ndarray_int64(self, *args):
+        import numpy as np
+        small = np.array([-3, 2**31 - 1], dtype=np.int64)
+        [indicator, dtype, shape, [bytes_indicator, data]] = proxy_widget.ndarray_command(small)
+        self.assertEqual(dtype, "<i4")
+        self.assertEqual(bytes(data), small.astype("<i4").tobytes())
+        self.assertEqual(proxy_widget.ndarray_command(np.array([2**32 - 1], dtype=np.uint64))[1], "<u4")
+        large = np.array([2**40, -1], dtype=np.int64)
+        [indicator, dtype, shape, [bytes_indicator, data]] = proxy_widget.ndarray_command(large)
+        self.assertEqual(dtype, "<f8")
+        self.assertEqual(bytes(data), large.astype("<f8").tobytes())
+        self.assertEqual(proxy_widget.to_javascript(large), "Float64Array.from([1099511627776.0, -1.0])")
+        # BigInt typed arrays are opt in.
+        wrapped = proxy_widget.bigint_array(large)
+        self.assertEqual(proxy_widget.LiteralMaker(wrapped)._cmd()[1], "<i8")
+        self.assertEqual(proxy_widget.quoteIfNeeded(wrapped)._cmd()[1], "<i8")
+        self.assertEqual(proxy_widget.to_javascript(wrapped), "BigInt64Array.from([1099511627776, -1], BigInt)")
+
+    def test_quote_numpy(self, *args):
+        import numpy as np
+        self.assertEqual(type(proxy_widget.quoteIfNeeded(np.int64(3))), int)
+        self.assertEqual(type(proxy_widget.quoteIfNeeded(np.float32(3))), float)
+        self.assertIsInstance(proxy_widget.quoteIfNeeded(np.zeros(3)), proxy_widget.LiteralMaker)
+        L = proxy_widget.LiteralMaker({"array": np.zeros(2, dtype=np.uint8)})._cmd()
+        self.assertEqual(L[1]["array"]._cmd()[:3], ["ndarray", "|u1", [2]])
+        js = proxy_widget.to_javascript(np.arange(3, dtype=np.int32))
+        self.assertEqual(js, "Int32Array.from([0, 1, 2])")
+
+    def test_encode_binary_loader(self, *args):
+        text = "x" * 100
+        buffers = []
+        encoded = proxy_widget.encode_binary([proxy_widget.LOAD_JS, "name.js", text], buffers, 10)
+        self.assertEqual(encoded, [proxy_widget.LOAD_JS, "name.js", ["text", 0]])
+
 
     """
     def test_evaluate(self, *args):
@@ -497,6 +1714,102 @@ class TestProxyWidget(unittest.TestCase):
         widget.forget_callback(list)
         self.assertEqual(list(widget.identifier_to_callback.keys()), [2])
 
+    def test_forget_bound_method(self, *args):
+        widget = proxy_widget.JSProxyWidget()
+        class Handler:
+            def on_event(self, *args):
+                pass
+        handler = Handler()
+        other = Handler()
+        c = widget.callback(handler.on_event, "data")
+        weak = widget.callable(handler.on_event, lifetime=proxy_widget.WEAK)
+        kept = widget.callback(other.on_event, "data")
+        # each attribute access creates a new bound method object.
+        widget.forget_callback(handler.on_event)
+        self.assertNotIn(c.args[0], widget.identifier_to_callback)
+        self.assertNotIn(weak.args[0], widget.identifier_to_callback)
+        self.assertIn(kept.args[0], widget.identifier_to_callback)
+
+    def test_forget_callable_tells_view(self, *args):
+        widget = proxy_widget.JSProxyWidget()
+        widget.rendered = True
+        widget.send = MagicMock()
+        def f(*args):
+            pass
+        c = widget.callable(f)
+        identifier = c.args[0]
+        widget.forget_callback(f)
+        self.assertNotIn(identifier, widget.identifier_to_callback)
+        self.assertNotIn(f, widget.callable_cache)
+        widget.flush()
+        self.assertEqual(widget.last_commands_sent[1], [["forget_callbacks", identifier]])
+        self.assertIsNot(widget.callable(f), c)
+
+    def test_callback_scope(self, *args):
+        widget = proxy_widget.JSProxyWidget()
+        def f(*args):
+            pass
+        before = widget.callback_stats()
+        kept = widget.callback(f, "kept")
+        with widget.callback_scope():
+            scoped = widget.callable(lambda x: x)
+            self.assertEqual(widget.callback_stats()["scopes"], 1)
+        self.assertIn(kept.args[0], widget.identifier_to_callback)
+        self.assertNotIn(scoped.args[0], widget.identifier_to_callback)
+        self.assertEqual(widget._forgotten_callbacks, [scoped.args[0]])
+        stats = widget.callback_stats()
+        self.assertEqual(stats["callbacks"], before["callbacks"] + 1)
+        self.assertEqual(stats["callables"], before["callables"])
+        self.assertEqual(stats["forgotten"], 1)
+        self.assertGreater(stats["registry_bytes"], 0)
+
+    def test_callback_weak(self, *args):
+        import gc
+        widget = proxy_widget.JSProxyWidget()
+        calls = []
+        class Handler:
+            def on_event(self, *args):
+                calls.append(args)
+        handler = Handler()
+        c = widget.callable(handler.on_event, lifetime=proxy_widget.WEAK)
+        identifier = c.args[0]
+        widget.identifier_to_callback[identifier]("data", {"0": 1})
+        self.assertEqual(calls, [(1,)])
+        del handler
+        gc.collect()
+        self.assertNotIn(identifier, widget.identifier_to_callback)
+        self.assertEqual(widget._forgotten_callbacks, [identifier])
+
+    def test_callback_weak_does_not_keep_widget(self, *args):
+        import gc
+        widget = proxy_widget.JSProxyWidget()
+        class Handler:
+            def on_event(self, *args):
+                pass
+        handler = Handler()
+        widget.callable(handler.on_event, lifetime=proxy_widget.WEAK)
+        widget_reference = weakref.ref(widget)
+        widget.close()
+        del widget
+        gc.collect()
+        self.assertIs(widget_reference(), None)
+        # the finalizer does nothing once the widget is gone.
+        del handler
+        gc.collect()
+
+    @patch("jp_proxy_widget.proxy_widget.time.time")
+    def test_callback_expiry(self, time):
+        widget = proxy_widget.JSProxyWidget()
+        time.return_value = 100.0
+        f = MagicMock()
+        c = widget.callback(f, "data", lifetime=10)
+        widget.handle_callback_results([c.args[0], "data", {}, 1])
+        self.assertEqual(f.call_count, 1)
+        time.return_value = 111.0
+        widget.handle_callback_results([c.args[0], "data", {}, 2])
+        self.assertEqual(f.call_count, 1)
+        self.assertEqual(widget.callback_stats()["expiring"], 0)
+
     def test_js_debug(self, *args):
         widget = proxy_widget.JSProxyWidget()
         widget.get_element = MagicMock()
@@ -536,6 +1849,9 @@ class TestProxyWidget(unittest.TestCase):
             ["function", ["element"]] + call_args,
             ["id", "untranslated"],
             ["bytes", u"12ff"],
+            ["bytes", 0],
+            ["text", 0],
+            ["ndarray", "<f4", [2, 2], ["bytes", 0]],
             ["list"] + call_args,
             ["dict", {"key": ["element"]}],
             ["callback", numerical_identifier, untranslated_data, level, segmented],
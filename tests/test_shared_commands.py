@@ -0,0 +1,62 @@
+import unittest
+import json
+from jp_proxy_widget import shared_commands
+
+def expand(commands, table):
+    "Python version of the view's expand_shared for checking round trips."
+    expanded = []
+    def expand_one(command):
+        if type(command) is not list or not command:
+            return command
+        if command[0] == "ref":
+            return expanded[command[1]]
+        if command[0] in ("id", "callback"):
+            return command
+        result = command[:1]
+        for item in command[1:]:
+            if type(item) is dict:
+                item = dict((k, expand_one(v)) for (k, v) in item.items())
+            else:
+                item = expand_one(item)
+            result.append(item)
+        return result
+    for entry in table:
+        expanded.append(expand_one(entry))
+    return [expand_one(c) for c in commands]
+
+FRAGILE = ["get", ["element"], "_FRAGILE_THIS"]
+
+class TestSharedCommands(unittest.TestCase):
+
+    def test_no_sharing_for_small_batches(self):
+        commands = [["method", ["element"], "html", "hello"]]
+        (shared, table) = shared_commands.share_commands(commands)
+        self.assertEqual(table, [])
+        self.assertIs(shared, commands)
+
+    def test_repeated_subtrees_shared(self):
+        chain = ["method", FRAGILE, "appendChild", ["method", ["window"], "createTextNode", "some text"]]
+        commands = [list(chain) for i in range(6)]
+        (shared, table) = shared_commands.share_commands(commands)
+        self.assertEqual(table, [chain])
+        self.assertEqual(shared, [["ref", 0]] * 6)
+        self.assertTrue(len(json.dumps([shared, table])) < len(json.dumps(commands)))
+        self.assertEqual(expand(shared, table), commands)
+
+    def test_table_entries_refer_to_earlier_entries(self):
+        name = "a_rather_long_attribute_name"
+        commands = [["set", FRAGILE, name, i] for i in range(5)]
+        commands += [["get", FRAGILE, name]] * 3
+        (shared, table) = shared_commands.share_commands(commands)
+        self.assertTrue(len(table) >= 2)
+        self.assertEqual(expand(shared, table), commands)
+        self.assertTrue(len(json.dumps([shared, table])) < len(json.dumps(commands)))
+
+    def test_indicators_and_untranslated_data_unchanged(self):
+        data = {"nested": ["ref", 0], "text": "untranslated string " * 3}
+        commands = [["method", ["element"], "f", ["id", data], ["dict", {"k": ["list", "x" * 40]}]]
+            for i in range(4)]
+        commands += [["list", "x" * 40]] * 3
+        (shared, table) = shared_commands.share_commands(commands)
+        self.assertEqual(expand(shared, table), commands)
+        self.assertIn(["id", data], [c[3] for c in table if c[0] == "method"])
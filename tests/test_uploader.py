@@ -0,0 +1,33 @@
+import unittest
+from jp_proxy_widget import uploader
+from jp_proxy_widget import hex_codec
+
+class TestUploader(unittest.TestCase):
+
+    def test_from_hex_iterator(self):
+        binary = bytes(range(256))
+        hex_content = hex_codec.bytes_to_hex(binary)
+        decoded = b"".join(uploader.from_hex_iterator(hex_content, chunk_size=33))
+        self.assertEqual(decoded, binary)
+
+    def test_binary_chunks(self):
+        received = []
+        def content_callback(widget, name, content):
+            received.append((name, content))
+        u = uploader.BinaryUploader(content_callback=content_callback)
+        binary = bytes(range(256))
+        hex_content = hex_codec.bytes_to_hex(binary)
+        info = {"size": len(binary)}
+        # chunks need not split the hex content at byte boundaries
+        u.handle_chunk("more", "name", hex_content[:101], info)
+        u.handle_chunk("done", "name", hex_content[101:], info)
+        self.assertEqual(received, [("name", binary)])
+
+    def test_unicode_chunks(self):
+        received = []
+        def content_callback(widget, name, content):
+            received.append(content)
+        u = uploader.UnicodeUploader(content_callback=content_callback)
+        u.handle_chunk("more", "name", u"abc", {"size": 6})
+        u.handle_chunk("done", "name", u"def", {"size": 6})
+        self.assertEqual(received, [u"abcdef"])